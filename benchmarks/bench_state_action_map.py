@@ -0,0 +1,111 @@
+"""
+Microbenchmark of the per-step cost of the Q-table operations on the retry hot path.
+
+Compares the numpy backed StateActionMap against the pandas DataFrame implementation it replaced
+(reproduced below as PandasStateActionMap).
+
+    python benchmarks/bench_state_action_map.py
+"""
+
+import math
+import random
+import timeit
+
+import pandas as pd
+
+from rlretry.rlretry import Action, StateActionMap, default_alpha_func
+
+NUM_STATES = 50
+NUMBER = 2000
+
+
+class PandasStateActionMap:
+    """
+    the hot path of the original DataFrame backed StateActionMap
+    """
+
+    def __init__(self, initial_value: float = 1.0):
+        self._df = pd.DataFrame(columns=list(Action), dtype=pd.Float32Dtype())
+        self._counts_df = pd.DataFrame(columns=list(Action))
+        self._initial_value = initial_value
+        self._alpha = default_alpha_func
+
+    def randomish_action(self, state: str) -> Action:
+        possible_actions = list(Action)[1:]
+        weights = [
+            1 / math.log(2 + self._counts_df[action][state])
+            for action in possible_actions
+        ]
+        return random.choices(possible_actions, weights=weights)[0]
+
+    def best_action(self, state) -> Action:
+        actions = self._df.loc[state]
+        return actions.index[actions.argmax()]
+
+    def create_state(self, state: str):
+        self._df.loc[state] = [1.0] + [
+            float(self._initial_value) for _ in list(Action)[1:]
+        ]
+        self._counts_df.loc[state] = [0 for _ in list(Action)]
+
+    def update_average_reward(self, state: str, action: Action, new_reward: float):
+        if state not in self._df.index:
+            self.create_state(state)
+        count = self._counts_df[action][state]
+        current_average = self._df[action][state]
+        value_delta = (new_reward - current_average) * self._alpha(count)
+        self._df.loc[state, action] += value_delta
+        self._counts_df.loc[state, action] += 1
+
+
+def per_step_microseconds(stmt) -> float:
+    return min(timeit.repeat(stmt, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def bench(name: str, sam):
+    states = [f"state{i}" for i in range(NUM_STATES)]
+    for state in states:
+        sam.create_state(state)
+    actions = list(Action)
+
+    def update():
+        sam.update_average_reward(
+            random.choice(states), random.choice(actions), random.random()
+        )
+
+    def best():
+        sam.best_action(random.choice(states))
+
+    def explore():
+        sam.randomish_action(random.choice(states))
+
+    counter = iter(range(10**9))
+
+    def create():
+        sam.create_state(f"new{next(counter)}")
+
+    return {
+        "impl": name,
+        "update_average_reward": per_step_microseconds(update),
+        "best_action": per_step_microseconds(best),
+        "randomish_action": per_step_microseconds(explore),
+        "create_state": per_step_microseconds(create),
+    }
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    results = [
+        bench("pandas (before)", PandasStateActionMap()),
+        bench("numpy (after)", StateActionMap(None, None, 1.0, default_alpha_func)),
+    ]
+    columns = [
+        "update_average_reward",
+        "best_action",
+        "randomish_action",
+        "create_state",
+    ]
+    print(f"per step cost in microseconds ({NUM_STATES} states)")
+    print(f"{'':<18}" + "".join(f"{c:>24}" for c in columns))
+    for result in results:
+        print(f"{result['impl']:<18}" + "".join(f"{result[c]:>24.2f}" for c in columns))
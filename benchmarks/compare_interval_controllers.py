@@ -0,0 +1,95 @@
+"""
+Compare the interval controllers of auto_request_interval against a simulated rate limiter, in virtual time.
+
+    python benchmarks/compare_interval_controllers.py --hours 6 --rate-limit 100
+
+The server only raises TooBusyFailure, once more than rate_limit requests have been sent in a minute.  For each
+controller it reports the successes, the failed requests, the final interval and the throughput as a fraction of
+the best possible (every request succeeding at the limit).  --tighten-to changes the limit halfway through.
+"""
+
+import argparse
+from collections import deque
+from datetime import timedelta
+import random
+from typing import Dict, NamedTuple
+
+from rlretry.auto_rate_limit import RequestScheduler
+from rlretry.simulation import SimulatedServer, Simulator, TooBusyFailure
+
+CONTROLLERS: Dict[str, Dict] = {
+    "grid_1s": dict(controller="grid", time_increment=timedelta(seconds=1)),
+    "grid_100ms": dict(controller="grid", time_increment=timedelta(seconds=0.1)),
+    "bisection_10ms": dict(controller="bisection"),
+    "bisection_100ms": dict(controller="bisection", resolution=timedelta(seconds=0.1)),
+}
+
+
+class Run(NamedTuple):
+    successes: int
+    failures: int
+    interval: timedelta
+
+
+def run(
+    controller: Dict, hours: float, rate_limit: int, tighten_to: int, seed: int
+) -> Run:
+    random.seed(seed)
+    simulator = Simulator()
+    clock = simulator.clock
+    server = SimulatedServer(
+        clock,
+        random_failure_rate=0.0,
+        outage_duration=timedelta(0),
+        rate_limit=rate_limit,
+        repeatable_failure_prefix="",
+    )
+    failures = 0
+
+    scheduler = RequestScheduler(
+        maximum=timedelta(seconds=10), clock=clock, epsilon=0.05, **controller
+    )
+
+    call = scheduler(server.request)
+
+    end = clock.monotonic() + hours * 3600
+    halfway = clock.monotonic() + hours * 1800
+    while clock.monotonic() < end:
+        if tighten_to and clock.monotonic() >= halfway:
+            server.rate_limit = tighten_to
+            server._request_times = deque(maxlen=tighten_to)
+            tighten_to = 0
+        try:
+            call()
+        except TooBusyFailure:
+            failures += 1
+    return Run(server.requests - failures, failures, scheduler.current_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hours", type=float, default=6.0)
+    parser.add_argument("--rate-limit", type=int, default=100)
+    parser.add_argument("--tighten-to", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # the limiter compares each request with the one rate_limit - 1 requests before it
+    limits = [args.rate_limit] * 2
+    if args.tighten_to:
+        limits[1] = args.tighten_to
+    best = sum(args.hours * 1800 / (60 / (limit - 1)) for limit in limits)
+
+    print(
+        f"{'controller':<16} {'successes':>10} {'failures':>9} {'interval':>9} {'throughput':>11}"
+    )
+    for name, controller in CONTROLLERS.items():
+        r = run(controller, args.hours, args.rate_limit, args.tighten_to, args.seed)
+        print(
+            f"{name:<16} {r.successes:>10} {r.failures:>9} "
+            f"{r.interval.total_seconds():>8.3f}s {r.successes / best:>11.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Compare the action selection strategies on the simulated failure scenarios, in virtual time.
+
+    python benchmarks/compare_strategies.py --hours 6
+
+For each scenario and strategy it reports the mean number of retries per successful call and the pseudo-regret:
+the sum over every retry of (the mean reward of the best action in that state - the mean reward of the action taken),
+where the mean rewards are estimated from the retries of every strategy in the scenario.
+"""
+
+import argparse
+from collections import defaultdict
+from datetime import timedelta
+import random
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from rlretry import rlretry
+from rlretry.simulation import SimulatedServer, Simulator
+from rlretry.strategies import (
+    DecayingEpsilonGreedy,
+    EpsilonGreedy,
+    ThompsonSampling,
+    UCB1,
+)
+
+SCENARIOS: Dict[str, Dict] = {
+    # only RandomFailure, retrying immediately is best
+    "random": dict(
+        random_failure_rate=0.1,
+        outage_duration=timedelta(0),
+        rate_limit=10**9,
+        repeatable_failure_prefix="",
+    ),
+    # only ClusteredFailure, waiting out the outage is best
+    "clustered": dict(
+        random_failure_rate=0.0, rate_limit=10**9, repeatable_failure_prefix=""
+    ),
+    # only TooBusyFailure
+    "too_busy": dict(
+        random_failure_rate=0.0,
+        outage_duration=timedelta(0),
+        repeatable_failure_prefix="",
+    ),
+    # only RepeatableFailure, aborting is best
+    "repeatable": dict(
+        random_failure_rate=0.0, outage_duration=timedelta(0), rate_limit=10**9
+    ),
+    # everything examples/mock_server.py does
+    "mixed": dict(),
+}
+
+STRATEGIES: Dict[str, Callable[[], object]] = {
+    "epsilon_greedy": lambda: EpsilonGreedy(0.1),
+    "decaying_epsilon": lambda: DecayingEpsilonGreedy(),
+    "ucb1": lambda: UCB1(),
+    "thompson": lambda: ThompsonSampling(seed=0),
+}
+
+
+class Recorder:
+    """
+    a transition_log which keeps the transitions in memory
+    """
+
+    def __init__(self):
+        self.transitions: List[Tuple] = []
+
+    def record(self, state, action, reward, next_state, duration):
+        self.transitions.append((state, action, reward))
+
+
+class Run(NamedTuple):
+    calls: int
+    successes: int
+    transitions: List[Tuple]
+
+
+def failure_state(e: Exception) -> str:
+    return e.__class__.__name__
+
+
+def run(scenario: Dict, strategy, hours: float, seed: int) -> Run:
+    random.seed(seed)
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock, **scenario)
+    recorder = Recorder()
+
+    @rlretry(
+        state_func=failure_state,
+        timeout=timedelta(seconds=300),
+        dump_interval=10**9,
+        clock=simulator.clock,
+        transition_log=recorder,
+        strategy=strategy,
+    )
+    async def call(parameter):
+        return await server.request_async(parameter)
+
+    result = simulator.run_traffic(
+        call,
+        duration=timedelta(hours=hours),
+        interval=timedelta(seconds=0.45),
+        poisson=True,
+    )
+    return Run(result.calls, result.successes, recorder.transitions)
+
+
+def pseudo_regret(transitions: List[Tuple], means: Dict) -> float:
+    best = defaultdict(lambda: float("-inf"))
+    for (state, _), mean in means.items():
+        best[state] = max(best[state], mean)
+    return sum(best[state] - means[(state, action)] for state, action, _ in transitions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hours", type=float, default=6.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenario", choices=list(SCENARIOS), action="append")
+    args = parser.parse_args()
+
+    print(
+        f"{'scenario':<12} {'strategy':<18} {'calls':>7} {'success':>8} "
+        f"{'retries/success':>16} {'regret':>10}"
+    )
+    for scenario_name in args.scenario or list(SCENARIOS):
+        runs = {
+            name: run(SCENARIOS[scenario_name], make(), args.hours, args.seed)
+            for name, make in STRATEGIES.items()
+        }
+
+        # estimate the mean reward of each state/action from every strategy's retries
+        sums: Dict = defaultdict(float)
+        counts: Dict = defaultdict(int)
+        for r in runs.values():
+            for state, action, reward in r.transitions:
+                sums[(state, action)] += reward
+                counts[(state, action)] += 1
+        means = {key: sums[key] / counts[key] for key in sums}
+
+        for name, r in runs.items():
+            retries_per_success = len(r.transitions) / max(r.successes, 1)
+            print(
+                f"{scenario_name:<12} {name:<18} {r.calls:>7} {r.successes / r.calls:>8.1%} "
+                f"{retries_per_success:>16.3f} {pseudo_regret(r.transitions, means):>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
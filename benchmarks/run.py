@@ -0,0 +1,251 @@
+"""
+Benchmarks for the overhead rlretry and auto_request_interval add to a call, and for how fast the agent learns.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare baseline.json --max-slowdown 1.25
+
+Every result is a time per operation in microseconds.  Results are written as JSON
+(a list of {"name", "params", "us_per_op"}) so that runs can be compared, and --compare exits
+with a non-zero status if any benchmark got slower than --max-slowdown times the baseline.
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import timeit
+from typing import Callable, Dict, List
+
+from rlretry import DeltaLogWeightStore, auto_request_interval, rlretry
+from rlretry.rlretry import Action, RLAgent
+
+Result = Dict[str, object]
+
+
+def us_per_op(func: Callable[[], None], number: int, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def noop():
+    return None
+
+
+def bench_first_try_success(number: int) -> List[Result]:
+    wrapped = rlretry()(noop)
+    unwrapped_us = us_per_op(noop, number)
+    wrapped_us = us_per_op(wrapped, number)
+
+    async def async_noop():
+        return None
+
+    async_wrapped = rlretry()(async_noop)
+
+    async def run_async(func) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return (time.perf_counter() - start) / number * 1e6
+
+    async_unwrapped_us = asyncio.run(run_async(async_noop))
+    async_wrapped_us = asyncio.run(run_async(async_wrapped))
+    return [
+        {"name": "unwrapped_call", "params": {}, "us_per_op": unwrapped_us},
+        {"name": "rlretry_first_try_success", "params": {}, "us_per_op": wrapped_us},
+        # what the wrapper adds to a call which succeeds first time
+        {
+            "name": "rlretry_first_try_overhead",
+            "params": {},
+            "us_per_op": wrapped_us - unwrapped_us,
+        },
+        {"name": "unwrapped_await", "params": {}, "us_per_op": async_unwrapped_us},
+        {
+            "name": "rlretry_async_first_try_success",
+            "params": {},
+            "us_per_op": async_wrapped_us,
+        },
+    ]
+
+
+def _populated_agent(num_states: int, **kwargs) -> RLAgent:
+    agent = RLAgent(0.1, alpha=0.1, dump_interval=10**9, **kwargs)
+    for i in range(num_states):
+        for action in Action:
+            agent.apply_reward(f"state{i}", action, random.random())
+    return agent
+
+
+def bench_agent_step(number: int, state_counts: List[int]) -> List[Result]:
+    results = []
+    for num_states in state_counts:
+        agent = _populated_agent(num_states)
+        states = [f"state{i}" for i in range(num_states)]
+
+        def step():
+            state = random.choice(states)
+            action = agent.choose_action(state)
+            agent.apply_reward(state, action, random.random())
+
+        results.append(
+            {
+                "name": "agent_choose_and_reward",
+                "params": {"states": num_states},
+                "us_per_op": us_per_op(step, number),
+            }
+        )
+    return results
+
+
+def bench_agent_threads(number: int, thread_counts: List[int]) -> List[Result]:
+    results = []
+    for num_threads in thread_counts:
+        agent = _populated_agent(16, thread_safe=True)
+        states = [f"state{i}" for i in range(16)]
+
+        def worker(_):
+            for _ in range(number):
+                state = random.choice(states)
+                action = agent.choose_action(state)
+                agent.apply_reward(state, action, random.random())
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(worker, range(num_threads)))
+        agent.flush_rewards()
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "name": "thread_safe_agent_step",
+                "params": {"threads": num_threads},
+                # wall time per step across all threads, ie. the inverse of throughput
+                "us_per_op": elapsed / (number * num_threads) * 1e6,
+            }
+        )
+    return results
+
+
+def bench_dump(state_counts: List[int]) -> List[Result]:
+    results = []
+    for num_states in state_counts:
+        agent = _populated_agent(num_states)
+        results.append(
+            {
+                "name": "dump_weights_dataframes",
+                "params": {"states": num_states},
+                "us_per_op": us_per_op(agent.dump_weights, 20),
+            }
+        )
+
+        with tempfile.TemporaryDirectory() as weights_dir:
+            agent = _populated_agent(
+                num_states, weight_store=DeltaLogWeightStore(weights_dir, 10**9)
+            )
+            agent.dump_weights()
+
+            def dump_one_change():
+                agent.apply_reward("state0", Action.RETRY0, 1.0)
+                agent.dump_weights()
+
+            results.append(
+                {
+                    "name": "dump_weights_delta_log_one_change",
+                    "params": {"states": num_states},
+                    "us_per_op": us_per_op(dump_one_change, 20),
+                }
+            )
+    return results
+
+
+def bench_auto_request_interval(number: int) -> List[Result]:
+    wrapped = auto_request_interval(
+        maximum=timedelta(seconds=1), time_increment=timedelta(seconds=1), epsilon=0
+    )(noop)
+    sync_us = us_per_op(wrapped, number)
+
+    async def async_noop():
+        return None
+
+    async_wrapped = auto_request_interval(
+        maximum=timedelta(seconds=1), time_increment=timedelta(seconds=1), epsilon=0
+    )(async_noop)
+
+    async def run_async():
+        start = time.perf_counter()
+        for _ in range(number):
+            await async_wrapped()
+        return time.perf_counter() - start
+
+    async_us = asyncio.run(run_async()) / number * 1e6
+    return [
+        {"name": "auto_request_interval_sync", "params": {}, "us_per_op": sync_us},
+        {"name": "auto_request_interval_async", "params": {}, "us_per_op": async_us},
+    ]
+
+
+def run(quick: bool) -> List[Result]:
+    random.seed(0)
+    number = 1000 if quick else 20000
+    state_counts = [1, 100] if quick else [1, 100, 10000]
+    thread_counts = [1, 8] if quick else [1, 8, 64]
+    return (
+        bench_first_try_success(number * 10)
+        + bench_agent_step(number, state_counts)
+        + bench_agent_threads(number // 10, thread_counts)
+        + bench_dump(state_counts)
+        + bench_auto_request_interval(number // 10)
+    )
+
+
+def _key(result: Result) -> str:
+    return f"{result['name']}{json.dumps(result['params'], sort_keys=True)}"
+
+
+def compare(results: List[Result], baseline: List[Result], max_slowdown: float) -> bool:
+    baseline_by_key = {_key(r): r for r in baseline}
+    ok = True
+    for result in results:
+        previous = baseline_by_key.get(_key(result))
+        # differences (eg. the overhead) can be close to zero
+        if previous is None or previous["us_per_op"] <= 0:
+            continue
+        ratio = result["us_per_op"] / previous["us_per_op"]
+        if ratio > max_slowdown:
+            ok = False
+            print(f"REGRESSION {_key(result)}: {ratio:.2f}x slower than the baseline")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25)
+    parser.add_argument(
+        "--quick", action="store_true", help="fewer iterations and sizes"
+    )
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    for result in results:
+        print(f"{_key(result):<60} {result['us_per_op']:>12.2f} us")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"python": platform.python_version(), "results": results}, f, indent=2
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if not compare(results, baseline, args.max_slowdown):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,10 +13,17 @@ from mock_server import ClusteredFailure, RandomFailure, RepeatableFailure, TooB
 WEIGHTS_PATH = pathlib.Path("/tmp/rlretry")
 
 
+# matched by name, so that the same failures raised by rlretry.simulation (see simulate_example.py) are recognised
+MOCK_FAILURES = {
+    cls.__name__
+    for cls in [RandomFailure, TooBusyFailure, ClusteredFailure, RepeatableFailure]
+}
+
+
 def mock_state_function(e: RuntimeError) -> str:
-    cls = e.__class__
-    if cls in [RandomFailure, TooBusyFailure, ClusteredFailure, RepeatableFailure]:
-        return cls.__name__
+    name = e.__class__.__name__
+    if name in MOCK_FAILURES:
+        return name
     raise e
 
 
@@ -0,0 +1,57 @@
+"""
+pre-train the weights used by rlretry_example.py on a simulated day of traffic, which takes seconds
+"""
+from datetime import timedelta
+import pathlib
+from typing import Tuple
+
+import pandas as pd
+
+from rlretry import rlretry
+from rlretry.simulation import SimulatedServer, SimulationResult, Simulator
+from rlretry_example import (
+    WEIGHTS_PATH,
+    create_weights_dumper_function,
+    create_weights_loader_function,
+    mock_state_function,
+)
+
+
+def simulate(
+    duration: timedelta = timedelta(days=1), weights_path: pathlib.Path = WEIGHTS_PATH
+) -> Tuple[SimulationResult, pd.DataFrame]:
+    """
+    run duration of simulated traffic and save the weights.  Returns the result and how often each action was tried
+    """
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock)
+
+    async def server_function(parameter: str) -> bool:
+        return await server.request_async(parameter)
+
+    retryable_function, agent = rlretry(
+        state_func=mock_state_function,
+        timeout=timedelta(seconds=300),
+        weight_loader=create_weights_loader_function(weights_path),
+        weight_dumper=create_weights_dumper_function(weights_path),
+        clock=simulator.clock,
+    )(server_function, return_agent=True)
+
+    result = simulator.run_traffic(
+        retryable_function,
+        duration=duration,
+        interval=timedelta(seconds=0.45),
+        poisson=True,
+    )
+    agent.dump_weights()
+    return result, agent._state_action_map.to_dataframes()[1]
+
+
+if __name__ == "__main__":
+    result, counts_df = simulate()
+    print(
+        f"{result.calls} calls, {result.success_rate:.1%} succeeded, "
+        f"mean latency {result.mean_latency:.1f}s, failures {result.failures}"
+    )
+    print(counts_df)
+    assert counts_df.to_numpy().sum() > 0, "the agent didn't learn anything"
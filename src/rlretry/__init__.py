@@ -1,2 +1,16 @@
-from .rlretry import rlretry, update_average, update_recency_weighted_average
-from .auto_rate_limit import auto_request_interval
+from .rlretry import (
+    rlretry,
+    update_average,
+    update_recency_weighted_average,
+    merge_weights,
+    Backoff,
+    backoff_ladder,
+    Hedge,
+)
+from .auto_rate_limit import auto_request_interval, AsyncRequestPacer, RequestScheduler
+from .persistence import DeltaLogWeightStore
+from .training import TransitionLog, read_transitions, train
+from .telemetry import TelemetryStreamer, TransitionRingBuffer, jsonl_file_sink
+from .metrics import PacingMetrics, PrometheusFileExporter, RetryMetrics
+from .strategies import DecayingEpsilonGreedy, EpsilonGreedy, ThompsonSampling, UCB1
+from .circuit_breaker import CircuitBreaker
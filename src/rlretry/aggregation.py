@@ -0,0 +1,341 @@
+"""
+A small weight aggregation service, so that a fleet of agents on many hosts can share what they learn.
+
+Agents push the cells which changed since their last push, along with the values those cells had at the
+last push (the base).  The server merges each push into a SQLite table with the same semantics as
+update_average / update_recency_weighted_average and replies with the merged table.
+
+    python -m rlretry.aggregation --db weights.sqlite --port 7788
+    python -m rlretry.aggregation --db weights.sqlite --unix /tmp/rlretry.sock
+
+and in each agent
+
+    client = AggregationClient(("aggregator.local", 7788))
+    @rlretry(weight_loader=client.load, weight_dumper=client.dump)
+
+The wire protocol is one JSON object per line in each direction.
+"""
+
+from __future__ import annotations
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .rlretry import (
+    Action,
+    Backoff,
+    Hedge,
+    action_from_name,
+    log,
+    update_average,
+    update_recency_weighted_average,
+)
+
+Address = Union[Tuple[str, int], str]
+
+
+def _encode_action(action) -> str:
+    return action.name if isinstance(action, (Action, Backoff, Hedge)) else str(action)
+
+
+def _decode_action(action: str):
+    try:
+        return action_from_name(action)
+    except ValueError:
+        # a label of a table which was not built by rlretry
+        return action
+
+
+def _encode_state(state) -> str:
+    return json.dumps(state)
+
+
+def _decode_state(state: str):
+    return json.loads(state)
+
+
+def _cells_to_table(cells: List[List[Any]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    if not cells:
+        return None, None
+    cells_df = pd.DataFrame(cells, columns=["state", "action", "q", "count"])
+    cells_df["action"] = [_decode_action(a) for a in cells_df["action"]]
+    states = list(pd.unique(cells_df["state"]))
+    actions = list(pd.unique(cells_df["action"]))
+    # keep ABRT in the first column
+    actions = [a for a in Action if a in actions] + [
+        a for a in actions if not isinstance(a, Action)
+    ]
+    df = cells_df.pivot(index="state", columns="action", values="q").reindex(
+        index=states, columns=actions
+    )
+    counts_df = (
+        cells_df.pivot(index="state", columns="action", values="count")
+        .reindex(index=states, columns=actions)
+        .fillna(0)
+        .astype(np.int64)
+    )
+    for table in (df, counts_df):
+        table.index.name = None
+        table.columns.name = None
+    return df, counts_df
+
+
+class WeightStore:
+    """
+    The merged weights, in a SQLite database
+    """
+
+    def __init__(self, db_path: str, alpha: Optional[float] = None):
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS weights ("
+            " state TEXT NOT NULL, action TEXT NOT NULL, q REAL NOT NULL, n INTEGER NOT NULL,"
+            " PRIMARY KEY (state, action))"
+        )
+        self._db.commit()
+
+    def cells(self) -> List[List[Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, action, q, n FROM weights ORDER BY rowid"
+            ).fetchall()
+        return [[_decode_state(state), action, q, n] for state, action, q, n in rows]
+
+    def push(self, cells: List[List[Any]]):
+        """
+        merge cells of [state, action, q, n, base_q, base_n] into the stored weights
+        """
+        if not cells:
+            return
+        keys = [(_encode_state(c[0]), c[1]) for c in cells]
+        q, n, base_q, base_n = (
+            np.array([c[i] for c in cells], dtype=np.float64) for i in range(2, 6)
+        )
+
+        with self._lock, self._db:
+            stored = {}
+            for state, action in keys:
+                row = self._db.execute(
+                    "SELECT q, n FROM weights WHERE state = ? AND action = ?",
+                    (state, action),
+                ).fetchone()
+                if row is not None:
+                    stored[(state, action)] = row
+            # a cell the server has never seen is treated as holding the agent's base
+            stored_q = np.array(
+                [
+                    stored.get(key, (bq, bn))[0]
+                    for key, bq, bn in zip(keys, base_q, base_n)
+                ]
+            )
+            stored_n = np.array(
+                [
+                    stored.get(key, (bq, bn))[1]
+                    for key, bq, bn in zip(keys, base_q, base_n)
+                ]
+            )
+
+            if self._alpha is None:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    merged_q, merged_n = update_average(
+                        base_q, base_n, stored_q, stored_n, q, n
+                    )
+                # cells which nobody has tried yet, keep the agent's initial value
+                merged_q = np.where(merged_n > 0, merged_q, q)
+            else:
+                merged_q, merged_n = update_recency_weighted_average(
+                    base_q, base_n, stored_q, stored_n, q, n, self._alpha
+                )
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO weights (state, action, q, n) VALUES (?, ?, ?, ?)",
+                [
+                    (state, action, float(mq), int(mn))
+                    for (state, action), mq, mn in zip(keys, merged_q, merged_n)
+                ],
+            )
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store: WeightStore = self.server.weight_store
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request["op"] == "push":
+                    store.push(request["cells"])
+                elif request["op"] != "pull":
+                    raise ValueError(f"unknown op {request['op']}")
+                response: Dict[str, Any] = {"cells": store.cells()}
+            except Exception as e:
+                log.exception("failed to handle request")
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class WeightAggregationServer:
+    """
+    Serves a WeightStore over TCP (address is a (host, port) tuple) or a unix socket (address is a path)
+
+    :param alpha: merge pushes with update_recency_weighted_average using this alpha.  If None, use update_average
+    """
+
+    def __init__(self, db_path: str, address: Address, alpha: Optional[float] = None):
+        self.weight_store = WeightStore(db_path, alpha)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = _UnixServer(address, _Handler)
+        else:
+            self._server = _TCPServer(address, _Handler)
+        self._server.weight_store = self.weight_store
+
+    @property
+    def server_address(self) -> Address:
+        return self._server.server_address
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self) -> threading.Thread:
+        """
+        serve on a daemon thread
+        """
+        thread = threading.Thread(
+            target=self.serve_forever, name="rlretry-aggregation", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class AggregationClient:
+    """
+    A weight_loader / weight_dumper pair which share weights through a WeightAggregationServer.
+
+    dump() pushes the cells which changed since the last dump and returns the merged weights,
+    which the agent then takes on.  If the server cannot be reached, a warning is logged and the agent carries on
+    with its own weights.  The cells are pushed with the next dump instead.
+    """
+
+    def __init__(self, address: Address, timeout: float = 5.0):
+        self._address = address
+        self._timeout = timeout
+        # the base of a push which failed, so that the next push includes its cells
+        self._unpushed_base: Optional[Tuple[pd.DataFrame, pd.DataFrame]] = None
+
+    def _request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        family = socket.AF_UNIX if isinstance(self._address, str) else socket.AF_INET
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self._timeout)
+            sock.connect(self._address)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+        if "error" in response:
+            raise RuntimeError(f"aggregation server error: {response['error']}")
+        return response
+
+    def load(self) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+        try:
+            return _cells_to_table(self._request({"op": "pull"})["cells"])
+        except (OSError, RuntimeError, ValueError) as e:
+            log.warning(f"could not load weights from {self._address}: {e}")
+            return None, None
+
+    def dump(
+        self,
+        df: pd.DataFrame,
+        counts_df: pd.DataFrame,
+        previous_df: pd.DataFrame,
+        previous_counts_df: pd.DataFrame,
+    ) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+        if self._unpushed_base is not None:
+            previous_df, previous_counts_df = self._unpushed_base
+        base_q = previous_df.reindex(index=df.index, columns=df.columns)
+        base_n = previous_counts_df.reindex(index=df.index, columns=df.columns)
+        changed = (base_n.isna() | (base_n != counts_df)).to_numpy()
+        base_q = base_q.to_numpy(dtype=np.float64, na_value=np.nan)
+        base_n = base_n.to_numpy(dtype=np.float64, na_value=np.nan)
+        q = df.to_numpy(dtype=np.float64)
+        n = counts_df.to_numpy(dtype=np.float64)
+
+        cells = []
+        for row, col in zip(*np.nonzero(changed)):
+            new_cell = np.isnan(base_n[row, col])
+            cells.append(
+                [
+                    df.index[row],
+                    _encode_action(df.columns[col]),
+                    q[row, col],
+                    int(n[row, col]),
+                    q[row, col] if new_cell else base_q[row, col],
+                    0 if new_cell else int(base_n[row, col]),
+                ]
+            )
+        try:
+            merged = _cells_to_table(
+                self._request({"op": "push", "cells": cells})["cells"]
+            )
+        except (OSError, RuntimeError, ValueError) as e:
+            log.warning(f"could not push weights to {self._address}: {e}")
+            if self._unpushed_base is None:
+                self._unpushed_base = (previous_df, previous_counts_df)
+            return None
+        self._unpushed_base = None
+        if merged[0] is None:
+            # nothing pushed and nothing on the server yet, so there is nothing to take on
+            return None
+        return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve merged rlretry weights")
+    parser.add_argument("--db", required=True, help="path of the SQLite database")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7788)
+    parser.add_argument("--unix", help="listen on this unix socket instead of TCP")
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=None,
+        help="merge with a recency weighted average using this alpha (default: plain average)",
+    )
+    args = parser.parse_args()
+
+    address = args.unix if args.unix else (args.host, args.port)
+    server = WeightAggregationServer(args.db, address, alpha=args.alpha)
+    print(f"serving weights from {args.db} on {server.server_address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
-from collections import defaultdict
+import asyncio
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
+import inspect
 import random
-import time
-from typing import Callable, Dict, Optional
+import threading
+from typing import Awaitable, Callable, Deque, Dict, NamedTuple, Optional
+
+from .clock import SYSTEM_CLOCK, Clock
+from .rlretry import log
 
 
 def default_success_func(e: Exception) -> bool:
@@ -35,108 +40,567 @@ def get_epsilon_greedy_interval(
     return get_optimum_interval(average_rewards)
 
 
-def auto_request_interval(
-    maximum: timedelta,
-    minimum: timedelta = timedelta(seconds=0),
-    time_increment: timedelta = timedelta(seconds=1),
-    success_func: Callable[[Exception], bool] = default_success_func,
-    alpha: float = 0.05,
-    epsilon: float = 0.05,
-):
+class IntervalLearner:
     """
-    A decorator that adjusts the query interval to find the optimum rate to repeat a function.
-    seeks to minimize the average interval between successful queries (ie queries which do not raise an exception)
+    The learning state behind auto_request_interval.
+
+    Keeps an average reward for every interval on the grid (minimum to maximum in steps of time_increment)
+    and picks the interval to wait between requests using get_epsilon_greedy_interval
     """
 
-    if minimum % time_increment != timedelta(seconds=0):
-        raise ValueError("minimum must be a multiple of time_increment")
+    def __init__(
+        self,
+        maximum: timedelta,
+        minimum: timedelta = timedelta(seconds=0),
+        time_increment: timedelta = timedelta(seconds=1),
+        alpha: float = 0.05,
+        epsilon: float = 0.05,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        if minimum % time_increment != timedelta(seconds=0):
+            raise ValueError("minimum must be a multiple of time_increment")
+
+        if maximum % time_increment != timedelta(seconds=0):
+            raise ValueError("maximum must be a multiple of time_increment")
+
+        if maximum <= minimum:
+            raise ValueError("maximum must be greater than minimum")
 
-    if maximum % time_increment != timedelta(seconds=0):
-        raise ValueError("maximum must be a multiple of time_increment")
+        self.maximum = maximum
+        self.minimum = minimum
+        self.time_increment = time_increment
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.clock = clock
 
-    if maximum <= minimum:
-        raise ValueError("maximum must be greater than minimum")
+        self.average_rewards: Dict[timedelta, float] = defaultdict(float)
+        self.current_interval = minimum
+        self.last_success_time: Optional[datetime] = None
+        self.subsequent_failed_requests = 0
 
-    def cropping_func(value: timedelta) -> timedelta:
-        if value < minimum:
-            return minimum
-        if maximum is not None and value > maximum:
-            return maximum
+    def cropping_func(self, value: timedelta) -> timedelta:
+        if value < self.minimum:
+            return self.minimum
+        if self.maximum is not None and value > self.maximum:
+            return self.maximum
         return value
 
-    def decorator_no_args(func: Callable):
-        average_rewards = defaultdict(float)
-        current_interval = minimum
-        last_success_time = None
-        last_request_time = None
-        subsequent_failed_requests = 0
-        n = 0
+    def record_request(self) -> datetime:
+        request_time = self.clock.now()
+        if self.last_success_time is None:
+            self.last_success_time = request_time
+        return request_time
 
-        def wrapper(*args, **kwargs):
-            nonlocal last_request_time, last_success_time, average_rewards, alpha, subsequent_failed_requests, time_increment, current_interval, epsilon, n
+    def record_result(
+        self,
+        is_success: bool,
+        request_time: datetime,
+        interval: Optional[timedelta] = None,
+    ):
+        """
+        update the rewards with the outcome of the request sent at request_time and choose the next interval
 
-            last_success_time = (
-                datetime.utcnow() if last_success_time is None else last_success_time
-            )
-            last_request_time = (
-                datetime.utcnow() if last_request_time is None else last_request_time
+        :param interval: the interval the request was paced at.  Default: the current interval
+        """
+        if interval is None:
+            interval = self.current_interval
+        now = self.clock.now()
+        alpha = self.alpha
+        # update rewards
+        if is_success:
+            success_interval_seconds = (now - self.last_success_time).total_seconds()
+            reward = -success_interval_seconds
+            average_reward_delta = (reward - self.average_rewards[interval]) * alpha
+            self.average_rewards[interval] += average_reward_delta
+            self.last_success_time = self.clock.now()
+            self.subsequent_failed_requests = 0
+        else:
+            fail_interval_seconds = (now - request_time).total_seconds()
+            # this is just an adjustment to the reward so that we punish multiple failures
+            self.average_rewards[interval] -= fail_interval_seconds * alpha
+            self.subsequent_failed_requests += 1
+
+        # now choose a new interval if required
+        if is_success or self.subsequent_failed_requests:
+            new_interval = get_epsilon_greedy_interval(
+                self.average_rewards,
+                self.time_increment,
+                self.minimum,
+                self.maximum,
+                self.epsilon,
             )
+            # force a change of interval if we had 10 successive failures
+            if not is_success and new_interval == self.current_interval:
+                new_interval = self.current_interval + self.time_increment
+                if new_interval > self.maximum:
+                    new_interval = self.maximum
+
+            self.current_interval = new_interval
+
+
+class BisectionIntervalLearner:
+    """
+    An alternative to IntervalLearner which searches for the interval continuously, rather than on a grid.
+
+    Keeps a bracket: the shortest interval which sustained patience successes in a row, and the longest which failed.
+    Each probe tries the middle of the bracket for patience requests, and the search settles on the sustained end
+    once the bracket is narrower than resolution.  A rate limiter usually lets a few requests through above its
+    limit, so an interval is only trusted once it has sustained a whole run.
+
+    After a failure it backs off to the sustained interval (or backoff times it, if that was what failed) until it
+    sustains a run again.  The failing end of the bracket is relaxed by drift after every run at the sustained end,
+    so it keeps re-probing slowly in case the limit loosens
+    """
+
+    def __init__(
+        self,
+        maximum: timedelta,
+        minimum: timedelta = timedelta(seconds=0),
+        resolution: timedelta = timedelta(milliseconds=10),
+        patience: int = 50,
+        backoff: float = 1.5,
+        drift: float = 0.002,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        """
+        :param resolution: stop bisecting once the bracket is narrower than this
+        :param patience: how many successes in a row it takes to trust an interval
+        :param backoff: how much to lengthen the interval by when the trusted one fails
+        :param drift: the fraction the failing end of the bracket is shortened by after each run at the trusted end
+        """
+        if maximum <= minimum:
+            raise ValueError("maximum must be greater than minimum")
+        if resolution <= timedelta(seconds=0):
+            raise ValueError("resolution must be positive")
+        if patience < 1:
+            raise ValueError("patience must be at least 1")
+        if backoff <= 1:
+            raise ValueError("backoff must be greater than 1")
+
+        self.maximum = maximum
+        self.minimum = minimum
+        self.resolution = resolution.total_seconds()
+        self.patience = patience
+        self.backoff = backoff
+        self.drift = drift
+        self.clock = clock
+
+        # in seconds.  The longest interval known to fail and the shortest known to sustain a run
+        self.lower = minimum.total_seconds()
+        self.upper = maximum.total_seconds()
+        self._interval = self.upper
+        self.current_interval = maximum
+        self.recovering = False
+        self._run = 0
+        # results of requests sent before this were sent at an earlier interval, and are ignored
+        self._interval_since: Optional[datetime] = None
+
+    def cropping_func(self, value: timedelta) -> timedelta:
+        if value < self.minimum:
+            return self.minimum
+        if value > self.maximum:
+            return self.maximum
+        return value
+
+    def record_request(self) -> datetime:
+        return self.clock.now()
+
+    def _set_interval(self, seconds: float):
+        self._interval = min(
+            max(seconds, self.minimum.total_seconds()), self.maximum.total_seconds()
+        )
+        self.current_interval = timedelta(seconds=self._interval)
+        self._interval_since = self.clock.now()
+        self._run = 0
+
+    def record_result(
+        self,
+        is_success: bool,
+        request_time: datetime,
+        interval: Optional[timedelta] = None,
+    ):
+        """
+        update the bracket with the outcome of the request sent at request_time and choose the next interval
+
+        :param interval: the interval the request was paced at.  Only taken for the same signature as IntervalLearner,
+            results from before the interval changed are recognised by their request_time
+        """
+        if self._interval_since is not None and request_time < self._interval_since:
+            return
+
+        if is_success:
+            self._run += 1
+            if self._run < self.patience:
+                return
+            if self.recovering:
+                self.recovering = False
+                self.upper = max(self.upper, self._interval)
+            elif self._interval < self.upper:
+                self.upper = self._interval
+            else:
+                self.lower = max(
+                    self.lower * (1 - self.drift), self.minimum.total_seconds()
+                )
+            if self.upper - self.lower > self.resolution:
+                self._set_interval((self.lower + self.upper) / 2)
+            else:
+                self._set_interval(self.upper)
+        elif self.recovering:
+            self._set_interval(self._interval * self.backoff)
+        else:
+            self.recovering = True
+            if self._interval < self.upper:
+                self.lower = self._interval
+                self._set_interval(self.upper)
+            else:
+                # the limit has tightened, find a new interval which sustains a run
+                self.lower = self.upper
+                self._set_interval(self.upper * self.backoff)
+
+
+INTERVAL_CONTROLLERS = ("grid", "bisection")
+
+
+def make_interval_learner(
+    controller: str,
+    maximum: timedelta,
+    minimum: timedelta,
+    time_increment: timedelta,
+    alpha: float,
+    epsilon: float,
+    clock: Clock = SYSTEM_CLOCK,
+    resolution: timedelta = timedelta(milliseconds=10),
+):
+    """
+    "grid" learns an average reward for every multiple of time_increment between minimum and maximum (IntervalLearner),
+    "bisection" searches between them down to resolution (BisectionIntervalLearner).  Each ignores the other's argument
+    """
+    if controller == "grid":
+        return IntervalLearner(maximum, minimum, time_increment, alpha, epsilon, clock)
+    if controller == "bisection":
+        return BisectionIntervalLearner(
+            maximum, minimum, resolution=resolution, clock=clock
+        )
+    raise ValueError(f"controller must be one of {INTERVAL_CONTROLLERS}")
+
+
+class TokenBucket:
+    """
+    Tokens accrue at one per interval, up to burst of them.  Each request takes one.
+
+    With a burst of 1 requests are spaced at least interval apart.  A larger burst lets requests which were
+    held back (eg. while the callers were idle) go out back to back, while keeping the same average rate.
+    Not thread safe, the schedulers only let one caller at a time take from it.
+    """
+
+    def __init__(self, burst: int = 1, clock: Clock = SYSTEM_CLOCK):
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.burst = burst
+        self.tokens = float(burst)
+        self._monotonic = clock.monotonic
+        self._last_refill: Optional[float] = None
 
-            # wait until it is time to query
-            sleep_duration = cropping_func(current_interval) - (
-                datetime.utcnow() - last_request_time
+    def take(self, interval: timedelta) -> float:
+        """
+        take a token and return 0, or if there isn't one, return the seconds until there will be
+        """
+        now = self._monotonic()
+        seconds = interval.total_seconds()
+        if seconds <= 0:
+            self.tokens = float(self.burst)
+        elif self._last_refill is not None:
+            self.tokens = min(
+                float(self.burst), self.tokens + (now - self._last_refill) / seconds
             )
+        self._last_refill = now
+
+        # allow for rounding, or a sleep for the missing sliver may not move the clock at all
+        if self.tokens >= 1 - 1e-9:
+            self.tokens = max(0.0, self.tokens - 1)
+            return 0.0
+        return (1 - self.tokens) * seconds
+
+
+class Slot(NamedTuple):
+    """
+    a send slot handed out by acquire(), to be passed back to report()
+    """
 
-            print(f'waiting for {sleep_duration}')
+    time: datetime
+    # the interval the request was paced at, which its result is credited to
+    interval: timedelta
 
-            time.sleep(max(0, sleep_duration.total_seconds()))
 
-            if n % 5 == 0:
-                print('average rewards')
-                for interval in sorted(average_rewards.keys()):
-                    print (f'    {interval}: {average_rewards[interval]}')
-            n += 1
+class RequestScheduler:
+    """
+    Hands out send slots to any number of threads at the interval learned by an IntervalLearner.
+
+    Threads call acquire() to wait for the next slot, make their request and then report() whether it succeeded.
+    Slots are handed out in the order acquire() was called: only the thread at the head of the queue sleeps
+    (until the token bucket has a token), then it wakes the next one.  Calling the scheduler on a function wraps it
+    so that this happens automatically.
+    """
+
+    def __init__(
+        self,
+        maximum: timedelta,
+        minimum: timedelta = timedelta(seconds=0),
+        time_increment: timedelta = timedelta(seconds=1),
+        success_func: Callable[[Exception], bool] = default_success_func,
+        alpha: float = 0.05,
+        epsilon: float = 0.05,
+        clock: Clock = SYSTEM_CLOCK,
+        metrics=None,
+        burst: int = 1,
+        controller: str = "grid",
+        resolution: timedelta = timedelta(milliseconds=10),
+    ):
+        """
+        :param metrics: record the requests, their waits and the current interval in a PacingMetrics (see metrics.py)
+        :param burst: how many requests may go out back to back after an idle period, see TokenBucket
+        :param controller: how the interval is learned, see make_interval_learner
+        :param resolution: how finely the "bisection" controller searches
+        """
+        self.learner = make_interval_learner(
+            controller,
+            maximum,
+            minimum,
+            time_increment,
+            alpha,
+            epsilon,
+            clock,
+            resolution,
+        )
+        self._bucket = TokenBucket(burst, clock)
+        self._success_func = success_func
+        self._metrics = metrics
+        self._clock = clock
+        # guards the learner, the bucket and the queue
+        self._lock = threading.Lock()
+        # the threads waiting behind the head of the queue, each is woken by the one in front of it
+        self._waiters: Deque[threading.Event] = deque()
+        self._head_taken = False
+
+    @property
+    def current_interval(self) -> timedelta:
+        return self.learner.current_interval
+
+    def acquire(self) -> Slot:
+        """
+        wait for the next send slot, which should be passed to report()
+        """
+        start = self._clock.monotonic()
+        with self._lock:
+            if self._head_taken:
+                turn = threading.Event()
+                self._waiters.append(turn)
+            else:
+                self._head_taken = True
+                turn = None
+        if turn is not None:
+            turn.wait()
 
-            last_request_time = datetime.utcnow()
+        try:
+            while True:
+                with self._lock:
+                    interval = self.learner.current_interval
+                    sleep_seconds = self._bucket.take(
+                        self.learner.cropping_func(interval)
+                    )
+                    if sleep_seconds <= 0:
+                        slot = Slot(self.learner.record_request(), interval)
+                        break
+                # the interval may change while we sleep, so check again afterwards
+                self._clock.sleep(sleep_seconds)
+        finally:
+            with self._lock:
+                if self._waiters:
+                    self._waiters.popleft().set()
+                else:
+                    self._head_taken = False
 
+        if self._metrics is not None:
+            self._metrics.record_wait(self._clock.monotonic() - start)
+        return slot
+
+    def report(self, is_success: bool, slot: Slot):
+        with self._lock:
+            self.learner.record_result(is_success, slot.time, slot.interval)
+            current_interval = self.learner.current_interval
+        if self._metrics is not None:
+            self._metrics.record_result(is_success, current_interval)
+        log.debug(f"updated current_interval to {current_interval}")
+
+    def __call__(self, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            slot = self.acquire()
             is_success = False
             try:
-                func(*args, **kwargs)
+                retval = func(*args, **kwargs)
                 is_success = True
+                return retval
             except Exception as e:
-                is_success = success_func(e)
-
-            now = datetime.utcnow()
-            # update rewards
-            if is_success:
-                success_interval_seconds = (now - last_success_time).total_seconds()
-                reward = -success_interval_seconds
-                average_reward_delta = (
-                    reward - average_rewards[current_interval]
-                ) * alpha
-                average_rewards[current_interval] += average_reward_delta
-                last_success_time = datetime.utcnow()
-                subsequent_failed_requests = 0
-            else:
-                fail_interval_seconds = (now - last_request_time).total_seconds()
-                # this is just an adjustment to the reward so that we punish multiple failures
-                average_rewards[current_interval] -= fail_interval_seconds * alpha
-                subsequent_failed_requests += 1
-
-            # now choose a new interval if required
-            if is_success or subsequent_failed_requests:
-                new_interval = get_epsilon_greedy_interval(
-                    average_rewards, time_increment, minimum, maximum, epsilon
-                )
-                # force a change of interval if we had 10 successive failures
-                if not is_success and new_interval == current_interval:
-                    new_interval = current_interval + time_increment
-                    if new_interval > maximum:
-                        new_interval = maximum
+                is_success = self._success_func(e)
+                raise
+            finally:
+                self.report(is_success, slot)
+
+        return wrapper
+
+
+class AsyncRequestPacer:
+    """
+    Paces requests from any number of coroutines at the interval learned by an IntervalLearner.
+
+    Coroutines await acquire() to be handed the next send slot (in FIFO order), make their request
+    and then report() whether it succeeded.  Calling the pacer on a coroutine function wraps it so that
+    this happens automatically.
+    """
+
+    def __init__(
+        self,
+        maximum: timedelta,
+        minimum: timedelta = timedelta(seconds=0),
+        time_increment: timedelta = timedelta(seconds=1),
+        success_func: Callable[[Exception], bool] = default_success_func,
+        alpha: float = 0.05,
+        epsilon: float = 0.05,
+        clock: Clock = SYSTEM_CLOCK,
+        metrics=None,
+        burst: int = 1,
+        controller: str = "grid",
+        resolution: timedelta = timedelta(milliseconds=10),
+    ):
+        """
+        :param metrics: record the requests, their waits and the current interval in a PacingMetrics (see metrics.py)
+        :param burst: how many requests may go out back to back after an idle period, see TokenBucket
+        :param controller: how the interval is learned, see make_interval_learner
+        :param resolution: how finely the "bisection" controller searches
+        """
+        self.learner = make_interval_learner(
+            controller,
+            maximum,
+            minimum,
+            time_increment,
+            alpha,
+            epsilon,
+            clock,
+            resolution,
+        )
+        self._bucket = TokenBucket(burst, clock)
+        self._clock = clock
+        self._success_func = success_func
+        self._metrics = metrics
+        # created lazily so that the pacer can be constructed outside of a running event loop
+        self._lock: Optional[asyncio.Lock] = None
 
-                current_interval = new_interval
-                print(f'updated current_interval to {current_interval}')
+    @property
+    def current_interval(self) -> timedelta:
+        return self.learner.current_interval
+
+    async def acquire(self) -> Slot:
+        """
+        wait for the next send slot, which should be passed to report()
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # asyncio.Lock wakes waiters in FIFO order, so slots are handed out in the order they were requested
+        async with self._lock:
+            start = self._clock.monotonic()
+            while True:
+                interval = self.learner.current_interval
+                sleep_seconds = self._bucket.take(self.learner.cropping_func(interval))
+                if sleep_seconds <= 0:
+                    break
+                await asyncio.sleep(sleep_seconds)
+            if self._metrics is not None:
+                self._metrics.record_wait(self._clock.monotonic() - start)
+            return Slot(self.learner.record_request(), interval)
+
+    def report(self, is_success: bool, slot: Slot):
+        self.learner.record_result(is_success, slot.time, slot.interval)
+        if self._metrics is not None:
+            self._metrics.record_result(is_success, self.learner.current_interval)
+
+    def __call__(self, func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        async def wrapper(*args, **kwargs):
+            slot = await self.acquire()
+            is_success = False
+            try:
+                retval = await func(*args, **kwargs)
+                is_success = True
+                return retval
+            except Exception as e:
+                is_success = self._success_func(e)
+                raise
+            finally:
+                self.report(is_success, slot)
 
         return wrapper
 
+
+def auto_request_interval(
+    maximum: timedelta,
+    minimum: timedelta = timedelta(seconds=0),
+    time_increment: timedelta = timedelta(seconds=1),
+    success_func: Callable[[Exception], bool] = default_success_func,
+    alpha: float = 0.05,
+    epsilon: float = 0.05,
+    clock: Clock = SYSTEM_CLOCK,
+    metrics=None,
+    burst: int = 1,
+    controller: str = "grid",
+    resolution: timedelta = timedelta(milliseconds=10),
+):
+    """
+    A decorator that adjusts the query interval to find the optimum rate to repeat a function.
+    seeks to minimize the average interval between successful queries (ie queries which do not raise an exception)
+
+    Calls are paced by a RequestScheduler, so any number of threads share the learned interval and are sent
+    in the order they arrived.  If the decorated function is a coroutine function, calls are paced by an AsyncRequestPacer
+    so that any number of concurrent coroutines share the learned interval.
+    Either way, the decorated function returns what the function returned and raises what it raised.
+    success_func only decides whether an exception counts as a success when learning the interval.
+
+    Pass a VirtualClock as clock to run in simulated time (see simulation.py)
+    Pass a PacingMetrics as metrics to count the requests and export the current interval (see metrics.py)
+    :param burst: how many requests may go out back to back after an idle period, see TokenBucket
+    :param controller: "grid" (the default) learns an average reward for every multiple of time_increment.
+        "bisection" searches for the interval continuously (see BisectionIntervalLearner), stopping at resolution,
+        and ignores time_increment, so minimum and maximum needn't be multiples of it.  It converges with far fewer
+        failed requests, see benchmarks/compare_interval_controllers.py
+    :param resolution: how finely the "bisection" controller searches.  Unused by "grid"
+    """
+
+    # validate the arguments up front rather than when the decorator is applied
+    make_interval_learner(
+        controller,
+        maximum,
+        minimum,
+        time_increment,
+        alpha,
+        epsilon,
+        resolution=resolution,
+    )
+    TokenBucket(burst)
+
+    def decorator_no_args(func: Callable):
+        pacer = (
+            AsyncRequestPacer if inspect.iscoroutinefunction(func) else RequestScheduler
+        )
+        return pacer(
+            maximum,
+            minimum,
+            time_increment,
+            success_func,
+            alpha,
+            epsilon,
+            clock,
+            metrics,
+            burst,
+            controller,
+            resolution,
+        )(func)
+
     return decorator_no_args
@@ -0,0 +1,244 @@
+"""
+A StateActionMap which keeps at most max_states states, for state_funcs with unbounded cardinality
+(eg. states which include an endpoint, a tenant or an error message).
+
+    @rlretry(state_func=lambda e: f"{e.__class__.__name__}:{e.url}", max_states=1000, state_ttl=timedelta(hours=1),
+             fold_evicted_into="default")
+    def fetch(url): ...
+
+When a new state arrives and the table is full, the least recently used state is evicted to make room.
+States which haven't been used for state_ttl are evicted too.  If fold_evicted_into is given, each evicted state's
+averages and counts are added into that state rather than discarded, so what was learned from rare states isn't lost.
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from datetime import timedelta
+import threading
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .clock import SYSTEM_CLOCK, Clock
+from .rlretry import Action, StateActionMap, log
+
+
+class BoundedStateActionMap(StateActionMap):
+    """
+    A StateActionMap with LRU and/or TTL eviction.
+
+    Using a state (choosing an action in it or rewarding it) marks it as used.  The states are kept in the order they
+    were last used, so finding the one to evict doesn't depend on max_states.  An evicted state's row is either
+    handed to the new state, or (when it expires) filled with the last row so that rows stay contiguous.  A reader
+    which looked a state up just before its row moved may choose from the wrong row once, which is harmless.
+    Snapshots and evictions take a lock, so a dump on another thread never pairs a state with a row which moved.
+
+    The fold_evicted_into state is never evicted, and counts towards max_states.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        counts_df: pd.DataFrame,
+        initial_value: float = 0.0,
+        alpha: Union[float, None, Callable[[int], float]] = 0.0,
+        keep_last_saved: bool = True,
+        actions: Optional[Sequence] = None,
+        max_states: Optional[int] = None,
+        ttl: Optional[timedelta] = None,
+        fold_evicted_into: Optional[str] = None,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        """
+        :param max_states: the most states to keep.  None for no limit
+        :param ttl: evict states which haven't been used for this long.  None to keep them until they are the least recently used
+        :param fold_evicted_into: add the averages and counts of evicted states into this state
+        :param clock: where the time the states were last used comes from
+        """
+        if max_states is not None and max_states < (2 if fold_evicted_into else 1):
+            raise ValueError("max_states is too small")
+        self._max_states = max_states
+        self._ttl = None if ttl is None else ttl.total_seconds()
+        self._fold_into = fold_evicted_into
+        self._monotonic = clock.monotonic
+        self._next_expiry = float("-inf")
+        self._thread_lock = threading.RLock()
+        super().__init__(df, counts_df, initial_value, alpha, keep_last_saved, actions)
+
+    def _load(self, df: Optional[pd.DataFrame], counts_df: Optional[pd.DataFrame]):
+        super()._load(df, counts_df)
+        # loaded states count as just used
+        self._last_used = np.full(self._q.shape[0], self._monotonic())
+        if self._fold_into is not None and self._fold_into not in self._rows:
+            super().create_state(self._fold_into)
+        # the evictable states, least recently used first
+        self._lru = OrderedDict(
+            (state, None) for state in self._states if state != self._fold_into
+        )
+
+        excess = len(self._states) - (self._max_states or len(self._states))
+        if excess > 0:
+            # keep the states which have been tried the most
+            tries = self._counts[: len(self._states)].sum(axis=1)
+            rows = [
+                row for row in np.argsort(tries, kind="stable") if self._evictable(row)
+            ]
+            self._remove_rows(rows[:excess])
+        self._schedule_expiry(self._monotonic())
+
+    def _grow(self):
+        super()._grow()
+        last_used = np.zeros(self._q.shape[0])
+        last_used[: len(self._states)] = self._last_used[: len(self._states)]
+        self._last_used = last_used
+
+    def _evictable(self, row) -> bool:
+        return self._states[row] != self._fold_into
+
+    def _row(self, state) -> Optional[int]:
+        row = self._rows.get(state)
+        if row is not None:
+            self._last_used[row] = self._monotonic()
+            if state != self._fold_into:
+                try:
+                    self._lru.move_to_end(state)
+                except KeyError:
+                    # evicted by another thread since we looked it up
+                    pass
+        return row
+
+    def _fold(self, row: int):
+        """
+        add row's averages and counts into the fold_evicted_into state
+        """
+        if self._fold_into is None:
+            return
+        target = self._rows[self._fold_into]
+        counts = self._counts[row]
+        total = self._counts[target] + counts
+        tried = counts > 0
+        self._q[target, tried] = (
+            self._q[target, tried] * self._counts[target, tried]
+            + self._q[row, tried] * counts[tried]
+        ) / total[tried]
+        self._counts[target] = total
+        self._dirty[target, tried] = True
+        self._refresh_rows(np.array([target]))
+
+    def create_state(self, state: str) -> int:
+        now = self._monotonic()
+        if (
+            self._max_states is None
+            or state in self._rows
+            or len(self._states) < self._max_states
+        ):
+            row = super().create_state(state)
+            self._last_used[row] = now
+            if state != self._fold_into:
+                self._lru[state] = None
+                self._lru.move_to_end(state)
+            return row
+
+        with self._thread_lock:
+            evicted, _ = self._lru.popitem(last=False)
+            row = self._rows[evicted]
+            log.debug(f"evicting state {evicted} to make room for {state}")
+            self._fold(row)
+            del self._rows[evicted]
+
+            self._q[row, 0] = 1.0
+            self._q[row, 1:] = float(self._initial_value)
+            self._counts[row] = 0
+            self._dirty[row] = True
+            self._refresh_rows(np.array([row]))
+            self._last_used[row] = now
+            self._states[row] = state
+            self._rows[state] = row
+            self._lru[state] = None
+        return row
+
+    def _remove_rows(self, rows: Sequence[int]):
+        """
+        evict rows, moving the last rows into their place
+        """
+        with self._thread_lock:
+            for row in sorted(rows, reverse=True):
+                evicted = self._states[row]
+                self._fold(row)
+                del self._rows[evicted]
+                self._lru.pop(evicted, None)
+                last = len(self._states) - 1
+                if row != last:
+                    for array in (
+                        self._q,
+                        self._counts,
+                        self._dirty,
+                        self._greedy,
+                        self._cum_weights,
+                        self._last_used,
+                    ):
+                        array[row] = array[last]
+                    moved = self._states[last]
+                    self._states[row] = moved
+                    self._rows[moved] = row
+                self._states.pop()
+        if len(rows):
+            log.debug(f"evicted {len(rows)} states")
+
+    def _schedule_expiry(self, now: float):
+        if self._ttl is None:
+            self._next_expiry = float("inf")
+            return
+        # nothing can expire before the least recently used state does
+        oldest = now
+        if self._lru:
+            oldest = self._last_used[self._rows[next(iter(self._lru))]]
+        self._next_expiry = oldest + self._ttl
+
+    def expire(self, now: Optional[float] = None):
+        """
+        evict the states which haven't been used for ttl
+        """
+        if self._ttl is None:
+            return
+        now = self._monotonic() if now is None else now
+        # the states are in the order they were used, so stop at the first which hasn't expired
+        while self._lru:
+            row = self._rows[next(iter(self._lru))]
+            if self._last_used[row] > now - self._ttl:
+                break
+            self._remove_rows([row])
+        self._schedule_expiry(now)
+
+    def snapshot(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        with self._thread_lock:
+            return super().snapshot()
+
+    def pop_changes(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        with self._thread_lock:
+            return super().pop_changes()
+
+    def update_average_reward(self, state: str, action: Action, new_reward: float):
+        if self._ttl is not None:
+            now = self._monotonic()
+            if now >= self._next_expiry:
+                self.expire(now)
+        super().update_average_reward(state, action, new_reward)
+
+    def set_cells(self, df: pd.DataFrame, counts_df: pd.DataFrame):
+        """
+        as StateActionMap.set_cells, but states which aren't in the table are only added while there is room,
+        rather than evicting states this process is using to make room for ones another process has seen
+        """
+        if self._max_states is not None:
+            room = self._max_states - len(self._states)
+            keep = []
+            for state in df.index:
+                if state in self._rows:
+                    keep.append(True)
+                else:
+                    keep.append(room > 0)
+                    room -= 1
+            df = df[keep]
+        super().set_cells(df, counts_df)
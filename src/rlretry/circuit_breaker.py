@@ -0,0 +1,158 @@
+"""
+A circuit breaker for an rlretry decorated function, which opens when the agent has learned that retrying is hopeless.
+
+    breaker = CircuitBreaker(cooldown=timedelta(seconds=10))
+
+    @rlretry(circuit_breaker=breaker)
+    def fetch(url): ...
+
+While the breaker is closed, calls go through as normal.  It opens when a call is aborted in a state where ABRT is
+the agent's preferred action by at least abort_margin (and the state has been tried at least min_samples times),
+while the recent failure rate is at least failure_rate.  While it is open, calls raise RLRetryCircuitOpen without
+calling the function.  After the cool-down, one call is let through as a probe (half-open): if it succeeds the breaker
+closes, if it fails it opens again.  If the probe ends without a result (eg. it is cancelled), the next call probes.
+
+The cool-down is learned from the outages: it doubles every time a probe fails (up to max_cooldown)
+and halves every time one succeeds (down to min_cooldown).
+
+Every caller of the decorated function (threads and coroutines) shares the breaker.
+"""
+
+from __future__ import annotations
+from datetime import timedelta
+import threading
+from typing import Optional
+
+from .clock import SYSTEM_CLOCK, Clock
+from .rlretry import log
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        abort_margin: float = 0.0,
+        min_samples: int = 20,
+        window: int = 20,
+        cooldown: timedelta = timedelta(seconds=10),
+        min_cooldown: timedelta = timedelta(seconds=1),
+        max_cooldown: timedelta = timedelta(minutes=10),
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        """
+        :param failure_rate: only open when at least this fraction of recent calls failed
+        :param abort_margin: only open when ABRT's average reward beats the best retry's by at least this much.
+            A retry which succeeds earns at least 1.5 more than ABRT, so even a small margin means retries rarely succeed
+        :param min_samples: only open on states which have been tried at least this many times
+        :param window: the failure rate is an exponentially weighted average over roughly this many calls
+        :param cooldown: how long to stay open before the first probe
+        """
+        self._failure_rate_threshold = failure_rate
+        self._abort_margin = abort_margin
+        self._min_samples = min_samples
+        self._weight = 1 / window
+        self._cooldown = cooldown.total_seconds()
+        self._min_cooldown = min_cooldown.total_seconds()
+        self._max_cooldown = max_cooldown.total_seconds()
+        self._monotonic = clock.monotonic
+        self._lock = threading.Lock()
+
+        self.state = CircuitBreaker.CLOSED
+        self.failure_rate = 0.0
+        self._open_until = 0.0
+        # the exception and state which opened the breaker
+        self.last_exception: Optional[Exception] = None
+        self.tripped_state = None
+
+    @property
+    def cooldown(self) -> timedelta:
+        return timedelta(seconds=self._cooldown)
+
+    def retry_in(self) -> float:
+        """
+        the seconds until the next probe is let through
+        """
+        return max(0.0, self._open_until - self._monotonic())
+
+    def allow(self) -> bool:
+        """
+        whether a call may go ahead.  The first caller after the cool-down is the probe
+        """
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        with self._lock:
+            if (
+                self.state == CircuitBreaker.OPEN
+                and self._monotonic() >= self._open_until
+            ):
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        # not locked, a lost update only nudges the average
+        self.failure_rate -= self.failure_rate * self._weight
+        if self.state == CircuitBreaker.CLOSED:
+            return
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self._cooldown = max(self._min_cooldown, self._cooldown / 2)
+                self.failure_rate = 0.0
+                self.state = CircuitBreaker.CLOSED
+                log.info("circuit breaker closed")
+
+    def record_failure(
+        self,
+        exception: Exception,
+        state=None,
+        abort_margin: Optional[float] = None,
+        visits: int = 0,
+    ):
+        """
+        :param state: the state the call was aborted in, if it was aborted
+        :param abort_margin: how much ABRT's average reward beats the best retry's in state
+        :param visits: how many times state has been tried
+        """
+        self.failure_rate += (1 - self.failure_rate) * self._weight
+        if self.state == CircuitBreaker.HALF_OPEN:
+            with self._lock:
+                if self.state == CircuitBreaker.HALF_OPEN:
+                    self._cooldown = min(self._max_cooldown, self._cooldown * 2)
+                    self._open(exception, state)
+            return
+
+        if (
+            self.state == CircuitBreaker.CLOSED
+            and abort_margin is not None
+            and abort_margin >= self._abort_margin
+            and visits >= self._min_samples
+            and self.failure_rate >= self._failure_rate_threshold
+        ):
+            with self._lock:
+                if self.state == CircuitBreaker.CLOSED:
+                    self._open(exception, state)
+
+    def abandon_probe(self):
+        """
+        the probe ended without reporting a result (eg. it was cancelled).  Let the next call probe instead
+        """
+        if self.state != CircuitBreaker.HALF_OPEN:
+            return
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+                self._open_until = self._monotonic()
+
+    def _open(self, exception: Exception, state):
+        self.state = CircuitBreaker.OPEN
+        self._open_until = self._monotonic() + self._cooldown
+        self.last_exception = exception
+        if state is not None:
+            self.tripped_state = state
+        log.warning(
+            f"circuit breaker opened in state {self.tripped_state} for {self._cooldown:g}s"
+        )
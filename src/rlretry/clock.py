@@ -0,0 +1,101 @@
+"""
+The clock rlretry and auto_request_interval use to tell the time and to sleep.
+
+Pass a VirtualClock (and run async code on a VirtualTimeEventLoop) to run them in simulated time, see simulation.py
+"""
+
+from __future__ import annotations
+import asyncio
+from datetime import datetime, timedelta
+import selectors
+import time
+from typing import Optional
+
+
+class Clock:
+    """
+    real time
+    """
+
+    def now(self) -> datetime:
+        return datetime.utcnow()
+
+    # time.monotonic itself, so that the rlretry fast path pays for a single C call
+    monotonic = staticmethod(time.monotonic)
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+SYSTEM_CLOCK = Clock()
+
+
+class VirtualClock(Clock):
+    """
+    simulated time, which only moves when something sleeps (or advance() is called)
+    """
+
+    def __init__(self, start: datetime = datetime(2000, 1, 1)):
+        self._start = start
+        self._elapsed = 0.0
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=self._elapsed)
+
+    def monotonic(self) -> float:
+        return self._elapsed
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def advance(self, seconds: float):
+        if seconds > 0:
+            self._elapsed += seconds
+
+
+class _VirtualTimeSelector(selectors.BaseSelector):
+    """
+    a selector which, instead of blocking until the next timer is due, moves the virtual clock forward to it
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self._clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout: Optional[float] = None):
+        ready = self._selector.select(0)
+        if not ready:
+            if timeout is None:
+                # nothing is scheduled, so only real I/O can wake us
+                return self._selector.select(None)
+            self._clock.advance(timeout)
+        return ready
+
+    def close(self):
+        self._selector.close()
+
+    def get_map(self):
+        return self._selector.get_map()
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """
+    an event loop whose time is a VirtualClock.  asyncio.sleep() and timeouts complete immediately in real time,
+    moving the clock forward instead.  Real I/O still works, but time does not pass while waiting for it
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        super().__init__(_VirtualTimeSelector(clock))
+
+    def time(self) -> float:
+        return self.clock.monotonic()
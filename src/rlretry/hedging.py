@@ -0,0 +1,227 @@
+"""
+Hedged attempts: if an attempt is slower than usual, launch a duplicate and take whichever succeeds first.
+
+    @rlretry(actions=list(Action) + [Hedge(90), Hedge(99)], max_hedge_fraction=0.05)
+    def fetch(url): ...
+
+Each Hedge is an action the agent learns to choose (or not) in each state, like the back-offs.  "Slower than usual"
+is a percentile of the latency of the function's recent successful attempts, so hedging only starts once
+min_samples of them have been seen.  At most max_hedge_fraction of attempts launch a duplicate, which caps the extra
+load hedging puts on the server.
+
+A sync attempt runs on the caller's thread, so it never waits for a pool thread to become free.  If it hasn't returned
+after the delay, the duplicate is submitted to a thread pool.  The caller takes the first attempt's result if it
+succeeds, or else the duplicate's, so a sync hedge pays off when a slow attempt goes on to fail.  A duplicate which
+is still queued when the first attempt succeeds is cancelled, otherwise it runs to completion and its result is
+discarded.  Async attempts run as tasks, the caller takes whichever succeeds first, and the loser is cancelled.
+"""
+
+from __future__ import annotations
+import asyncio
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import heapq
+import itertools
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .clock import SYSTEM_CLOCK, Clock
+from .rlretry import log
+
+
+class _Attempt:
+    """
+    a sync attempt which may be hedged, and its hedge once one has been launched
+    """
+
+    __slots__ = ("func", "finished", "hedge")
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.finished = False
+        self.hedge: Optional[Future] = None
+
+
+class Hedger:
+    """
+    Keeps the recent latencies of a function, and runs attempts which are hedged at a percentile of them
+    """
+
+    def __init__(
+        self,
+        max_hedge_fraction: float = 0.1,
+        window: int = 1024,
+        min_samples: int = 20,
+        executor: Optional[Executor] = None,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        """
+        :param max_hedge_fraction: the most hedges to launch, as a fraction of all attempts
+        :param window: how many recent latencies to take percentiles of
+        :param min_samples: don't hedge until this many latencies have been recorded
+        :param executor: where the hedges of sync attempts run.  Default: a ThreadPoolExecutor
+        """
+        self._max_hedge_fraction = max_hedge_fraction
+        self._latencies = np.zeros(window)
+        self._min_samples = min_samples
+        self._executor = executor
+        self._monotonic = clock.monotonic
+        # percentiles are recomputed once this many new latencies have been recorded
+        self._refresh_every = max(1, min(64, window // 16))
+        self._percentiles: Dict[float, float] = {}
+        self._percentiles_at = 0
+        # approximate under concurrency, they are only used for the cap
+        self.successes = 0
+        self.attempts = 0
+        self.hedges = 0
+        # sync attempts waiting for their delay to pass, as (when, sequence number, attempt), on one timer thread
+        self._timers: List[Tuple[float, int, _Attempt]] = []
+        self._timer_sequence = itertools.count()
+        self._timer_condition = threading.Condition()
+        self._timer_thread: Optional[threading.Thread] = None
+
+    def record(self, seconds: Optional[float]):
+        """
+        record an attempt, and its latency if it succeeded (None if it failed)
+        """
+        self.attempts += 1
+        if seconds is not None:
+            self._latencies[self.successes % len(self._latencies)] = seconds
+            self.successes += 1
+
+    def delay(self, percentile: float) -> Optional[float]:
+        """
+        how long to wait before hedging, or None if too few latencies have been recorded
+        """
+        successes = self.successes
+        if successes < self._min_samples:
+            return None
+        if successes - self._percentiles_at >= self._refresh_every:
+            self._percentiles = {}
+            self._percentiles_at = successes
+        delay = self._percentiles.get(percentile)
+        if delay is None:
+            recorded = self._latencies[: min(successes, len(self._latencies))]
+            delay = self._percentiles[percentile] = float(
+                np.percentile(recorded, percentile)
+            )
+        return delay
+
+    def _may_hedge(self) -> bool:
+        return self.hedges < self._max_hedge_fraction * self.attempts
+
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix="rlretry-hedge")
+        return self._executor
+
+    def _schedule(self, delay: float, attempt: _Attempt):
+        with self._timer_condition:
+            heapq.heappush(
+                self._timers,
+                (time.monotonic() + delay, next(self._timer_sequence), attempt),
+            )
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(
+                    target=self._run_timers, name="rlretry-hedge-timer", daemon=True
+                )
+                self._timer_thread.start()
+            self._timer_condition.notify()
+
+    def _run_timers(self):
+        with self._timer_condition:
+            while True:
+                if not self._timers:
+                    self._timer_condition.wait()
+                    continue
+                when, _, attempt = self._timers[0]
+                now = time.monotonic()
+                if when > now:
+                    self._timer_condition.wait(when - now)
+                    continue
+                heapq.heappop(self._timers)
+                if not attempt.finished and self._may_hedge():
+                    log.debug("hedging a slow attempt")
+                    self.hedges += 1
+                    attempt.hedge = self._pool().submit(attempt.func)
+
+    def _finish(self, attempt: _Attempt) -> Optional[Future]:
+        """
+        stop attempt from being hedged, and return its hedge if it already has one
+        """
+        with self._timer_condition:
+            attempt.finished = True
+            return attempt.hedge
+
+    def run(self, func: Callable, percentile: float):
+        """
+        call func, and call it again on the pool if it hasn't returned after the percentile'th percentile
+        of the latency.  Return func's result if it succeeds, else the hedge's, or raise func's exception if both fail
+        """
+        delay = self.delay(percentile)
+        start = self._monotonic()
+        if delay is None or not self._may_hedge():
+            try:
+                retval = func()
+            except Exception:
+                self.record(None)
+                raise
+            self.record(self._monotonic() - start)
+            return retval
+
+        attempt = _Attempt(func)
+        self._schedule(delay, attempt)
+        try:
+            retval = func()
+        except Exception:
+            hedge = self._finish(attempt)
+            if hedge is None or hedge.exception() is not None:
+                self.record(None)
+                raise
+            self.record(self._monotonic() - start)
+            return hedge.result()
+        hedge = self._finish(attempt)
+        if hedge is not None:
+            # don't spend a pool thread on a hedge which is no longer needed
+            hedge.cancel()
+        self.record(self._monotonic() - start)
+        return retval
+
+    async def run_async(self, func: Callable[[], Awaitable], percentile: float):
+        """
+        the same as run, for a coroutine function.  The losing attempt is cancelled
+        """
+        delay = self.delay(percentile)
+        start = self._monotonic()
+        if delay is None or not self._may_hedge():
+            try:
+                retval = await func()
+            except Exception:
+                self.record(None)
+                raise
+            self.record(self._monotonic() - start)
+            return retval
+
+        primary = asyncio.ensure_future(func())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self._may_hedge():
+                log.debug(f"hedging an attempt after {delay:.3f}s")
+                self.hedges += 1
+                pending.add(asyncio.ensure_future(func()))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self.record(self._monotonic() - start)
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        self.record(None)
+        return primary.result()
@@ -0,0 +1,372 @@
+"""
+Counters and histograms for rlretry and auto_request_interval, and an exporter in the Prometheus text format.
+
+    retry_metrics = RetryMetrics("fetch")
+    pacing_metrics = PacingMetrics("fetch")
+
+    @rlretry(metrics=retry_metrics)
+    @auto_request_interval(maximum=timedelta(seconds=60), metrics=pacing_metrics)
+    def fetch(url): ...
+
+    PrometheusFileExporter("/var/lib/node_exporter/rlretry.prom", [retry_metrics, pacing_metrics]).start()
+
+Each thread accumulates into its own shard, so recording never takes a lock.  Shards are summed when exporting.
+"""
+
+from __future__ import annotations
+import bisect
+from datetime import timedelta
+import os
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .rlretry import log
+
+# seconds
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+
+
+class Histogram:
+    """
+    bucket counts for a Prometheus histogram.  bucket i counts the observations <= buckets[i],
+    the last one counts those above every bucket
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def add(self, other: Histogram):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+
+class Family(NamedTuple):
+    """
+    a metric family: its HELP and TYPE lines are written once, followed by the samples of every labelled series
+    """
+
+    metric: str
+    type: str
+    help: str
+    samples: List[str]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class _Sharded:
+    """
+    per thread accumulators, created by _new_shard()
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._local = threading.local()
+        self._shards: List = []
+        self._shards_lock = threading.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = self._new_shard()
+            # only taken the first time a thread records something
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _all_shards(self) -> List:
+        with self._shards_lock:
+            return list(self._shards)
+
+    def _samples(self, metric: str, values: Iterable[Tuple[Dict, float]]) -> List[str]:
+        return [
+            f"{metric}{_labels({'name': self.name, **labels})} {value}"
+            for labels, value in values
+        ]
+
+    def _counter(
+        self, metric: str, help_text: str, values: Iterable[Tuple[Dict, float]]
+    ) -> Family:
+        return Family(metric, "counter", help_text, self._samples(metric, values))
+
+    def _gauge(self, metric: str, help_text: str, value: float) -> Family:
+        return Family(metric, "gauge", help_text, self._samples(metric, [({}, value)]))
+
+    def _histogram(self, metric: str, help_text: str, histogram: Histogram) -> Family:
+        cumulative = 0
+        buckets = []
+        for le, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+            cumulative += count
+            buckets.append(({"le": le}, cumulative))
+        return Family(
+            metric,
+            "histogram",
+            help_text,
+            self._samples(f"{metric}_bucket", buckets)
+            + self._samples(f"{metric}_sum", [({}, histogram.sum)])
+            + self._samples(f"{metric}_count", [({}, cumulative)]),
+        )
+
+    def families(self) -> List[Family]:
+        raise NotImplementedError
+
+
+class _RetryShard:
+    def __init__(self, buckets: Sequence[float]):
+        # keyed by outcome: success, abort, timeout, max_retries or circuit_open
+        self.calls: Dict[str, int] = {}
+        # keyed by (state, action)
+        self.retries: Dict[Tuple[str, str], int] = {}
+        self.latency = Histogram(buckets)
+        self.sleep_seconds = 0.0
+
+
+class RetryMetrics(_Sharded):
+    """
+    metrics for an rlretry decorated function
+    """
+
+    OUTCOMES = ("success", "abort", "timeout", "max_retries", "circuit_open")
+
+    def __init__(
+        self, name: str = "rlretry", buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS
+    ):
+        super().__init__(name)
+        self._buckets = buckets
+
+    def _new_shard(self) -> _RetryShard:
+        return _RetryShard(self._buckets)
+
+    def record_retry(self, state, action):
+        retries = self._shard().retries
+        key = (str(state), action.name)
+        retries[key] = retries.get(key, 0) + 1
+
+    def record_call(self, outcome: str, latency: float, sleep_seconds: float = 0.0):
+        """
+        :param latency: the seconds from calling the wrapper to it returning or raising
+        :param sleep_seconds: how much of latency was spent backing off rather than in the function
+        """
+        shard = self._shard()
+        shard.calls[outcome] = shard.calls.get(outcome, 0) + 1
+        shard.latency.observe(latency)
+        shard.sleep_seconds += sleep_seconds
+
+    def totals(self) -> _RetryShard:
+        total = _RetryShard(self._buckets)
+        total.calls = dict.fromkeys(RetryMetrics.OUTCOMES, 0)
+        for shard in self._all_shards():
+            # copy first, the owning thread may be adding keys
+            for outcome, count in list(shard.calls.items()):
+                total.calls[outcome] = total.calls.get(outcome, 0) + count
+            for key, count in list(shard.retries.items()):
+                total.retries[key] = total.retries.get(key, 0) + count
+            total.latency.add(shard.latency)
+            total.sleep_seconds += shard.sleep_seconds
+        return total
+
+    def families(self) -> List[Family]:
+        total = self.totals()
+        return [
+            self._counter(
+                "rlretry_calls_total",
+                "Calls to the decorated function by outcome",
+                (({"outcome": o}, n) for o, n in total.calls.items()),
+            ),
+            self._counter(
+                "rlretry_retries_total",
+                "Actions chosen by the agent, by the state it was in",
+                (
+                    ({"state": state, "action": action}, n)
+                    for (state, action), n in sorted(total.retries.items())
+                ),
+            ),
+            self._histogram(
+                "rlretry_call_duration_seconds",
+                "End to end call latency, including retries",
+                total.latency,
+            ),
+            self._counter(
+                "rlretry_sleep_seconds_total",
+                "Time spent backing off between attempts",
+                [({}, total.sleep_seconds)],
+            ),
+            self._counter(
+                "rlretry_function_seconds_total",
+                "Time spent in the decorated function",
+                [({}, max(0.0, total.latency.sum - total.sleep_seconds))],
+            ),
+        ]
+
+
+class _PacingShard:
+    def __init__(self, buckets: Sequence[float]):
+        self.successes = 0
+        self.failures = 0
+        self.throttled = 0
+        self.wait = Histogram(buckets)
+
+
+class PacingMetrics(_Sharded):
+    """
+    metrics for an auto_request_interval decorated function
+    """
+
+    def __init__(
+        self,
+        name: str = "auto_request_interval",
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        super().__init__(name)
+        self._buckets = buckets
+        self.current_interval = 0.0
+
+    def _new_shard(self) -> _PacingShard:
+        return _PacingShard(self._buckets)
+
+    def record_wait(self, wait_seconds: float):
+        shard = self._shard()
+        if wait_seconds > 0:
+            shard.throttled += 1
+        shard.wait.observe(max(0.0, wait_seconds))
+
+    def record_result(self, is_success: bool, current_interval: timedelta):
+        shard = self._shard()
+        if is_success:
+            shard.successes += 1
+        else:
+            shard.failures += 1
+        self.current_interval = current_interval.total_seconds()
+
+    def families(self) -> List[Family]:
+        total = _PacingShard(self._buckets)
+        for shard in self._all_shards():
+            total.successes += shard.successes
+            total.failures += shard.failures
+            total.throttled += shard.throttled
+            total.wait.add(shard.wait)
+        return [
+            self._counter(
+                "rlretry_paced_requests_total",
+                "Paced requests by result",
+                [
+                    ({"result": "success"}, total.successes),
+                    ({"result": "failure"}, total.failures),
+                ],
+            ),
+            self._counter(
+                "rlretry_throttled_requests_total",
+                "Paced requests which had to wait for their slot",
+                [({}, total.throttled)],
+            ),
+            self._histogram(
+                "rlretry_pacing_wait_seconds",
+                "Time requests waited for their slot",
+                total.wait,
+            ),
+            self._gauge(
+                "rlretry_pacing_interval_seconds",
+                "The interval between requests currently chosen",
+                self.current_interval,
+            ),
+        ]
+
+
+def prometheus_text(metrics: Iterable[_Sharded]) -> str:
+    """
+    the metrics in the Prometheus text exposition format.  The families of metrics with different names are merged
+    """
+    families: Dict[str, Family] = {}
+    for m in metrics:
+        for family in m.families():
+            if family.metric in families:
+                families[family.metric].samples.extend(family.samples)
+            else:
+                families[family.metric] = family._replace(samples=list(family.samples))
+    lines = []
+    for family in families.values():
+        lines.append(f"# HELP {family.metric} {family.help}")
+        lines.append(f"# TYPE {family.metric} {family.type}")
+        lines.extend(family.samples)
+    return "".join(line + "\n" for line in lines)
+
+
+def write_prometheus(path: str, metrics: Iterable[_Sharded]):
+    """
+    write the metrics to path (eg. for node_exporter's textfile collector), replacing it atomically
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text(metrics))
+    os.replace(tmp_path, path)
+
+
+class PrometheusFileExporter:
+    """
+    rewrites path with the metrics every interval, on a daemon thread
+    """
+
+    def __init__(
+        self,
+        path: str,
+        metrics: Sequence[_Sharded],
+        interval: timedelta = timedelta(seconds=15),
+    ):
+        self._path = path
+        self._metrics = list(metrics)
+        self._interval = interval.total_seconds()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self):
+        write_prometheus(self._path, self._metrics)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.export()
+            except Exception:
+                log.exception(f"failed to write metrics to {self._path}")
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(
+            target=self._run, name="rlretry-metrics", daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.export()
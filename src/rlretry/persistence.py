@@ -0,0 +1,158 @@
+"""
+Built-in weight persistence which only writes the cells of the Q-table that changed.
+"""
+from __future__ import annotations
+import itertools
+import os
+import pathlib
+import pickle
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .rlretry import StateActionMap, log
+
+
+class DeltaLogWeightStore:
+    """
+    Saves the Q-table as a snapshot plus an append-only log of the cells which changed since the snapshot.
+
+    Each dump appends one record holding only the changed (state, action) cells.  Every compact_every records
+    the log is replayed into a new snapshot and truncated.  Loading reads the snapshot and replays the log on top of it.
+
+    Pass it to rlretry (or RLAgent) as weight_store.  Only one process should write to a directory.
+    """
+
+    SNAPSHOT_FILENAME = "snapshot.pickle"
+    LOG_FILENAME = "delta.log"
+
+    def __init__(self, directory: Union[str, pathlib.Path], compact_every: int = 100):
+        self._dir = pathlib.Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._snapshot_path = self._dir / DeltaLogWeightStore.SNAPSHOT_FILENAME
+        self._log_path = self._dir / DeltaLogWeightStore.LOG_FILENAME
+        self._compact_every = compact_every
+        records, length = self._read_log()
+        self._records_since_compaction = len(records)
+        # a record torn by a crash would hide every record appended after it, so cut it off before appending
+        if self._log_path.exists() and self._log_path.stat().st_size > length:
+            log.warning(
+                f"truncating a partly written record at the end of {self._log_path}"
+            )
+            os.truncate(self._log_path, length)
+
+    def load(self) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+        df, counts_df = self._read_snapshot()
+        records, _ = self._read_log()
+        if records:
+            df, counts_df = DeltaLogWeightStore._replay(df, counts_df, records)
+        return df, counts_df
+
+    def dump_changes(
+        self,
+        states: Sequence,
+        actions: Sequence,
+        q: np.ndarray,
+        counts: np.ndarray,
+    ):
+        """
+        append the changed cells to the log (see StateActionMap.pop_changes())
+        """
+        if len(states) == 0:
+            return
+        with open(self._log_path, "ab") as f:
+            pickle.dump(
+                (list(states), list(actions), np.asarray(q), np.asarray(counts)),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        self._records_since_compaction += 1
+        if self._records_since_compaction >= self._compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        write the current table to a new snapshot and truncate the log
+        """
+        df, counts_df = self.load()
+        tmp_path = self._snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((df, counts_df), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._snapshot_path)
+        # records hold absolute values, so if we die before truncating, replaying them onto the new snapshot is harmless
+        open(self._log_path, "wb").close()
+        self._records_since_compaction = 0
+
+    def _read_snapshot(self) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+        if not self._snapshot_path.exists():
+            return None, None
+        with open(self._snapshot_path, "rb") as f:
+            return pickle.load(f)
+
+    def _read_log(self) -> Tuple[List[Tuple[List, List, np.ndarray, np.ndarray]], int]:
+        """
+        the complete records in the log, and the length in bytes of the log up to the end of the last one
+        """
+        records = []
+        length = 0
+        if not self._log_path.exists():
+            return records, length
+        with open(self._log_path, "rb") as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError):
+                    # the last record was only partly written
+                    log.warning(f"ignoring truncated record at the end of {self._log_path}")
+                    break
+                length = f.tell()
+        return records, length
+
+    @staticmethod
+    def _replay(
+        df: Optional[pd.DataFrame],
+        counts_df: Optional[pd.DataFrame],
+        records: List[Tuple[List, List, np.ndarray, np.ndarray]],
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        if df is None or df.empty:
+            df = StateActionMap.default_df()
+        if counts_df is None or counts_df.empty:
+            counts_df = StateActionMap.default_counts_df()
+
+        deltas = pd.DataFrame(
+            {
+                "state": list(itertools.chain.from_iterable(r[0] for r in records)),
+                "action": list(itertools.chain.from_iterable(r[1] for r in records)),
+                "q": np.concatenate([r[2] for r in records]),
+                "count": np.concatenate([r[3] for r in records]),
+            }
+        ).drop_duplicates(["state", "action"], keep="last")
+
+        # keep the row and column order of the snapshot (ABRT must stay first)
+        known_states = set(df.index)
+        states = list(df.index) + [
+            s for s in pd.unique(deltas["state"]) if s not in known_states
+        ]
+        actions = list(df.columns) + [
+            a for a in pd.unique(deltas["action"]) if a not in df.columns
+        ]
+        q_df = (
+            deltas.pivot(index="state", columns="action", values="q")
+            .reindex(index=states, columns=actions)
+            .fillna(df.astype(np.float64).reindex(index=states, columns=actions))
+        )
+        new_counts_df = (
+            deltas.pivot(index="state", columns="action", values="count")
+            .reindex(index=states, columns=actions)
+            .fillna(counts_df.astype(np.float64).reindex(index=states, columns=actions))
+            .fillna(0)
+            .astype(np.int64)
+        )
+        q_df.columns.name = None
+        q_df.index.name = None
+        new_counts_df.columns.name = None
+        new_counts_df.index.name = None
+        return q_df, new_counts_df
@@ -1,14 +1,34 @@
 from __future__ import annotations
+import asyncio
+import atexit
+from collections import deque
+import copy
 from datetime import datetime, timedelta
+import functools
+import inspect
+import itertools
 import math
 import random
-import time
-from typing import Callable, Tuple, Union
+import threading
+from typing import (
+    Callable,
+    Deque,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 from enum import Enum
+import numpy as np
 import pandas as pd
 import logging
 
-log = logging.Logger(__name__)
+from .clock import SYSTEM_CLOCK, Clock
+
+log = logging.getLogger(__name__)
 
 
 def update_average(
@@ -43,6 +63,107 @@ def update_recency_weighted_average(
     return new_reward, counts
 
 
+class MergedWeights(NamedTuple):
+    average: pd.DataFrame
+    # None unless merge_weights() was given an alpha
+    recency_weighted_average: Optional[pd.DataFrame]
+    counts: pd.DataFrame
+
+
+def _union(labels: Iterable[Iterable]) -> List:
+    seen = {}
+    for label_list in labels:
+        for label in label_list:
+            seen.setdefault(label, None)
+    return list(seen)
+
+
+def merge_weights(
+    q0: Optional[pd.DataFrame],
+    n0: Optional[pd.DataFrame],
+    worker_weights: Sequence[Tuple[pd.DataFrame, pd.DataFrame]],
+    alpha: Optional[float] = None,
+) -> MergedWeights:
+    """
+    combine the estimates of any number of workers which all started from the same base estimate (q0, n0).
+
+    This is the N-way version of update_average and update_recency_weighted_average, computed in one vectorized pass.
+    The states and actions of all the tables are aligned first.  A cell which is missing from a worker's table
+    is treated as the worker having no new samples for it, a cell missing from the base as never having been tried.
+
+    The recency weighted average replays the workers' samples in the order they are given.
+
+    :param worker_weights: a sequence of (average rewards, counts) DataFrames, one per worker
+    :param alpha: the recency weighting.  If None, only the plain average is calculated
+    """
+    tables = [(q0, n0)] + list(worker_weights)
+    tables = [(q, n) for q, n in tables if q is not None and n is not None]
+    states = _union(q.index for q, _ in tables)
+    actions = _union(q.columns for q, _ in tables)
+
+    def aligned(df: Optional[pd.DataFrame]) -> np.ndarray:
+        if df is None:
+            return np.full((len(states), len(actions)), np.nan)
+        return df.reindex(index=states, columns=actions).to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+
+    base_q = np.nan_to_num(aligned(q0))
+    base_n = np.nan_to_num(aligned(n0))
+    # shape is (workers, states, actions)
+    no_workers = np.empty((0, len(states), len(actions)))
+    q = (
+        np.stack([aligned(worker_q) for worker_q, _ in worker_weights])
+        if worker_weights
+        else no_workers
+    )
+    n = (
+        np.stack([aligned(worker_n) for _, worker_n in worker_weights])
+        if worker_weights
+        else no_workers
+    )
+    missing = np.isnan(q) | np.isnan(n)
+    q = np.where(missing, base_q, q)
+    n = np.where(missing, base_n, n)
+
+    k = n - base_n
+    has_samples = k > 0
+    counts = base_n + k.sum(axis=0)
+
+    # the sum of every worker's samples on top of the base
+    total = base_q * base_n + np.where(has_samples, q * n - base_q * base_n, 0).sum(
+        axis=0
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average = total / counts
+
+    # nobody has tried the cell, so take the value from the first table which has it
+    untried = aligned(q0)
+    for worker_q, worker_missing in zip(q, missing):
+        untried = np.where(np.isnan(untried) & ~worker_missing, worker_q, untried)
+    untried = np.nan_to_num(untried)
+    average = np.where(counts > 0, average, untried)
+
+    recency_weighted_average = None
+    if alpha is not None:
+        decay = 1 - alpha
+        # the samples of later workers are replayed on top of those of earlier workers
+        later_k = np.cumsum(k[::-1], axis=0)[::-1] - k
+        contribution = np.where(has_samples, q - decay**k * base_q, 0)
+        weighted = decay ** k.sum(axis=0) * base_q + (
+            decay**later_k * contribution
+        ).sum(axis=0)
+        recency_weighted_average = pd.DataFrame(
+            np.where(counts > 0, weighted, untried), index=states, columns=actions
+        )
+
+    return MergedWeights(
+        pd.DataFrame(average, index=states, columns=actions),
+        recency_weighted_average,
+        pd.DataFrame(counts.astype(np.int64), index=states, columns=actions),
+    )
+
+
 class Action(Enum):
     ABRT = 0
     RETRY0 = 1
@@ -59,6 +180,135 @@ class Action(Enum):
             return 0.5
         return 0
 
+    def sleep_seconds(self, timeout: timedelta) -> float:
+        return timeout.total_seconds() * self.sleeptime()
+
+
+class Backoff:
+    """
+    An action which retries after a back-off: seconds, or if relative is set that fraction of the timeout.
+    Pass a list of them to rlretry as actions to use instead of the RETRY Actions (see backoff_ladder())
+    """
+
+    __slots__ = ("seconds", "relative")
+
+    def __init__(self, seconds: float, relative: bool = False):
+        if seconds < 0:
+            raise ValueError("a back-off can not be negative")
+        self.seconds = float(seconds)
+        self.relative = relative
+
+    @property
+    def name(self) -> str:
+        # repr() round trips exactly, see from_name()
+        return f"BACKOFF_{self.seconds!r}{'X' if self.relative else 'S'}"
+
+    @staticmethod
+    def from_name(name: str) -> Backoff:
+        if not name.startswith("BACKOFF_") or name[-1] not in "XS":
+            raise ValueError(f"{name} is not the name of a Backoff")
+        return Backoff(float(name[len("BACKOFF_") : -1]), name[-1] == "X")
+
+    def sleep_seconds(self, timeout: timedelta) -> float:
+        return self.seconds * timeout.total_seconds() if self.relative else self.seconds
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, Backoff)
+            and self.seconds == other.seconds
+            and self.relative == other.relative
+        )
+
+    def __hash__(self) -> int:
+        return hash((Backoff, self.seconds, self.relative))
+
+    def __repr__(self) -> str:
+        return f"Backoff({self.seconds:g}{', relative=True' if self.relative else ''})"
+
+    def __getstate__(self):
+        return (self.seconds, self.relative)
+
+    def __setstate__(self, state):
+        self.seconds, self.relative = state
+
+
+class Hedge:
+    """
+    An action which retries immediately, and if the attempt is still running after the percentile'th percentile
+    of the function's latency, launches a duplicate of it.  Whichever succeeds first wins.
+    Add them to the actions passed to rlretry, eg. actions=list(Action) + [Hedge(90), Hedge(99)], see hedging.py
+    """
+
+    __slots__ = ("percentile",)
+
+    def __init__(self, percentile: float):
+        if not 0 < percentile < 100:
+            raise ValueError("the percentile must be between 0 and 100")
+        self.percentile = float(percentile)
+
+    @property
+    def name(self) -> str:
+        return f"HEDGE_P{self.percentile!r}"
+
+    @staticmethod
+    def from_name(name: str) -> Hedge:
+        if not name.startswith("HEDGE_P"):
+            raise ValueError(f"{name} is not the name of a Hedge")
+        return Hedge(float(name[len("HEDGE_P") :]))
+
+    def sleep_seconds(self, timeout: timedelta) -> float:
+        return 0.0
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Hedge) and self.percentile == other.percentile
+
+    def __hash__(self) -> int:
+        return hash((Hedge, self.percentile))
+
+    def __repr__(self) -> str:
+        return f"Hedge({self.percentile:g})"
+
+    def __getstate__(self):
+        return self.percentile
+
+    def __setstate__(self, state):
+        self.percentile = state
+
+
+def backoff_ladder(
+    minimum: timedelta, maximum: timedelta, steps: int, immediate: bool = True
+) -> List[Backoff]:
+    """
+    steps absolute back-offs, spaced geometrically from minimum to maximum (to 3 significant figures), eg.
+    backoff_ladder(timedelta(milliseconds=50), timedelta(seconds=60), 12)
+
+    :param immediate: also include retrying immediately
+    """
+    if minimum <= timedelta(0) or maximum < minimum or steps < 1:
+        raise ValueError("need 0 < minimum <= maximum and at least one step")
+    seconds = np.geomspace(minimum.total_seconds(), maximum.total_seconds(), steps)
+    return ([Backoff(0)] if immediate else []) + [
+        Backoff(float(f"{s:.3g}")) for s in seconds
+    ]
+
+
+def with_abort(actions: Iterable) -> List:
+    """
+    the actions with ABRT first, which the Q-table requires
+    """
+    return [Action.ABRT] + [a for a in actions if a is not Action.ABRT]
+
+
+def action_from_name(name: str):
+    """
+    the Action, Backoff or Hedge with this name
+    """
+    if name in Action.__members__:
+        return Action[name]
+    if name.startswith("HEDGE_"):
+        return Hedge.from_name(name)
+    return Backoff.from_name(name)
+
 
 class RLRetryError(RuntimeError):
     def __init__(self, msg: str = ""):
@@ -77,6 +327,12 @@ class RLRetryAbort(RLRetryError):
     pass
 
 
+class RLRetryCircuitOpen(RLRetryAbort):
+    """
+    raised without calling the function while a CircuitBreaker is open
+    """
+
+
 class RLRetryNoException(RuntimeError):
     pass
 
@@ -85,6 +341,33 @@ def default_state_func(e: Exception) -> str:
     return e.__class__.__name__
 
 
+STATE_LEVEL_SEPARATOR = "/"
+
+
+def state_key(state):
+    """
+    the name of a state.  A structured state, ie. a tuple of levels from coarsest to finest
+    (eg. (exception class, status code, host)), is joined with STATE_LEVEL_SEPARATOR
+    """
+    if isinstance(state, tuple):
+        return STATE_LEVEL_SEPARATOR.join(str(level) for level in state)
+    return state
+
+
+@functools.lru_cache(maxsize=4096)
+def state_levels(state) -> Tuple:
+    """
+    the state and each coarser level of it, finest first.
+    eg. "ConnectionError/503/example.com" -> ("ConnectionError/503/example.com", "ConnectionError/503", "ConnectionError")
+    """
+    if not isinstance(state, str):
+        return (state,)
+    levels = state.split(STATE_LEVEL_SEPARATOR)
+    return tuple(
+        STATE_LEVEL_SEPARATOR.join(levels[:i]) for i in range(len(levels), 0, -1)
+    )
+
+
 def default_alpha_func(n: int) -> float:
     """
     n is the count of attempts made so far for this state/action pair
@@ -95,22 +378,38 @@ def default_alpha_func(n: int) -> float:
 
 
 class StateActionMap:
+    """
+    The Q-table: the average reward and the number of attempts for every state/action pair.
+
+    Values are kept in contiguous numpy arrays (one row per state, one column per action)
+    with a dict mapping each state to its row.  Row capacity grows geometrically as new
+    states are seen, so adding a state is amortised O(1).
+    DataFrames are only built at the edges, ie. when weights are loaded or dumped.
+
+    Each row's greedy action and its cumulative exploration weights are kept alongside the values and updated
+    with each reward, so choosing an action never scans the row.
+    """
+
+    MIN_CAPACITY = 8
+
     def __init__(
         self,
         df: pd.DataFrame,
         counts_df: pd.DataFrame,
         initial_value: float = 0.0,
         alpha: Union[float, None, Callable[[int], float]] = 0.0,
+        keep_last_saved: bool = True,
+        actions: Optional[Sequence] = None,
     ):
-        self._df = StateActionMap.default_df() if df is None or df.empty else df
-        self._counts_df = (
-            StateActionMap.default_counts_df()
-            if counts_df is None or counts_df.empty
-            else counts_df
-        )
-        self._last_saved_df = self._df.copy(deep=True)
-        self._last_saved_counts_df = self._counts_df.copy(deep=True)
+        """
+        :param keep_last_saved: keep a copy of the table as it was when it was last dumped, for weight dumpers which
+            merge against it.  Not needed when only the changed cells are dumped (see pop_changes())
+        :param actions: the columns of the table (ABRT is always the first).  Loaded weights are reindexed to them,
+            so arms which were added start out untried.  If None, use the columns of the loaded weights, or every Action
+        """
         self._initial_value = initial_value
+        self._keep_last_saved = keep_last_saved
+        self._configured_actions = None if actions is None else with_abort(actions)
 
         if callable(alpha):
             self._alpha = alpha
@@ -119,6 +418,9 @@ class StateActionMap:
         else:
             self._alpha = None
 
+        self._load(df, counts_df)
+        self.update_last_saved()
+
     @staticmethod
     def default_df() -> pd.DataFrame:
         return pd.DataFrame(columns=list(Action), dtype=pd.Float32Dtype())
@@ -133,15 +435,143 @@ class StateActionMap:
         # the reward doesn't change so we don't need to explore it
         return random.choice(list(Action)[1:])
 
+    def _load(self, df: Optional[pd.DataFrame], counts_df: Optional[pd.DataFrame]):
+        if df is None or df.empty:
+            df = self._empty_dataframes()[0]
+        elif self._configured_actions is not None:
+            df = df.reindex(columns=self._configured_actions)
+        self._actions = list(df.columns)
+        self._columns = {action: i for i, action in enumerate(self._actions)}
+        self._states = list(df.index)
+        self._rows = {state: i for i, state in enumerate(self._states)}
+
+        num_states = len(self._states)
+        capacity = max(StateActionMap.MIN_CAPACITY, num_states)
+        self._q = np.zeros((capacity, len(self._actions)), dtype=np.float64)
+        self._counts = np.zeros((capacity, len(self._actions)), dtype=np.int64)
+        # cells which have changed since the last call to pop_changes()
+        self._dirty = np.zeros((capacity, len(self._actions)), dtype=bool)
+        # the column of each row's highest value, ie. argmax
+        self._greedy = np.zeros(capacity, dtype=np.int64)
+        # the cumulative sum of each row's exploration weights (every action but ABRT)
+        self._cum_weights = np.zeros((capacity, len(self._actions) - 1))
+
+        if num_states:
+            q = df.to_numpy(dtype=np.float64, na_value=np.nan)
+            # cells which are missing (eg. after merging tables which had seen different states) have never been tried
+            self._q[:num_states] = np.where(np.isnan(q), float(self._initial_value), q)
+
+        if counts_df is not None and not counts_df.empty and num_states:
+            counts = counts_df.reindex(index=self._states, columns=self._actions)
+            self._counts[:num_states] = counts.to_numpy(
+                dtype=np.float64, na_value=0
+            ).astype(np.int64)
+
+        self._refresh_rows(np.arange(num_states))
+
+    def _refresh_rows(self, rows: np.ndarray):
+        """
+        recompute the greedy action and the exploration weights of rows from scratch
+        """
+        if len(rows) == 0:
+            return
+        self._greedy[rows] = self._q[rows].argmax(axis=1)
+        self._cum_weights[rows] = np.cumsum(
+            1 / np.log(2 + self._counts[rows, 1:]), axis=1
+        )
+
+    def snapshot(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        """
+        return a copy of the table as (states, actions, average rewards, counts)
+
+        Safe to call from another thread while a single thread updates the table.
+        """
+        # take the states first, rows are only published once they are filled in
+        states = list(self._states)
+        num_states = len(states)
+        return (
+            states,
+            list(self._actions),
+            self._q[:num_states].copy(),
+            self._counts[:num_states].copy(),
+        )
+
+    @staticmethod
+    def snapshot_dataframes(
+        snapshot: Tuple[List, List, np.ndarray, np.ndarray],
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        states, actions, q, counts = snapshot
+        return (
+            pd.DataFrame(q, index=list(states), columns=list(actions)),
+            pd.DataFrame(counts, index=list(states), columns=list(actions)),
+        )
+
+    def to_dataframes(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        return copies of the average rewards and the counts as DataFrames (indexed by state, with a column per action)
+        """
+        return StateActionMap.snapshot_dataframes(self.snapshot())
+
+    def _empty_dataframes(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        if self._configured_actions is None:
+            return StateActionMap.default_df(), StateActionMap.default_counts_df()
+        return (
+            pd.DataFrame(columns=self._configured_actions, dtype=pd.Float32Dtype()),
+            pd.DataFrame(columns=self._configured_actions),
+        )
+
+    def last_saved_dataframes(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        if self._last_saved is None:
+            return self._empty_dataframes()
+        return StateActionMap.snapshot_dataframes(self._last_saved)
+
+    # DataFrame views of the table, kept for backwards compatibility with code written
+    # against the old pandas backed implementation.  Prefer to_dataframes()
+    @property
+    def _df(self) -> pd.DataFrame:
+        return self.to_dataframes()[0]
+
+    @_df.setter
+    def _df(self, df: pd.DataFrame):
+        self._load(df, self.to_dataframes()[1])
+
+    @property
+    def _counts_df(self) -> pd.DataFrame:
+        return self.to_dataframes()[1]
+
+    @_counts_df.setter
+    def _counts_df(self, counts_df: pd.DataFrame):
+        self._load(self.to_dataframes()[0], counts_df)
+
+    @property
+    def _last_saved_df(self) -> pd.DataFrame:
+        return self.last_saved_dataframes()[0]
+
+    @property
+    def _last_saved_counts_df(self) -> pd.DataFrame:
+        return self.last_saved_dataframes()[1]
+
+    def _row(self, state) -> Optional[int]:
+        return self._rows.get(state)
+
+    def visits(self, state) -> int:
+        """
+        the number of times any action has been tried in state
+        """
+        row = self._row(state)
+        return 0 if row is None else int(self._counts[row].sum())
+
     def randomish_action(self, state: str) -> Action:
         # don't ever choose ABRT as a random action
         # the reward doesn't change so we don't need to explore it
 
         # choose an action at random, but prefer those which have been tried the least
+        possible_actions = self._actions[1:]
 
-        # if we have no counts yet, just choose randomly
-        if self._counts_df.empty:
-            return self.__class__.random_action()
+        # if we have no counts for this state yet, just choose randomly
+        row = self._row(state)
+        if row is None:
+            return random.choice(possible_actions)
 
         # to make the weights take the inverse of the count (we want a low count to mean a high probability of being chosen)
         # take the log of the counts too so that small numbers have more impact. ie.
@@ -149,39 +579,66 @@ class StateActionMap:
         #   but an option chosen 100 times should be about the same as an option chosen 1000 times
         #   bascially, in the long run, the weights will even out at roughly even
         #   but at the start, infrequently chosen options will be boosted
-        possible_actions = list(Action)[1:]
-        weights = [
-            1 / math.log(2 + self._counts_df[action][state])
-            for action in possible_actions
-        ]
-        return random.choices(possible_actions, weights=weights)[0]
-
+        # (this is the same draw random.choices(possible_actions, weights) makes, without building the weights)
+        cum_weights = self._cum_weights[row]
+        index = cum_weights.searchsorted(random.random() * cum_weights[-1], "right")
+        # another thread may have lowered the weights between reading the total and searching
+        return possible_actions[min(int(index), len(possible_actions) - 1)]
 
     def best_action(self, state) -> Action:
-        if state not in self._df.index:
-            return random.choice(list(Action))
-
-        actions = self._df.loc[state]
+        row = self._row(state)
+        if row is None:
+            return random.choice(self._actions)
 
-        idx_of_best_action = actions.argmax()
+        return self._actions[int(self._greedy[row])]
 
-        best_action = actions.index[idx_of_best_action]
+    def create_state(self, state: str) -> int:
+        row = self._rows.get(state)
+        is_new = row is None
+        if is_new:
+            row = len(self._states)
+            if row == self._q.shape[0]:
+                self._grow()
 
-        return best_action
-
-    def create_state(self, state: str):
         # always set ABRT to have a reward of 1, regardless of other settings.
-        self._df.loc[state] = [1.0] + [
-            float(self._initial_value) for _ in list(Action)[1:]
-        ]
-        self._counts_df.loc[state] = [0 for _ in list(Action)]
+        self._q[row, 0] = 1.0
+        self._q[row, 1:] = float(self._initial_value)
+        self._counts[row] = 0
+        self._dirty[row] = True
+        self._refresh_rows(np.array([row]))
+
+        # only publish the row once it is filled in, so that concurrent readers never see a half created state
+        if is_new:
+            self._states.append(state)
+            self._rows[state] = row
+        return row
+
+    def _grow(self):
+        capacity = self._q.shape[0] * 2
+        q = np.zeros((capacity, len(self._actions)), dtype=np.float64)
+        counts = np.zeros((capacity, len(self._actions)), dtype=np.int64)
+        dirty = np.zeros((capacity, len(self._actions)), dtype=bool)
+        q[: len(self._states)] = self._q[: len(self._states)]
+        counts[: len(self._states)] = self._counts[: len(self._states)]
+        dirty[: len(self._states)] = self._dirty[: len(self._states)]
+        greedy = np.zeros(capacity, dtype=np.int64)
+        greedy[: len(self._states)] = self._greedy[: len(self._states)]
+        cum_weights = np.zeros((capacity, len(self._actions) - 1))
+        cum_weights[: len(self._states)] = self._cum_weights[: len(self._states)]
+        self._q = q
+        self._counts = counts
+        self._dirty = dirty
+        self._greedy = greedy
+        self._cum_weights = cum_weights
 
     def update_average_reward(self, state: str, action: Action, new_reward: float):
-        if state not in self._df.index:
-            self.create_state(state)
-        count = self._counts_df[action][state]
-        current_average = self._df[action][state]
-        value_delta = new_reward - current_average
+        row = self._row(state)
+        if row is None:
+            row = self.create_state(state)
+        col = self._columns[action]
+        count = int(self._counts[row, col])
+        old_value = float(self._q[row, col])
+        value_delta = new_reward - old_value
         # if alpha has been specified, use that as a recency weighting
         # otherwise use average reward
         if self._alpha is not None:
@@ -189,12 +646,88 @@ class StateActionMap:
         else:
             value_delta /= count + 1
 
-        self._df[action][state] += value_delta
-        self._counts_df[action][state] += 1
+        new_value = old_value + value_delta
+        self._q[row, col] = new_value
+        self._counts[row, col] = count + 1
+        self._dirty[row, col] = True
+
+        greedy = int(self._greedy[row])
+        if col == greedy:
+            if new_value < old_value:
+                self._greedy[row] = self._q[row].argmax()
+        else:
+            greedy_value = self._q[row, greedy]
+            # argmax takes the first of equal values
+            if new_value > greedy_value or (new_value == greedy_value and col < greedy):
+                self._greedy[row] = col
+        if col:
+            self._cum_weights[row, col - 1 :] += 1 / math.log(3 + count) - 1 / math.log(
+                2 + count
+            )
+
+    def update_average_rewards(self, rewards: Iterable[Tuple[str, Action, float]]):
+        """
+        apply a batch of (state, action, reward) updates in order
+        """
+        for state, action, reward in rewards:
+            self.update_average_reward(state, action, reward)
+
+    def pop_changes(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        """
+        return the cells which have changed since the last call as (states, actions, average rewards, counts)
+        and mark them as clean
+        """
+        states = list(self._states)
+        rows, cols = np.nonzero(self._dirty[: len(states)])
+        # clear the marks before reading the values.  If another thread updates a cell in between, it is marked
+        # dirty again and written twice, rather than being missed
+        self._dirty[rows, cols] = False
+        return (
+            [states[row] for row in rows],
+            [self._actions[col] for col in cols],
+            self._q[rows, cols],
+            self._counts[rows, cols],
+        )
 
-    def update_last_saved(self):
-        self._last_saved_df = self._df.copy(deep=True)
-        self._last_saved_counts_df = self._counts_df.copy(deep=True)
+    def set_cells(self, df: pd.DataFrame, counts_df: pd.DataFrame):
+        """
+        overwrite the table with the values in df and counts_df, adding any states it does not have yet.
+        Actions which are not in the table are ignored
+        """
+        counts_df = counts_df.reindex(index=df.index, columns=df.columns)
+        cols = [self._columns.get(action) for action in df.columns]
+        known = [i for i, col in enumerate(cols) if col is not None]
+        if not known:
+            return
+        rows = []
+        positions = []
+        for i, state in enumerate(df.index):
+            row = self._row(state)
+            if row is None:
+                row = self.create_state(state)
+            # a table with a fixed capacity may not have room for it
+            if row is not None:
+                rows.append(row)
+                positions.append(i)
+
+        source = np.ix_(positions, known)
+        target = np.ix_(rows, [cols[i] for i in known])
+        self._q[target] = df.to_numpy(dtype=np.float64, na_value=np.nan)[source]
+        self._counts[target] = counts_df.to_numpy(dtype=np.float64, na_value=0)[
+            source
+        ].astype(np.int64)
+        self._refresh_rows(np.array(rows, dtype=np.int64))
+
+    def update_last_saved(
+        self, snapshot: Optional[Tuple[List, List, np.ndarray, np.ndarray]] = None
+    ):
+        """
+        remember the table as it was when it was dumped.  snapshot defaults to the table as it is now
+        """
+        if not self._keep_last_saved:
+            self._last_saved = None
+            return
+        self._last_saved = self.snapshot() if snapshot is None else snapshot
 
 
 def _default_weight_loader() -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -224,36 +757,345 @@ class RLAgent:
         initial_value: float = 0.0,
         alpha: Union[float, None, Callable[[int], float]] = 0.0,
         dump_interval: int = 100,
+        thread_safe: bool = False,
+        reward_batch_size: int = 32,
+        shared_memory_name: Optional[str] = None,
+        shared_memory_capacity: int = 1024,
+        weight_store=None,
+        dump_in_background: bool = False,
+        dump_period: Optional[timedelta] = None,
+        telemetry_capacity: int = 0,
+        actions: Optional[Sequence] = None,
+        strategy=None,
+        max_states: Optional[int] = None,
+        state_ttl: Optional[timedelta] = None,
+        fold_evicted_into: Optional[str] = None,
+        clock: Clock = SYSTEM_CLOCK,
+        min_state_samples: int = 0,
     ):
-        self._state_action_map = StateActionMap(
-            *weight_loader(), initial_value, alpha=alpha
-        )
+        """
+        :param thread_safe: allow the agent to be shared between threads.  Rewards are buffered per thread
+            and folded into the table in batches of reward_batch_size, so threads only contend for the lock once per batch.
+            Action selection reads the table without locking.
+        :param shared_memory_name: keep the table in the named shared memory segment, shared by every process on the host
+            which uses the same name.  weight_loader is only called by the process which creates the segment.
+            See SharedStateActionMap
+        :param weight_store: an object with load() and dump_changes(states, actions, q, counts) methods (eg. DeltaLogWeightStore)
+            to use instead of weight_loader and weight_dumper.  Only the cells which changed since the last dump are passed to it,
+            and no copy of the last saved table is kept
+        :param dump_in_background: dump the weights on a background thread (every dump_interval choices) rather than in
+            the call which happens to trip the counter.  The weights are dumped once more by close(), which runs at exit
+        :param dump_period: dump the weights on a background thread at this interval instead of every dump_interval choices
+        :param telemetry_capacity: keep the last telemetry_capacity transitions in a TransitionRingBuffer (self.telemetry)
+            for a TelemetryStreamer to consume.  0 to keep none
+        :param actions: the actions to choose between, eg. backoff_ladder().  ABRT is always included.  Default: every Action
+        :param strategy: how to choose between exploring and the best known action, eg. UCB1() (see strategies.py).
+            Default: EpsilonGreedy(epsilon)
+        :param max_states: keep at most this many states, evicting the least recently used.  See BoundedStateActionMap
+        :param state_ttl: evict states which haven't been used for this long
+        :param fold_evicted_into: add the averages and counts of evicted states into this state rather than discarding them
+        :param clock: where the time states were last used comes from
+        :param min_state_samples: treat states as hierarchical (see state_levels), learning at every level and choosing
+            actions from the finest level which has been tried at least min_state_samples times.  0 to treat each state on its own
+        """
+        self._weight_store = weight_store
+        keep_last_saved = weight_store is None
+        if weight_store is not None:
+            weight_loader = weight_store.load
+
+        bounded = max_states is not None or state_ttl is not None
+        if bounded and shared_memory_name is not None:
+            raise ValueError(
+                "max_states and state_ttl can't be used with shared_memory_name, which has a fixed capacity"
+            )
+
+        if bounded:
+            from .bounded_table import BoundedStateActionMap
+
+            self._state_action_map = BoundedStateActionMap(
+                *weight_loader(),
+                initial_value,
+                alpha=alpha,
+                keep_last_saved=keep_last_saved,
+                actions=actions,
+                max_states=max_states,
+                ttl=state_ttl,
+                fold_evicted_into=fold_evicted_into,
+                clock=clock,
+            )
+        elif shared_memory_name is None:
+            self._state_action_map = StateActionMap(
+                *weight_loader(),
+                initial_value,
+                alpha=alpha,
+                keep_last_saved=keep_last_saved,
+                actions=actions,
+            )
+        else:
+            from .shared_table import SharedStateActionMap
+
+            self._state_action_map = SharedStateActionMap(
+                shared_memory_name,
+                weight_loader,
+                initial_value,
+                alpha=alpha,
+                capacity=shared_memory_capacity,
+                actions=None if actions is None else with_abort(actions),
+                keep_last_saved=keep_last_saved,
+            )
+        self.telemetry = None
+        if telemetry_capacity:
+            from .telemetry import TransitionRingBuffer
+
+            self.telemetry = TransitionRingBuffer(telemetry_capacity)
+
         self._eps = epsilon
+        if strategy is None:
+            from .strategies import EpsilonGreedy
+
+            strategy = EpsilonGreedy(epsilon)
+        self._strategy = strategy
+        self._min_state_samples = min_state_samples
         self._age = 0
+        # next() on an itertools.count is atomic, so concurrent callers never get the same age
+        self._age_counter = itertools.count(1)
         self._weight_loader = weight_loader
         self._weight_dumper = weight_dumper
         self._dump_interval = dump_interval
 
+        self._thread_safe = thread_safe
+        self._reward_batch_size = reward_batch_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reward_buffers: List[Tuple[threading.Thread, Deque]] = []
+
+        self._dump_lock = threading.Lock()
+        # merged weights returned to the background dump thread, for the caller's thread to take on
+        self._pending_adopt: Optional[Callable[[], None]] = None
+        self._dump_period = dump_period
+        self._dump_in_background = dump_in_background or dump_period is not None
+        self._closed = False
+        if self._dump_in_background:
+            self._dump_requested = threading.Event()
+            self._dump_thread = threading.Thread(
+                target=self._dump_loop, name="rlretry-weight-dumper", daemon=True
+            )
+            self._dump_thread.start()
+            # flush whatever has been learned since the last dump when the interpreter exits
+            atexit.register(self.close)
+
+    def _dump_loop(self):
+        timeout = (
+            None if self._dump_period is None else self._dump_period.total_seconds()
+        )
+        while True:
+            self._dump_requested.wait(timeout)
+            self._dump_requested.clear()
+            if self._closed:
+                return
+            try:
+                self.dump_weights()
+            except Exception:
+                log.exception("failed to dump weights")
+
+    def close(self):
+        """
+        stop the background dump thread (if there is one) and dump the weights a final time
+        """
+        if not self._dump_in_background or self._closed:
+            return
+        self._closed = True
+        self._dump_requested.set()
+        self._dump_thread.join()
+        atexit.unregister(self.close)
+        self.dump_weights()
+
     def dump_weights(self):
-        self._weight_dumper(
-            self._state_action_map._df,
-            self._state_action_map._counts_df,
-            self._state_action_map._last_saved_df,
-            self._state_action_map._last_saved_counts_df,
+        with self._dump_lock:
+            if self._thread_safe:
+                # take a consistent snapshot, but call the dumper outside of the lock
+                with self._lock:
+                    self._fold_all_rewards()
+                    dump = self._prepare_dump()
+            else:
+                dump = self._prepare_dump()
+            dump()
+
+    def _prepare_dump(self) -> Callable[[], None]:
+        """
+        snapshot whatever needs dumping, and return a function which dumps it
+        """
+        state_action_map = self._state_action_map
+        if self._weight_store is not None:
+            changes = state_action_map.pop_changes()
+            return lambda: self._weight_store.dump_changes(*changes)
+
+        snapshot = state_action_map.snapshot()
+        weights = (
+            *StateActionMap.snapshot_dataframes(snapshot),
+            *state_action_map.last_saved_dataframes(),
         )
-        self._state_action_map.update_last_saved()
 
-    def choose_action(self, state: str) -> Action:
-        self._age += 1
-        if self._age % self._dump_interval == 0:
-            self.dump_weights()
+        def dump():
+            merged = self._weight_dumper(*weights)
+            if merged is None:
+                state_action_map.update_last_saved(snapshot)
+            else:
+                self._adopt(snapshot, *merged)
 
-        if random.random() < self._eps:
-            log.debug("agent choosing random action")
-            return self._state_action_map.randomish_action(state)
-        return self._state_action_map.best_action(state)
+        return dump
+
+    def _adopt(
+        self,
+        snapshot: Tuple[List, List, np.ndarray, np.ndarray],
+        df: pd.DataFrame,
+        counts_df: pd.DataFrame,
+    ):
+        """
+        take on the weights a dumper returned (eg. merged with other agents' weights by an aggregation server),
+        keeping anything learned since the snapshot which was dumped
+        """
+
+        def adopt():
+            state_action_map = self._state_action_map
+            merged = merge_weights(
+                *StateActionMap.snapshot_dataframes(snapshot),
+                [(df, counts_df), state_action_map.to_dataframes()],
+            )
+            state_action_map.set_cells(merged.average, merged.counts)
+            # the next dump should only contain what we learn from now on
+            state_action_map.update_last_saved(
+                (
+                    list(df.index),
+                    list(df.columns),
+                    df.to_numpy(dtype=np.float64, na_value=np.nan),
+                    counts_df.reindex(index=df.index, columns=df.columns)
+                    .to_numpy(dtype=np.float64, na_value=0)
+                    .astype(np.int64),
+                )
+            )
+
+        if self._thread_safe:
+            with self._lock:
+                self._fold_all_rewards()
+                adopt()
+        elif self._dump_in_background and not self._closed:
+            # the table isn't locked, so only the caller's thread may change it.  It takes them on at its next choice
+            self._pending_adopt = adopt
+        else:
+            adopt()
+
+    def _reward_buffer(self) -> Deque:
+        buffer = getattr(self._local, "rewards", None)
+        if buffer is None:
+            buffer = self._local.rewards = deque()
+            with self._lock:
+                self._reward_buffers.append((threading.current_thread(), buffer))
+        return buffer
+
+    def _fold_rewards(self, buffer: Deque):
+        # popleft() is atomic, so other threads can fold this thread's buffer while it is still appending to it
+        rewards = []
+        while True:
+            try:
+                rewards.append(buffer.popleft())
+            except IndexError:
+                break
+        self._state_action_map.update_average_rewards(rewards)
+
+    def _fold_all_rewards(self):
+        for _, buffer in self._reward_buffers:
+            self._fold_rewards(buffer)
+        # forget buffers belonging to threads which have finished
+        self._reward_buffers = [
+            (thread, buffer)
+            for thread, buffer in self._reward_buffers
+            if thread.is_alive() or buffer
+        ]
+
+    def flush_rewards(self):
+        """
+        fold every thread's buffered rewards into the table.  Does nothing unless the agent is thread_safe
+        """
+        if self._thread_safe:
+            with self._lock:
+                self._fold_all_rewards()
+
+    def choose_action(self, state: str) -> Action:
+        return self.select_action(state)[0]
+
+    def select_action(self, state: str) -> Tuple[Action, bool]:
+        """
+        choose an action, and whether it was chosen to explore (True) or because it is the best known (False)
+        """
+        self._age = next(self._age_counter)
+        adopt = self._pending_adopt
+        if adopt is not None:
+            self._pending_adopt = None
+            adopt()
+        if self._dump_period is None and self._age % self._dump_interval == 0:
+            if self._dump_in_background:
+                self._dump_requested.set()
+            else:
+                self.dump_weights()
+
+        if self._min_state_samples:
+            state = self._decision_state(state)
+        return self._strategy.select(self._state_action_map, state)
+
+    def _decision_state(self, state):
+        """
+        the finest level of state which has been tried at least min_state_samples times, or its coarsest level
+        """
+        levels = state_levels(state)
+        for level in levels[:-1]:
+            if self._state_action_map.visits(level) >= self._min_state_samples:
+                return level
+        return levels[-1]
+
+    def abort_margin(self, state) -> Tuple[float, int]:
+        """
+        how much higher ABRT's average reward is than the best retry's in state (at the level actions are chosen from),
+        and how many times that state has been tried
+        """
+        if self._min_state_samples:
+            state = self._decision_state(state)
+        table = self._state_action_map
+        row = table._row(state)
+        if row is None:
+            return float("-inf"), 0
+        q = table._q[row]
+        return float(q[0] - q[1:].max()), int(table._counts[row].sum())
+
+    def record_transition(
+        self,
+        state,
+        action: Action,
+        explored: bool,
+        reward: float,
+        sleep: float,
+        outcome,
+    ):
+        if self.telemetry is not None:
+            self.telemetry.append(state, action, explored, reward, sleep, outcome)
 
     def apply_reward(self, state, action, reward):
+        if self._min_state_samples:
+            # every level learns from the reward, so coarse levels have something to fall back on
+            for level in state_levels(state):
+                self._apply_reward(level, action, reward)
+        else:
+            self._apply_reward(state, action, reward)
+
+    def _apply_reward(self, state, action, reward):
+        if self._thread_safe:
+            buffer = self._reward_buffer()
+            buffer.append((state, action, reward))
+            if len(buffer) >= self._reward_batch_size:
+                with self._lock:
+                    self._fold_rewards(buffer)
+            return
+
         self._state_action_map.update_average_reward(state, action, reward)
 
 
@@ -264,13 +1106,24 @@ class RLEnvironment:
         func,
         max_wait: timedelta,
         state_func: Callable[[Exception], str] = default_state_func,
+        clock: Clock = SYSTEM_CLOCK,
+        hedger=None,
+        deadline: Optional[float] = None,
     ):
-        self._previous_action_start_time = datetime.utcnow()
+        """
+        :param hedger: runs the attempts of Hedge actions, see hedging.py.  Without one they are plain retries
+        :param deadline: the clock.monotonic() time by which the call must finish.  Back-offs are cut short so as not to sleep past it
+        """
+        self._clock = clock
+        self._hedger = hedger
+        self._deadline = deadline
         self._func = func
         self._state_func = state_func
         self.func_retval = None
         self._max_wait = max_wait
         self.last_exception = RLRetryNoException("something has gone wrong")
+        # the seconds the last action backed off for
+        self.slept = 0.0
 
     def run_func(self) -> str:
         try:
@@ -280,21 +1133,98 @@ class RLEnvironment:
             self.last_exception = e
             return self._state_func(e)
 
+    def run_func_hedged(self, hedge: Hedge) -> str:
+        try:
+            self.func_retval = self._hedger.run(self._func, hedge.percentile)
+            return "success"
+        except Exception as e:
+            self.last_exception = e
+            return self._state_func(e)
+
+    async def run_func_async(self) -> str:
+        try:
+            self.func_retval = await self._func()
+            return "success"
+        except Exception as e:
+            self.last_exception = e
+            return self._state_func(e)
+
+    async def run_func_hedged_async(self, hedge: Hedge) -> str:
+        try:
+            self.func_retval = await self._hedger.run_async(
+                self._func, hedge.percentile
+            )
+            return "success"
+        except Exception as e:
+            self.last_exception = e
+            return self._state_func(e)
+
     def next_state_to_reward(self, next_state: str, duration: timedelta) -> float:
         if next_state == "success":
             return 2.5 - duration / self._max_wait
         return 1 - duration / self._max_wait
 
+    def backoff_seconds(self, action: Action) -> float:
+        """
+        how long to back off before retrying with action: its back-off, cut short at the deadline
+        """
+        if action is Action.ABRT:
+            return 0.0
+        seconds = action.sleep_seconds(self._max_wait)
+        if self._deadline is not None:
+            seconds = min(seconds, max(0.0, self._deadline - self._clock.monotonic()))
+        return seconds
+
+    def deadline_passed(self) -> bool:
+        return self._deadline is not None and self._clock.monotonic() >= self._deadline
+
     def execute_action(self, action: Action) -> Tuple[str, float]:
+        """
+        back off, then retry (unless action is ABRT).  The reward is for the time the back-off and the attempt took.
+        If the back-off runs up to the deadline there's no time left for the attempt, and the next state is "timeout"
+        """
         log.debug(f"RLEnvironment execute_action({action})")
-        previous_action_start_time = datetime.utcnow()
+        start = self._clock.monotonic()
 
-        next_state = self.run_func() if action != Action.ABRT else "abort"
+        self.slept = self.backoff_seconds(action)
+        if action is Action.ABRT:
+            next_state = "abort"
+        else:
+            self._clock.sleep(self.slept)
+            if self.deadline_passed():
+                next_state = "timeout"
+            elif self._hedger is not None and isinstance(action, Hedge):
+                next_state = self.run_func_hedged(action)
+            else:
+                next_state = self.run_func()
 
-        time.sleep(self._max_wait.total_seconds() * action.sleeptime())
+        reward = self.next_state_to_reward(
+            next_state, timedelta(seconds=self._clock.monotonic() - start)
+        )
+
+        return next_state, reward
+
+    async def execute_action_async(self, action: Action) -> Tuple[str, float]:
+        """
+        the same as execute_action, but for coroutine functions.  Sleeps without blocking the event loop
+        """
+        log.debug(f"RLEnvironment execute_action_async({action})")
+        start = self._clock.monotonic()
+
+        self.slept = self.backoff_seconds(action)
+        if action is Action.ABRT:
+            next_state = "abort"
+        else:
+            await asyncio.sleep(self.slept)
+            if self.deadline_passed():
+                next_state = "timeout"
+            elif self._hedger is not None and isinstance(action, Hedge):
+                next_state = await self.run_func_hedged_async(action)
+            else:
+                next_state = await self.run_func_async()
 
         reward = self.next_state_to_reward(
-            next_state, datetime.utcnow() - previous_action_start_time
+            next_state, timedelta(seconds=self._clock.monotonic() - start)
         )
 
         return next_state, reward
@@ -315,6 +1245,27 @@ def rlretry(
     optimistic_initial_values: bool = True,
     alpha: Union[float, None, Callable[[int], float]] = default_alpha_func,
     raise_primary_exception=False,
+    thread_safe: bool = False,
+    reward_batch_size: int = 32,
+    shared_memory_name: Optional[str] = None,
+    shared_memory_capacity: int = 1024,
+    weight_store=None,
+    dump_in_background: bool = False,
+    dump_period: Optional[timedelta] = None,
+    clock: Clock = SYSTEM_CLOCK,
+    transition_log=None,
+    telemetry_capacity: int = 0,
+    metrics=None,
+    actions: Optional[Sequence] = None,
+    strategy=None,
+    max_states: Optional[int] = None,
+    state_ttl: Optional[timedelta] = None,
+    fold_evicted_into: Optional[str] = None,
+    min_state_samples: int = 0,
+    max_hedge_fraction: float = 0.1,
+    hedge_executor=None,
+    deadline_kwarg: Optional[str] = None,
+    circuit_breaker=None,
 ):
     """
     A decorator that performs retries on a function if it throws an exceptions.
@@ -324,11 +1275,46 @@ def rlretry(
 
 
     :param max_retries: the maximum number of retries to perform
-    :param timeout: the maximum time to allow for all retries
+    :param timeout: the maximum time to allow for all retries.  A back-off which would run past it is cut short, and RLRetryTimeout is raised instead of retrying
     :param state_func: a function that accepts an exception and returns a string which is the name of a state (in RL parlance).  The default_state_func uses the name of the exception class as the state.
     :param epsilon: determines how much exploration to do.  Set to zero to always use the best option (but slows down learning).  Set to 1 to always use a random option.  Ideally set it somewhere in between
     :param weight_loader loads the weights (ie. the probabilities that certain actions will be chosen)
     :param weight_dumper a function that saves the weights somewhere (so that you don't start from the beginning next time it runs)
+        If it returns a (df, counts_df) tuple, eg. the weights merged with those of other agents, the agent takes them on (see AggregationClient)
+    :param thread_safe: set this if the decorated function is called from several threads.  Rewards are buffered per thread and applied in batches of reward_batch_size
+    :param shared_memory_name: share the learned table with every process on this host which uses the same name (eg. a pool of worker processes).  At most shared_memory_capacity states are kept.
+        Every process sees the combined table, so only merge dumped weights (eg. with update_average) from one of them
+    :param weight_store: persist the weights with eg. a DeltaLogWeightStore, which only writes the cells that changed since the last dump.  Replaces weight_loader and weight_dumper
+    :param dump_in_background: dump the weights on a background thread, so that calls never wait for disk I/O.  If dump_period is given the weights are dumped at that interval rather than every dump_interval retries
+
+    If the decorated function is a coroutine function, the wrapper is also a coroutine function.
+    It awaits the function and uses asyncio.sleep for the back-off, so concurrent calls share the event loop (and the agent).
+
+    :param clock: where the time comes from and how to sleep.  Pass a VirtualClock to run in simulated time (see simulation.py).
+        The async wrapper sleeps with asyncio.sleep, so run it on a VirtualTimeEventLoop too
+    :param transition_log: record every (state, action, reward, next_state, duration) transition, eg. to a TransitionLog,
+        so that weights can be trained offline from them (see training.py)
+    :param telemetry_capacity: keep the most recent transitions in agent.telemetry, see telemetry.py
+    :param metrics: count calls, retries and their latency in a RetryMetrics, see metrics.py
+    :param actions: the back-offs to choose between instead of the RETRY Actions, eg. backoff_ladder(timedelta(milliseconds=50), timedelta(seconds=60), 12)
+        for a geometric ladder of absolute back-offs, or Backoff(fraction, relative=True) for fractions of timeout.  ABRT is always included
+    :param strategy: choose actions with eg. UCB1(), ThompsonSampling() or DecayingEpsilonGreedy() (see strategies.py) rather than
+        epsilon-greedy.  epsilon is ignored if it is given
+    :param max_states: bound the number of states (eg. if state_func includes an endpoint or tenant), evicting the least recently used.
+        States which haven't been used for state_ttl are evicted too.  Evicted states are added into the fold_evicted_into state if it is given,
+        see bounded_table.py
+    :param min_state_samples: state_func may return a structured state, a tuple from coarsest to finest level (eg. (e.__class__.__name__, e.status, e.host)).
+        If min_state_samples is given, every level learns from each retry, and actions are chosen from the finest level which has been tried at least
+        min_state_samples times, so rare states use the estimates of the states they belong to rather than exploring from scratch
+    :param max_hedge_fraction: if actions includes any Hedge, launch duplicate attempts for at most this fraction of attempts.
+        The hedges of sync attempts run on hedge_executor (default: a ThreadPoolExecutor), see hedging.py
+    :param deadline_kwarg: pass the time left before the timeout to the function, as a timedelta keyword argument with this name
+        (eg. "deadline" for func(..., deadline=timedelta(...))), so that it can limit its own timeouts to fit.
+
+    The back-off of each retry happens before the attempt, and is cut short rather than sleeping past the timeout
+
+    :param circuit_breaker: a CircuitBreaker, which fails calls fast (with RLRetryCircuitOpen) without calling the function
+        once the agent has learned to abort in a state which keeps failing, see circuit_breaker.py
     """
     initial_value = 1 if optimistic_initial_values else 0.0
 
@@ -342,43 +1328,270 @@ def rlretry(
         raise_original_exception if raise_primary_exception else raise_rlexception
     )
 
+    def keyed_state_func(e: Exception):
+        return state_key(state_func(e))
+
     def decorator_no_args(
         func: Callable, return_agent: bool = False
     ) -> Union[Callable, Tuple[Callable, RLAgent]]:
         agent = RLAgent(
-            epsilon, weight_loader, weight_dumper, initial_value, alpha, dump_interval
+            epsilon,
+            weight_loader,
+            weight_dumper,
+            initial_value,
+            alpha,
+            dump_interval,
+            thread_safe=thread_safe,
+            reward_batch_size=reward_batch_size,
+            shared_memory_name=shared_memory_name,
+            shared_memory_capacity=shared_memory_capacity,
+            weight_store=weight_store,
+            dump_in_background=dump_in_background,
+            dump_period=dump_period,
+            telemetry_capacity=telemetry_capacity,
+            actions=actions,
+            strategy=strategy,
+            max_states=max_states,
+            state_ttl=state_ttl,
+            fold_evicted_into=fold_evicted_into,
+            clock=clock,
+            min_state_samples=min_state_samples,
         )
 
+        hedger = None
+        if actions is not None and any(isinstance(a, Hedge) for a in actions):
+            from .hedging import Hedger
+
+            hedger = Hedger(max_hedge_fraction, executor=hedge_executor, clock=clock)
+
+        monotonic = clock.monotonic
+        timeout_seconds = timeout.total_seconds()
+
+        def attempt(start_time, args, kwargs) -> Callable:
+            """
+            a function which calls func with the arguments, and the time left before the timeout as deadline_kwarg
+            """
+            if deadline_kwarg is None:
+                return functools.partial(func, *args, **kwargs)
+
+            def call():
+                remaining = start_time + timeout_seconds - monotonic()
+                kwargs[deadline_kwarg] = timedelta(seconds=max(0.0, remaining))
+                return func(*args, **kwargs)
+
+            return call
+
         def wrapper(*args, **kwargs):
-            start_time = datetime.utcnow()
+            start_time = monotonic()
+            if circuit_breaker is None:
+                return call(start_time, args, kwargs)
+            if not circuit_breaker.allow():
+                return fail_fast(start_time)
+            probing = circuit_breaker.state == circuit_breaker.HALF_OPEN
+            try:
+                return call(start_time, args, kwargs)
+            finally:
+                if probing:
+                    # the probe was cancelled or interrupted before it could report back
+                    circuit_breaker.abandon_probe()
+
+        def call(start_time, args, kwargs):
+            if deadline_kwarg is not None:
+                kwargs[deadline_kwarg] = timeout
+            try:
+                retval = func(*args, **kwargs)
+            except Exception as e:
+                first_exception = e
+                current_state = keyed_state_func(e)
+                if hedger is not None:
+                    hedger.record(None)
+            else:
+                if hedger is not None:
+                    # the latencies which Hedge actions take percentiles of
+                    hedger.record(monotonic() - start_time)
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                if metrics is not None:
+                    metrics.record_call("success", monotonic() - start_time)
+                return retval
+            # it didn't work first time, so now set up the RL stuff
+            return retry(start_time, first_exception, current_state, args, kwargs)
+
+        def learn(
+            previous_state, action, explored, reward, current_state, duration, sleep
+        ):
+            agent.apply_reward(previous_state, action, reward)
+            if agent.telemetry is not None:
+                agent.record_transition(
+                    previous_state,
+                    action,
+                    explored,
+                    reward,
+                    sleep,
+                    current_state,
+                )
+            if transition_log is not None:
+                transition_log.record(
+                    previous_state, action, reward, current_state, duration
+                )
+            if metrics is not None:
+                metrics.record_retry(previous_state, action)
+
+        def finish(outcome, start_time, slept, environment, aborted_state=None):
+            if metrics is not None:
+                metrics.record_call(outcome, monotonic() - start_time, slept)
+            if outcome == "success":
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                return environment.func_retval
+            if circuit_breaker is not None:
+                if aborted_state is None:
+                    circuit_breaker.record_failure(environment.last_exception)
+                else:
+                    circuit_breaker.record_failure(
+                        environment.last_exception,
+                        aborted_state,
+                        *agent.abort_margin(aborted_state),
+                    )
+            if outcome == "timeout":
+                error = RLRetryTimeout()
+            elif outcome == "abort":
+                error = RLRetryAbort(
+                    f"encountered a state in which RLRetry thinks it is not worth continuing {aborted_state}",
+                )
+            else:
+                error = RLRetryMaxRetries()
+            raise_exception(error, environment.last_exception)
+
+        def fail_fast(start_time):
+            if metrics is not None:
+                metrics.record_call("circuit_open", monotonic() - start_time)
+            error = RLRetryCircuitOpen(
+                f"the circuit breaker opened in state {circuit_breaker.tripped_state}, "
+                f"the next call will be let through in {circuit_breaker.retry_in():.1f}s"
+            )
+            last_exception = circuit_breaker.last_exception
+            if raise_primary_exception:
+                # raising the stored exception would add to its traceback on every call, and every thread shares it
+                try:
+                    last_exception = copy.copy(last_exception).with_traceback(None)
+                except Exception:
+                    raise error from last_exception
+            raise_exception(error, last_exception)
+
+        def retry(start_time, first_exception, current_state, args, kwargs):
             environment = RLEnvironment(
-                lambda: func(*args, **kwargs),
+                attempt(start_time, args, kwargs),
                 timeout,
-                state_func=state_func,
+                state_func=keyed_state_func,
+                clock=clock,
+                hedger=hedger,
+                deadline=start_time + timeout_seconds,
             )
-            current_state = environment.run_func()
-            # if it works first time, then we don't have to do any RL stuff
-            if current_state == "success":
-                return environment.func_retval
+            environment.last_exception = first_exception
+            slept = 0.0
 
             for _ in range(max_retries):
-                if datetime.utcnow() - start_time > timeout:
-                    raise_exception(RLRetryTimeout(), environment.last_exception)
-                action = agent.choose_action(current_state)
+                if monotonic() - start_time > timeout_seconds:
+                    return finish("timeout", start_time, slept, environment)
+                action, explored = agent.select_action(current_state)
                 previous_state = current_state
+                action_start = monotonic()
                 current_state, reward = environment.execute_action(action)
-                agent.apply_reward(previous_state, action, reward)
-                if current_state == "success":
-                    return environment.func_retval
+                slept += environment.slept
+                learn(
+                    previous_state,
+                    action,
+                    explored,
+                    reward,
+                    current_state,
+                    monotonic() - action_start,
+                    environment.slept,
+                )
+                if current_state in ("success", "timeout"):
+                    return finish(current_state, start_time, slept, environment)
                 elif current_state == "abort":
-                    raise_exception(
-                        RLRetryAbort(
-                            f"encountered a state in which RLRetry thinks it is not worth continuing {previous_state}",
-                        ),
-                        environment.last_exception,
+                    return finish(
+                        "abort", start_time, slept, environment, previous_state
                     )
 
-            raise_exception(RLRetryMaxRetries(), environment.last_exception)
+            return finish("max_retries", start_time, slept, environment)
+
+        async def async_wrapper(*args, **kwargs):
+            start_time = monotonic()
+            if circuit_breaker is None:
+                return await call_async(start_time, args, kwargs)
+            if not circuit_breaker.allow():
+                return fail_fast(start_time)
+            probing = circuit_breaker.state == circuit_breaker.HALF_OPEN
+            try:
+                return await call_async(start_time, args, kwargs)
+            finally:
+                if probing:
+                    circuit_breaker.abandon_probe()
+
+        async def call_async(start_time, args, kwargs):
+            if deadline_kwarg is not None:
+                kwargs[deadline_kwarg] = timeout
+            try:
+                retval = await func(*args, **kwargs)
+            except Exception as e:
+                first_exception = e
+                current_state = keyed_state_func(e)
+                if hedger is not None:
+                    hedger.record(None)
+            else:
+                if hedger is not None:
+                    hedger.record(monotonic() - start_time)
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                if metrics is not None:
+                    metrics.record_call("success", monotonic() - start_time)
+                return retval
+            return await retry_async(
+                start_time, first_exception, current_state, args, kwargs
+            )
+
+        async def retry_async(start_time, first_exception, current_state, args, kwargs):
+            environment = RLEnvironment(
+                attempt(start_time, args, kwargs),
+                timeout,
+                state_func=keyed_state_func,
+                clock=clock,
+                hedger=hedger,
+                deadline=start_time + timeout_seconds,
+            )
+            environment.last_exception = first_exception
+            slept = 0.0
+
+            for _ in range(max_retries):
+                if monotonic() - start_time > timeout_seconds:
+                    return finish("timeout", start_time, slept, environment)
+                action, explored = agent.select_action(current_state)
+                previous_state = current_state
+                action_start = monotonic()
+                current_state, reward = await environment.execute_action_async(action)
+                slept += environment.slept
+                learn(
+                    previous_state,
+                    action,
+                    explored,
+                    reward,
+                    current_state,
+                    monotonic() - action_start,
+                    environment.slept,
+                )
+                if current_state in ("success", "timeout"):
+                    return finish(current_state, start_time, slept, environment)
+                elif current_state == "abort":
+                    return finish(
+                        "abort", start_time, slept, environment, previous_state
+                    )
+
+            return finish("max_retries", start_time, slept, environment)
+
+        if inspect.iscoroutinefunction(func):
+            wrapper = async_wrapper
 
         if return_agent:
             return wrapper, agent
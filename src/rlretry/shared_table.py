@@ -0,0 +1,304 @@
+"""
+A StateActionMap whose Q-values and counts live in a named shared memory segment,
+so that every process on a host reads and updates the same table.
+
+POSIX only (locking uses fcntl.flock).
+"""
+from __future__ import annotations
+from contextlib import contextmanager
+import fcntl
+from multiprocessing import resource_tracker, shared_memory
+import os
+import random
+import sys
+import tempfile
+import threading
+import zlib
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .rlretry import Action, StateActionMap, log
+
+_MAGIC = 0x726C7274
+# header is [magic, capacity, num_actions, num_states, actions_hash]
+_HEADER_SIZE = 5
+KEY_BYTES = 128
+
+
+def _actions_hash(actions: List) -> int:
+    # hash() is salted per process, so use a stable checksum of the action names
+    return zlib.crc32(",".join(action.name for action in actions).encode("utf-8"))
+
+
+def _segment_size(capacity: int, num_actions: int) -> int:
+    return (
+        _HEADER_SIZE * 8 + capacity * KEY_BYTES + 2 * capacity * num_actions * 8
+    )
+
+
+class SharedStateActionMap(StateActionMap):
+    """
+    A fixed capacity Q-table in shared memory.
+
+    The first process to use a segment name creates it and seeds it from weight_loader,
+    later processes (including forked workers) attach to it without loading anything.
+    States must be strings of at most KEY_BYTES bytes when utf-8 encoded.
+    Once capacity states exist, rewards for new states are dropped (and a warning logged).
+
+    The segment outlives the processes using it, call unlink() to remove it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        weight_loader: Callable[[], Tuple[pd.DataFrame, pd.DataFrame]],
+        initial_value: float = 0.0,
+        alpha: Union[float, None, Callable[[int], float]] = 0.0,
+        capacity: int = 1024,
+        actions: Optional[List] = None,
+        keep_last_saved: bool = True,
+    ):
+        self._initial_value = initial_value
+        self._keep_last_saved = keep_last_saved
+
+        if callable(alpha):
+            self._alpha = alpha
+        elif isinstance(alpha, float):
+            self._alpha = lambda _: alpha
+        else:
+            self._alpha = None
+
+        self._name = name
+        self._actions = list(Action) if actions is None else list(actions)
+        self._columns = {action: i for i, action in enumerate(self._actions)}
+        self._states: List[str] = []
+        self._rows = {}
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"rlretry-{name}.lock")
+        self._open_locks()
+
+        with self._locked():
+            try:
+                self._shm = self._open_segment(
+                    create=True, size=_segment_size(capacity, len(self._actions))
+                )
+                self._map_segment(capacity)
+                self._header[:] = [
+                    _MAGIC,
+                    capacity,
+                    len(self._actions),
+                    0,
+                    _actions_hash(self._actions),
+                ]
+                self._seed(*weight_loader())
+            except FileExistsError:
+                self._shm = self._open_segment(create=False)
+                header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=self._shm.buf)
+                if (
+                    header[0] != _MAGIC
+                    or header[2] != len(self._actions)
+                    or header[4] != _actions_hash(self._actions)
+                ):
+                    raise ValueError(
+                        f"shared memory segment {name} does not hold a table with the actions {self._actions}"
+                    )
+                self._map_segment(int(header[1]))
+            self._sync_states()
+
+        self.update_last_saved()
+
+    def _open_segment(self, create: bool, size: int = 0) -> shared_memory.SharedMemory:
+        # the segment is shared by many processes, so don't let whichever one exits first remove it
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(
+                name=self._name, create=create, size=size, track=False
+            )
+        shm = shared_memory.SharedMemory(name=self._name, create=create, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    def _map_segment(self, capacity: int):
+        buf = self._shm.buf
+        num_actions = len(self._actions)
+        offset = 0
+        self._header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=buf)
+        offset += _HEADER_SIZE * 8
+        self._keys = np.ndarray((capacity,), dtype=f"S{KEY_BYTES}", buffer=buf, offset=offset)
+        offset += capacity * KEY_BYTES
+        self._q = np.ndarray((capacity, num_actions), dtype=np.float64, buffer=buf, offset=offset)
+        offset += capacity * num_actions * 8
+        self._counts = np.ndarray((capacity, num_actions), dtype=np.int64, buffer=buf, offset=offset)
+        # the cells this process has changed since it last dumped them
+        self._dirty = np.zeros((capacity, num_actions), dtype=bool)
+
+    def _open_locks(self):
+        self._pid = os.getpid()
+        # flock only excludes other processes, threads in this process are excluded by the RLock
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = open(self._lock_path, "a")
+
+    @contextmanager
+    def _locked(self):
+        # a forked child shares the parent's open lock file, which would make flock a no-op between them
+        if os.getpid() != self._pid:
+            self._open_locks()
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _seed(self, df: Optional[pd.DataFrame], counts_df: Optional[pd.DataFrame]):
+        if df is None or df.empty:
+            return
+        df = df.reindex(columns=self._actions)
+        counts_df = (
+            None
+            if counts_df is None or counts_df.empty
+            else counts_df.reindex(index=df.index, columns=self._actions)
+        )
+        for state in df.index:
+            row = self.create_state(state)
+            if row is None:
+                break
+            q = df.loc[state].to_numpy(dtype=np.float64, na_value=np.nan)
+            self._q[row] = np.where(np.isnan(q), float(self._initial_value), q)
+            if counts_df is not None:
+                self._counts[row] = counts_df.loc[state].to_numpy(
+                    dtype=np.float64, na_value=0
+                ).astype(np.int64)
+        # the seeded weights have already been saved
+        self._dirty[:] = False
+
+    def _sync_states(self):
+        """
+        pick up states which other processes have added since we last looked
+        """
+        num_states = int(self._header[3])
+        for row in range(len(self._states), num_states):
+            state = self._keys[row].decode("utf-8")
+            self._states.append(state)
+            self._rows[state] = row
+
+    def _row(self, state) -> Optional[int]:
+        row = self._rows.get(state)
+        if row is None and int(self._header[3]) > len(self._states):
+            self._sync_states()
+            row = self._rows.get(state)
+        return row
+
+    # other processes change the table, so the greedy action and exploration weights can't be cached locally
+    def _refresh_rows(self, rows: np.ndarray):
+        pass
+
+    def randomish_action(self, state: str) -> Action:
+        row = self._row(state)
+        if row is None:
+            return random.choice(self._actions[1:])
+        weights = 1 / np.log(2 + self._counts[row, 1:])
+        return random.choices(self._actions[1:], weights=weights.tolist())[0]
+
+    def best_action(self, state) -> Action:
+        row = self._row(state)
+        if row is None:
+            return random.choice(self._actions)
+        return self._actions[int(self._q[row].argmax())]
+
+    def create_state(self, state: str) -> Optional[int]:
+        key = state.encode("utf-8")
+        if len(key) > KEY_BYTES:
+            raise ValueError(f"state {state!r} is longer than {KEY_BYTES} bytes")
+
+        with self._locked():
+            self._sync_states()
+            row = self._rows.get(state)
+            if row is None:
+                row = len(self._states)
+                if row == self._keys.shape[0]:
+                    log.warning(
+                        f"shared state action map {self._name} is full, not recording state {state}"
+                    )
+                    return None
+                self._keys[row] = key
+
+            # always set ABRT to have a reward of 1, regardless of other settings.
+            self._q[row, 0] = 1.0
+            self._q[row, 1:] = float(self._initial_value)
+            self._counts[row] = 0
+            self._dirty[row] = True
+
+            # publish the row to other processes once it is filled in
+            self._header[3] = max(int(self._header[3]), row + 1)
+            self._sync_states()
+            return row
+
+    def update_average_reward(self, state: str, action: Action, new_reward: float):
+        with self._locked():
+            row = self._row(state)
+            if row is None:
+                row = self.create_state(state)
+                if row is None:
+                    return
+            col = self._columns[action]
+            count = int(self._counts[row, col])
+            value_delta = new_reward - self._q[row, col]
+            if self._alpha is not None:
+                value_delta *= self._alpha(count)
+            else:
+                value_delta /= count + 1
+
+            self._q[row, col] += value_delta
+            self._counts[row, col] = count + 1
+            self._dirty[row, col] = True
+
+    def update_average_rewards(self, rewards: Iterable[Tuple[str, Action, float]]):
+        # take the lock once for the whole batch
+        with self._locked():
+            super().update_average_rewards(rewards)
+
+    def set_cells(self, df: pd.DataFrame, counts_df: pd.DataFrame):
+        with self._locked():
+            super().set_cells(df, counts_df)
+
+    def snapshot(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        with self._locked():
+            self._sync_states()
+            return super().snapshot()
+
+    def pop_changes(self) -> Tuple[List, List, np.ndarray, np.ndarray]:
+        with self._locked():
+            self._sync_states()
+            return super().pop_changes()
+
+    def update_last_saved(
+        self, snapshot: Optional[Tuple[List, List, np.ndarray, np.ndarray]] = None
+    ):
+        super().update_last_saved(self.snapshot() if snapshot is None else snapshot)
+
+    def _load(self, df: Optional[pd.DataFrame], counts_df: Optional[pd.DataFrame]):
+        raise NotImplementedError(
+            "the shared table cannot be replaced, update it with update_average_reward()"
+        )
+
+    def close(self):
+        self._header = self._keys = self._q = self._counts = None
+        self._shm.close()
+        self._lock_file.close()
+
+    def unlink(self):
+        """
+        remove the shared memory segment.  Processes which still have it open can carry on using it
+        """
+        if sys.version_info < (3, 13):
+            # unlink() unregisters the segment from the resource tracker, so it must be registered first
+            resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+        if os.path.exists(self._lock_path):
+            os.unlink(self._lock_path)
@@ -0,0 +1,217 @@
+"""
+Run rlretry and auto_request_interval against simulated failures in virtual time.
+
+A day of traffic takes seconds, so policies can be evaluated, compared and pre-trained before they are deployed.
+
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock)
+
+    @rlretry(clock=simulator.clock, weight_dumper=...)
+    async def call(parameter):
+        return await server.request_async(parameter)
+
+    result = simulator.run_traffic(call, duration=timedelta(days=1), interval=timedelta(seconds=1))
+
+Coroutine functions run concurrently on a VirtualTimeEventLoop.  Plain functions are called one after another
+(run_traffic_sync), with the clock moving forward whenever they sleep.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import Counter, deque
+from datetime import datetime, timedelta
+import random
+import string
+from typing import Awaitable, Callable, Coroutine, Deque, Dict, NamedTuple
+
+from .clock import VirtualClock, VirtualTimeEventLoop
+
+# These mirror the failures in examples/mock_server.py
+
+
+# returned every time for certain parameter values (like an HTTP 404 or 500)
+class RepeatableFailure(RuntimeError):
+    pass
+
+
+# returned with low probablity for any request (like an HTTP 504)
+class RandomFailure(RuntimeError):
+    pass
+
+
+# returned for every request during a regular outage (like a 502)
+class ClusteredFailure(RuntimeError):
+    pass
+
+
+# returned when there have been too many requests in a time window (like a 429)
+class TooBusyFailure(RuntimeError):
+    pass
+
+
+class SimulatedServer:
+    """
+    A server which fails in the same ways as examples/mock_server.py, in the time of the given clock
+    """
+
+    def __init__(
+        self,
+        clock: VirtualClock,
+        random_failure_rate: float = 0.02,
+        outage_period: timedelta = timedelta(minutes=5),
+        outage_duration: timedelta = timedelta(seconds=30),
+        rate_limit: int = 100,
+        rate_limit_window: timedelta = timedelta(seconds=60),
+        repeatable_failure_prefix: str = "k",
+    ):
+        self._clock = clock
+        self._start = clock.now()
+        self.random_failure_rate = random_failure_rate
+        self.outage_period = outage_period
+        self.outage_duration = outage_duration
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.repeatable_failure_prefix = repeatable_failure_prefix
+        self._request_times: Deque[datetime] = deque(maxlen=rate_limit)
+        self.requests = 0
+
+    def is_outage(self) -> bool:
+        return (
+            self._clock.now() - self._start
+        ) % self.outage_period < self.outage_duration
+
+    def is_too_busy(self) -> bool:
+        now = self._clock.now()
+        self._request_times.append(now)
+        if len(self._request_times) >= self.rate_limit:
+            n_requests_ago = self._request_times.popleft()
+            return now - n_requests_ago < self.rate_limit_window
+        return False
+
+    def request(self, parameter: str = "") -> bool:
+        self.requests += 1
+        if random.random() < self.random_failure_rate:
+            raise RandomFailure()
+        if self.is_outage():
+            raise ClusteredFailure()
+        if self.is_too_busy():
+            raise TooBusyFailure()
+        if self.repeatable_failure_prefix and parameter.startswith(
+            self.repeatable_failure_prefix
+        ):
+            raise RepeatableFailure()
+        return True
+
+    async def request_async(self, parameter: str = "") -> bool:
+        return self.request(parameter)
+
+
+def random_parameter() -> str:
+    return "".join(random.choices(string.ascii_lowercase, k=6))
+
+
+class SimulationResult(NamedTuple):
+    calls: int
+    successes: int
+    # the number of calls which raised each exception class
+    failures: Dict[str, int]
+    # in virtual seconds
+    mean_latency: float
+    duration: timedelta
+
+    @property
+    def success_rate(self) -> float:
+        return self.successes / self.calls if self.calls else 0.0
+
+
+class Simulator:
+    def __init__(self, start: datetime = datetime(2000, 1, 1)):
+        self.clock = VirtualClock(start)
+
+    def run(self, coro: Coroutine):
+        """
+        run a coroutine to completion in virtual time
+        """
+        loop = VirtualTimeEventLoop(self.clock)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def run_traffic(
+        self,
+        call: Callable[[str], Awaitable],
+        duration: timedelta,
+        interval: timedelta,
+        poisson: bool = False,
+        parameter_func: Callable[[], str] = random_parameter,
+    ) -> SimulationResult:
+        """
+        start call(parameter_func()) every interval (or at exponentially distributed intervals with that mean
+        if poisson is set) for duration, without waiting for earlier calls to finish
+        """
+
+        async def traffic() -> SimulationResult:
+            loop = asyncio.get_running_loop()
+            latencies = []
+            failures: Counter = Counter()
+
+            async def timed_call():
+                start = loop.time()
+                try:
+                    await call(parameter_func())
+                except Exception as e:
+                    failures[e.__class__.__name__] += 1
+                latencies.append(loop.time() - start)
+
+            start = loop.time()
+            tasks = set()
+            while loop.time() - start < duration.total_seconds():
+                task = loop.create_task(timed_call())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                gap = interval.total_seconds()
+                await asyncio.sleep(random.expovariate(1 / gap) if poisson else gap)
+            if tasks:
+                await asyncio.wait(tasks)
+
+            return SimulationResult(
+                calls=len(latencies),
+                successes=len(latencies) - sum(failures.values()),
+                failures=dict(failures),
+                mean_latency=sum(latencies) / len(latencies) if latencies else 0.0,
+                duration=timedelta(seconds=loop.time() - start),
+            )
+
+        return self.run(traffic())
+
+    def run_traffic_sync(
+        self,
+        call: Callable[[str], object],
+        duration: timedelta,
+        interval: timedelta,
+        parameter_func: Callable[[], str] = random_parameter,
+    ) -> SimulationResult:
+        """
+        call(parameter_func()) repeatedly for duration, waiting interval after each call returns.
+        call should sleep with this simulator's clock (eg. rlretry(clock=simulator.clock))
+        """
+        latencies = []
+        failures: Counter = Counter()
+        start = self.clock.monotonic()
+        while self.clock.monotonic() - start < duration.total_seconds():
+            call_start = self.clock.monotonic()
+            try:
+                call(parameter_func())
+            except Exception as e:
+                failures[e.__class__.__name__] += 1
+            latencies.append(self.clock.monotonic() - call_start)
+            self.clock.sleep(interval.total_seconds())
+
+        return SimulationResult(
+            calls=len(latencies),
+            successes=len(latencies) - sum(failures.values()),
+            failures=dict(failures),
+            mean_latency=sum(latencies) / len(latencies) if latencies else 0.0,
+            duration=timedelta(seconds=self.clock.monotonic() - start),
+        )
@@ -0,0 +1,120 @@
+"""
+Ways for the agent to choose between exploring and taking the best known action.
+
+Pass one to rlretry (or RLAgent) as strategy.  Each has a select(table, state) method which returns the chosen
+action and whether it was chosen to explore, reading the averages and counts the table already keeps.
+
+See benchmarks/compare_strategies.py for how they compare on the simulated failure scenarios.
+"""
+
+from __future__ import annotations
+import math
+import random
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .rlretry import StateActionMap, log
+
+
+class EpsilonGreedy:
+    """
+    explore with probability epsilon, preferring the actions which have been tried least (the default)
+    """
+
+    def __init__(self, epsilon: float = 0.1):
+        self.epsilon = epsilon
+
+    def select(self, table: StateActionMap, state) -> Tuple[object, bool]:
+        return EpsilonGreedy._select(table, state, self.epsilon)
+
+    @staticmethod
+    def _select(table: StateActionMap, state, epsilon: float) -> Tuple[object, bool]:
+        if random.random() < epsilon:
+            log.debug("agent choosing random action")
+            return table.randomish_action(state), True
+        return table.best_action(state), False
+
+
+class DecayingEpsilonGreedy(EpsilonGreedy):
+    """
+    epsilon-greedy, where epsilon for each state falls from initial towards minimum as the state is visited,
+    halving after half_life visits
+    """
+
+    def __init__(
+        self, initial: float = 0.5, minimum: float = 0.01, half_life: int = 50
+    ):
+        super().__init__(initial)
+        self.initial = initial
+        self.minimum = minimum
+        self.half_life = half_life
+
+    def select(self, table: StateActionMap, state) -> Tuple[object, bool]:
+        row = table._row(state)
+        if row is None:
+            return random.choice(table._actions[1:]), True
+        return EpsilonGreedy._select(
+            table, state, self.state_epsilon(int(table._counts[row].sum()))
+        )
+
+    def state_epsilon(self, visits: int) -> float:
+        # not stored on self, the strategy may be choosing for several states at once
+        return max(
+            self.minimum, self.initial * self.half_life / (self.half_life + visits)
+        )
+
+
+class UCB1:
+    """
+    try every action once, then choose the one with the highest upper confidence bound
+    average + c * sqrt(ln(visits to the state) / tries of the action).
+    ABRT always gets the same reward, so it gets no bonus
+    """
+
+    def __init__(self, c: float = 1.0):
+        self.c = c
+
+    def select(self, table: StateActionMap, state) -> Tuple[object, bool]:
+        actions = table._actions
+        row = table._row(state)
+        if row is None:
+            return random.choice(actions[1:]), True
+
+        counts = table._counts[row]
+        q = table._q[row]
+        untried = np.flatnonzero(counts[1:] == 0)
+        if untried.size:
+            return actions[1 + int(random.choice(untried))], True
+
+        bonus = np.zeros(len(q))
+        bonus[1:] = self.c * np.sqrt(math.log(counts.sum()) / counts[1:])
+        choice = int((q + bonus).argmax())
+        return actions[choice], choice != int(q.argmax())
+
+
+class ThompsonSampling:
+    """
+    sample each action's average reward from a normal posterior, with standard deviation
+    sigma / sqrt(tries + 1), and choose the action with the highest sample
+    """
+
+    def __init__(self, sigma: float = 1.0, seed: Optional[int] = None):
+        self.sigma = sigma
+        self._rng = np.random.default_rng(seed)
+
+    def select(self, table: StateActionMap, state) -> Tuple[object, bool]:
+        actions = table._actions
+        row = table._row(state)
+        if row is None:
+            return random.choice(actions[1:]), True
+
+        counts = table._counts[row]
+        q = table._q[row]
+        samples = q + self.sigma * self._rng.standard_normal(len(q)) / np.sqrt(
+            counts + 1
+        )
+        # ABRT's reward is known
+        samples[0] = q[0]
+        choice = int(samples.argmax())
+        return actions[choice], choice != int(q.argmax())
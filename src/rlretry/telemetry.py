@@ -0,0 +1,208 @@
+"""
+A bounded record of the agent's recent decisions, for watching what the policy does in production.
+
+    wrapped, agent = rlretry(telemetry_capacity=4096)(func, return_agent=True)
+    streamer = TelemetryStreamer(agent.telemetry, jsonl_file_sink("/var/log/rlretry/telemetry.jsonl"))
+    streamer.start()
+
+Recording a transition writes one row of a preallocated array, nothing is formatted or written out on the
+calling thread.  Consumers read batches by cursor without blocking writers for longer than a copy, and if a
+consumer falls more than capacity transitions behind, the oldest transitions are overwritten and counted as dropped.
+"""
+
+from __future__ import annotations
+from datetime import timedelta
+import json
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+from .rlretry import Action, log
+
+TELEMETRY_DTYPE = np.dtype(
+    [
+        # wall clock, seconds since the epoch
+        ("time", "<f8"),
+        ("state", "<u4"),
+        ("action", "u1"),
+        # True if the action was chosen at random (epsilon), False if it was the greedy choice
+        ("explored", "?"),
+        ("reward", "<f8"),
+        # the back-off before the retry it led to, in seconds (clamped to the deadline)
+        ("sleep", "<f8"),
+        # the next state: "success", "abort" or another failure state
+        ("outcome", "<u4"),
+    ]
+)
+
+
+class TelemetryBatch(NamedTuple):
+    # records["state"] and records["outcome"] index into states
+    states: List
+    records: np.ndarray
+    # pass this to the next read()
+    cursor: int
+    # transitions which were overwritten before they were read
+    dropped: int
+    # records["action"] indexes into actions
+    actions: List
+
+    def to_dicts(self) -> Iterator[Dict]:
+        for record in self.records:
+            yield {
+                "time": float(record["time"]),
+                "state": self.states[record["state"]],
+                "action": self.actions[record["action"]].name,
+                "explored": bool(record["explored"]),
+                "reward": float(record["reward"]),
+                "sleep": float(record["sleep"]),
+                "outcome": self.states[record["outcome"]],
+            }
+
+
+class TransitionRingBuffer:
+    """
+    The last capacity transitions, in a preallocated array
+    """
+
+    def __init__(self, capacity: int = 4096):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._records = np.zeros(capacity, dtype=TELEMETRY_DTYPE)
+        self._states: List = []
+        self._state_ids = {}
+        self._actions: List = []
+        self._action_ids = {}
+        # the total number of transitions ever appended
+        self._written = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return len(self._records)
+
+    def _state_id(self, state) -> int:
+        state_id = self._state_ids.get(state)
+        if state_id is None:
+            state_id = self._state_ids[state] = len(self._states)
+            self._states.append(state)
+        return state_id
+
+    def _action_id(self, action) -> int:
+        action_id = self._action_ids.get(action)
+        if action_id is None:
+            action_id = self._action_ids[action] = len(self._actions)
+            self._actions.append(action)
+        return action_id
+
+    def append(
+        self,
+        state,
+        action: Action,
+        explored: bool,
+        reward: float,
+        sleep: float,
+        outcome,
+    ):
+        now = time.time()
+        with self._lock:
+            self._records[self._written % len(self._records)] = (
+                now,
+                self._state_id(state),
+                self._action_id(action),
+                explored,
+                reward,
+                sleep,
+                self._state_id(outcome),
+            )
+            self._written += 1
+
+    def read(
+        self, cursor: int = 0, max_records: Optional[int] = None
+    ) -> TelemetryBatch:
+        """
+        the transitions appended since cursor (oldest first).  Never waits for new transitions
+        """
+        capacity = len(self._records)
+        with self._lock:
+            written = self._written
+            start = max(cursor, written - capacity)
+            end = written if max_records is None else min(written, start + max_records)
+            positions = np.arange(start, end) % capacity
+            records = self._records[positions]
+            states = list(self._states)
+            actions = list(self._actions)
+        return TelemetryBatch(states, records, end, start - cursor, actions)
+
+
+def jsonl_file_sink(path: str) -> Callable[[TelemetryBatch], None]:
+    """
+    a sink which appends each transition to path as a JSON line
+    """
+
+    def sink(batch: TelemetryBatch):
+        with open(path, "a") as f:
+            for transition in batch.to_dicts():
+                f.write(json.dumps(transition) + "\n")
+
+    return sink
+
+
+class TelemetryStreamer:
+    """
+    Reads batches from a TransitionRingBuffer on a background thread and passes each one to sink
+    (eg. jsonl_file_sink, or a callback which ships them elsewhere)
+    """
+
+    def __init__(
+        self,
+        buffer: TransitionRingBuffer,
+        sink: Callable[[TelemetryBatch], None],
+        interval: timedelta = timedelta(seconds=1),
+        batch_size: int = 1024,
+    ):
+        self._buffer = buffer
+        self._sink = sink
+        self._interval = interval.total_seconds()
+        self._batch_size = batch_size
+        self._cursor = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def drain(self):
+        """
+        pass everything recorded so far to the sink
+        """
+        while True:
+            batch = self._buffer.read(self._cursor, self._batch_size)
+            self._cursor = batch.cursor
+            if batch.dropped:
+                log.warning(f"telemetry dropped {batch.dropped} transitions")
+            if len(batch.records) == 0:
+                return
+            self._sink(batch)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.drain()
+            except Exception:
+                log.exception("failed to stream telemetry")
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(
+            target=self._run, name="rlretry-telemetry", daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def close(self):
+        """
+        stop the background thread and drain what is left
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.drain()
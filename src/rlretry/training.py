@@ -0,0 +1,364 @@
+"""
+Offline training: record the transitions rlretry makes, then replay them into a Q-table in one vectorised batch.
+
+    transition_log = TransitionLog(f"/var/log/rlretry/{os.getpid()}.transitions")
+    @rlretry(transition_log=transition_log)
+
+and later, eg. before rolling out a new deployment
+
+    python -m rlretry.training /var/log/rlretry/*.transitions --output weights.pickle
+
+which writes a (df, counts_df) pickle for the new instances' weight_loader to return.
+
+Each transition is written as a fixed size binary record (state id, action, next state id, reward, duration),
+with the states themselves written once each, as JSON lines, to a .states file alongside.
+Actions are numbered in the order of list(Action), unless other actions (eg. Backoffs) are recorded,
+in which case their names are listed in a .actions file.
+"""
+
+from __future__ import annotations
+import argparse
+import atexit
+import json
+import os
+import pathlib
+import pickle
+import threading
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .rlretry import Action, action_from_name, default_alpha_func, log, with_abort
+
+TRANSITION_DTYPE = np.dtype(
+    [
+        ("state", "<u4"),
+        ("action", "u1"),
+        ("next_state", "<u4"),
+        ("reward", "<f8"),
+        ("duration", "<f8"),
+    ]
+)
+
+# the action ids of a log which has no .actions file
+DEFAULT_ACTIONS = list(Action)
+
+
+class Transitions(NamedTuple):
+    # records["state"] and records["next_state"] index into states
+    states: List
+    records: np.ndarray
+    # records["action"] indexes into actions
+    actions: List = DEFAULT_ACTIONS
+
+
+class TransitionLog:
+    """
+    An append-only log of (state, action, reward, next_state, duration) transitions.
+
+    Records are buffered and written every buffer_size transitions, on flush() and at exit.
+    Safe to share between threads, but each process should write to its own path.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], buffer_size: int = 1024):
+        self._path = pathlib.Path(path)
+        self._states_path = self._path.with_name(self._path.name + ".states")
+        self._actions_path = self._path.with_name(self._path.name + ".actions")
+        self._lock = threading.Lock()
+        self._buffer = np.zeros(buffer_size, dtype=TRANSITION_DTYPE)
+        self._buffered = 0
+        # carry on with the ids of an existing log
+        self._state_ids = {
+            state: i for i, state in enumerate(_read_states(self._states_path))
+        }
+        self._action_ids = {
+            action: i for i, action in enumerate(_read_actions(self._actions_path))
+        }
+        atexit.register(self.flush)
+
+    def _state_id(self, state) -> int:
+        state_id = self._state_ids.get(state)
+        if state_id is None:
+            state_id = len(self._state_ids)
+            # the state is written before any record which refers to it
+            with open(self._states_path, "a") as f:
+                f.write(json.dumps(state) + "\n")
+            self._state_ids[state] = state_id
+        return state_id
+
+    def _action_id(self, action) -> int:
+        action_id = self._action_ids.get(action)
+        if action_id is None:
+            action_id = len(self._action_ids)
+            if action_id > np.iinfo(TRANSITION_DTYPE["action"]).max:
+                raise ValueError("a transition log can hold at most 256 actions")
+            # until now the actions were numbered implicitly, so list them all
+            names = (
+                list(self._action_ids)
+                if action_id and not self._actions_path.exists()
+                else []
+            )
+            with open(self._actions_path, "a") as f:
+                for a in names + [action]:
+                    f.write(json.dumps(a.name) + "\n")
+            self._action_ids[action] = action_id
+        return action_id
+
+    def record(self, state, action: Action, reward: float, next_state, duration: float):
+        with self._lock:
+            self._buffer[self._buffered] = (
+                self._state_id(state),
+                self._action_id(action),
+                self._state_id(next_state),
+                reward,
+                duration,
+            )
+            self._buffered += 1
+            if self._buffered == len(self._buffer):
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._buffered == 0:
+            return
+        with open(self._path, "ab") as f:
+            f.write(self._buffer[: self._buffered].tobytes())
+        self._buffered = 0
+
+    def read(self) -> Transitions:
+        self.flush()
+        return read_transitions([self._path])
+
+
+def _read_states(states_path: pathlib.Path) -> List:
+    if not states_path.exists():
+        return []
+    with open(states_path) as f:
+        return [json.loads(line) for line in f if line.endswith("\n")]
+
+
+def _read_actions(actions_path: pathlib.Path) -> List:
+    if not actions_path.exists():
+        return list(DEFAULT_ACTIONS)
+    with open(actions_path) as f:
+        return [action_from_name(json.loads(line)) for line in f if line.endswith("\n")]
+
+
+def read_transitions(paths: Sequence[Union[str, pathlib.Path]]) -> Transitions:
+    """
+    read and concatenate the transitions in several logs (eg. one per process), in the order given
+    """
+    states: List = []
+    state_ids = {}
+    actions: List = []
+    action_ids = {}
+    all_records = []
+    for path in paths:
+        path = pathlib.Path(path)
+        records = np.fromfile(path, dtype=np.uint8)
+        usable = len(records) - len(records) % TRANSITION_DTYPE.itemsize
+        if usable != len(records):
+            log.warning(f"ignoring truncated record at the end of {path}")
+        records = records[:usable].view(TRANSITION_DTYPE).copy()
+
+        # map this log's state ids onto the combined ids
+        log_states = _read_states(path.with_name(path.name + ".states"))
+        remap = np.empty(len(log_states), dtype=np.uint32)
+        for i, state in enumerate(log_states):
+            if state not in state_ids:
+                state_ids[state] = len(states)
+                states.append(state)
+            remap[i] = state_ids[state]
+        records["state"] = remap[records["state"]]
+        records["next_state"] = remap[records["next_state"]]
+
+        log_actions = _read_actions(path.with_name(path.name + ".actions"))
+        action_remap = np.empty(len(log_actions), dtype=np.uint8)
+        for i, action in enumerate(log_actions):
+            if action not in action_ids:
+                action_ids[action] = len(actions)
+                actions.append(action)
+            action_remap[i] = action_ids[action]
+        records["action"] = action_remap[records["action"]]
+        all_records.append(records)
+
+    return Transitions(
+        states,
+        (
+            np.concatenate(all_records)
+            if all_records
+            else np.zeros(0, dtype=TRANSITION_DTYPE)
+        ),
+        actions,
+    )
+
+
+def _alpha_values(
+    alpha: Union[float, Callable[[int], float]], counts: np.ndarray
+) -> np.ndarray:
+    if not callable(alpha):
+        return np.full(len(counts), float(alpha))
+    # alpha functions need not be vectorised, so evaluate them once per distinct count
+    unique_counts, inverse = np.unique(counts, return_inverse=True)
+    return np.array([alpha(int(n)) for n in unique_counts], dtype=np.float64)[inverse]
+
+
+def train(
+    transitions: Transitions,
+    initial_value: float = 1.0,
+    alpha: Union[float, None, Callable[[int], float]] = default_alpha_func,
+    weights: Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]] = (None, None),
+    actions: Optional[Sequence] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    replay transitions onto weights (eg. what weight_loader returns), giving the same table as calling
+    StateActionMap.update_average_reward for each of them in order, with the same initial_value and alpha as rlretry
+
+    Each cell's updates q <- q + alpha(n) * (reward - q) are a chain of affine maps, so the final value is
+    q_start * prod(1 - alpha_i) + sum(alpha_i * reward_i * prod(1 - alpha_j for j after i)).  The products are
+    evaluated as cumulative sums of logs over the transitions sorted by cell, so there is no python loop per transition.
+
+    :param actions: the columns of the table (as passed to rlretry).  Transitions of other actions are ignored.
+        Default: the columns of weights (or every Action) and any other action in the transitions
+    """
+    df, counts_df = weights
+    records = transitions.records
+    if actions is None:
+        seen = [transitions.actions[i] for i in np.unique(records["action"])]
+        if df is not None and not df.empty:
+            actions = list(df.columns)
+        elif all(isinstance(a, Action) for a in seen):
+            actions = list(Action)
+        else:
+            actions = []
+        actions += [a for a in seen if a not in actions]
+    actions = with_abort(actions)
+    column_of = {action: i for i, action in enumerate(actions)}
+    action_columns = np.array(
+        [column_of.get(a, -1) for a in transitions.actions], dtype=np.int64
+    )
+    records = records[action_columns[records["action"]] >= 0]
+    trained_states = [transitions.states[i] for i in np.unique(records["state"])]
+
+    states = [] if df is None else list(df.index)
+    known_states = set(states)
+    states += [s for s in trained_states if s not in known_states]
+    row_of = {state: i for i, state in enumerate(states)}
+
+    # every cell starts out as StateActionMap.create_state would set it
+    q = np.full((len(states), len(actions)), float(initial_value))
+    q[:, 0] = 1.0
+    n = np.zeros((len(states), len(actions)), dtype=np.int64)
+    if df is not None and not df.empty:
+        loaded = df.reindex(columns=actions).to_numpy(dtype=np.float64, na_value=np.nan)
+        q[: len(df)] = np.where(np.isnan(loaded), q[: len(df)], loaded)
+        if counts_df is not None and not counts_df.empty:
+            n[: len(df)] = (
+                counts_df.reindex(index=df.index, columns=actions)
+                .to_numpy(dtype=np.float64, na_value=0)
+                .astype(np.int64)
+            )
+
+    if len(records):
+        # states which only ever appear as a next state (eg. "success") have no row
+        state_rows = np.array(
+            [row_of.get(s, -1) for s in transitions.states], dtype=np.int64
+        )
+        rows = state_rows[records["state"]]
+        cells = rows * len(actions) + action_columns[records["action"]]
+        # a stable sort keeps each cell's transitions in the order they happened
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        rewards = records["reward"][order]
+
+        num_cells = q.size
+        per_cell = np.bincount(cells, minlength=num_cells)
+        first = np.cumsum(per_cell) - per_cell
+        # the number of updates each transition's cell had before it
+        before = np.arange(len(cells)) - first[cells] + n.ravel()[cells]
+
+        flat_q = q.ravel()
+        if alpha is None:
+            reward_sums = np.bincount(cells, weights=rewards, minlength=num_cells)
+            n_start = n.ravel()
+            updated = per_cell > 0
+            flat_q[updated] = (
+                flat_q[updated] * n_start[updated] + reward_sums[updated]
+            ) / (n_start[updated] + per_cell[updated])
+        else:
+            alphas = _alpha_values(alpha, before)
+            # an alpha of 1 forgets everything before it, keep the logs finite
+            log_keep = np.log(np.maximum(1 - alphas, np.finfo(np.float64).tiny))
+            cumulative = np.cumsum(log_keep)
+            cell_totals = np.bincount(cells, weights=log_keep, minlength=num_cells)
+            cell_end = cumulative[first[cells] + per_cell[cells] - 1]
+            # prod(1 - alpha_j) over the later transitions of the same cell
+            keep_after = np.exp(cell_end - cumulative)
+            contributions = np.bincount(
+                cells, weights=alphas * rewards * keep_after, minlength=num_cells
+            )
+            updated = per_cell > 0
+            flat_q[updated] = (
+                flat_q[updated] * np.exp(cell_totals[updated]) + contributions[updated]
+            )
+        n += per_cell.reshape(n.shape)
+
+    return (
+        pd.DataFrame(q, index=states, columns=actions),
+        pd.DataFrame(n, index=states, columns=actions),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="train rlretry weights from transition logs"
+    )
+    parser.add_argument("logs", nargs="+", help="transition log files")
+    parser.add_argument(
+        "--output", required=True, help="write a (df, counts_df) pickle here"
+    )
+    parser.add_argument(
+        "--weights", help="a (df, counts_df) pickle to start from (default: untrained)"
+    )
+    parser.add_argument("--initial-value", type=float, default=1.0)
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=None,
+        help="a constant recency weighting (default: default_alpha_func)",
+    )
+    parser.add_argument(
+        "--plain-average",
+        action="store_true",
+        help="use the plain average of the rewards, ie. alpha=None",
+    )
+    args = parser.parse_args()
+
+    weights = (None, None)
+    if args.weights:
+        with open(args.weights, "rb") as f:
+            weights = pickle.load(f)
+    if args.plain_average:
+        alpha = None
+    elif args.alpha is not None:
+        alpha = args.alpha
+    else:
+        alpha = default_alpha_func
+
+    transitions = read_transitions(args.logs)
+    df, counts_df = train(transitions, args.initial_value, alpha, weights)
+    tmp_path = args.output + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((df, counts_df), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, args.output)
+    print(
+        f"trained {len(df)} states from {len(transitions.records)} transitions into {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.rlretry.rlretry import Action, StateActionMap
+
+
+@pytest.mark.parametrize("alpha", [0.3, None])
+def test_cached_greedy_action_and_weights_match_the_table(alpha):
+    random.seed(0)
+    sam = StateActionMap(None, None, 1.0, alpha)
+    states = [f"state{i}" for i in range(20)]
+    for _ in range(5000):
+        sam.update_average_reward(
+            random.choice(states), random.choice(list(Action)), random.uniform(-2, 3)
+        )
+
+        num_states = len(sam._states)
+        q = sam._q[:num_states]
+        counts = sam._counts[:num_states]
+        assert (sam._greedy[:num_states] == q.argmax(axis=1)).all()
+    np.testing.assert_allclose(
+        sam._cum_weights[:num_states], np.cumsum(1 / np.log(2 + counts[:, 1:]), axis=1)
+    )
+
+
+def test_randomish_action_draws_like_random_choices():
+    sam = StateActionMap(None, None, 1.0, 0.1)
+    for i, action in enumerate(list(Action)[1:]):
+        for _ in range(i * 10):
+            sam.update_average_reward("a", action, 0.0)
+    weights = (1 / np.log(2 + sam._counts[0, 1:])).tolist()
+
+    random.seed(1)
+    cached = [sam.randomish_action("a") for _ in range(200)]
+    random.seed(1)
+    expected = [
+        random.choices(list(Action)[1:], weights=weights)[0] for _ in range(200)
+    ]
+    assert cached == expected
+
+
+def test_set_cells_and_load_refresh_the_cache():
+    sam = StateActionMap(None, None, 0.0, 0.1)
+    sam.update_average_reward("a", Action.RETRY0, 0.5)
+    assert sam.best_action("a") == Action.ABRT
+
+    df = pd.DataFrame([[1.0, 2.0, 0.0, 0.0, 0.0]], index=["a"], columns=list(Action))
+    counts_df = pd.DataFrame([[0, 3, 0, 0, 0]], index=["a"], columns=list(Action))
+    sam.set_cells(df, counts_df)
+    assert sam.best_action("a") == Action.RETRY0
+
+    df.loc["a", Action.RETRY0_5] = 5.0
+    sam._df = df
+    assert sam.best_action("a") == Action.RETRY0_5
@@ -0,0 +1,88 @@
+import sys
+
+import pytest
+
+from src.rlretry.aggregation import AggregationClient, WeightAggregationServer
+from src.rlretry.rlretry import Action, RLAgent
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def server(request, tmp_path):
+    if request.param == "unix":
+        if sys.platform == "win32":
+            pytest.skip("unix sockets are not available")
+        address = str(tmp_path / "rlretry.sock")
+    else:
+        address = ("127.0.0.1", 0)
+    server = WeightAggregationServer(str(tmp_path / "weights.sqlite"), address)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def _agent(client: AggregationClient) -> RLAgent:
+    return RLAgent(
+        0.0,
+        weight_loader=client.load,
+        weight_dumper=client.dump,
+        alpha=None,
+        dump_interval=10**6,
+    )
+
+
+def test_agents_share_weights_through_the_server(server):
+    client1 = AggregationClient(server.server_address)
+    client2 = AggregationClient(server.server_address)
+    agent1 = _agent(client1)
+    agent2 = _agent(client2)
+
+    for _ in range(3):
+        agent1.apply_reward("TooBusy", Action.RETRY0_5, 2.0)
+    agent1.dump_weights()
+
+    for _ in range(1):
+        agent2.apply_reward("TooBusy", Action.RETRY0_5, 6.0)
+    agent2.apply_reward("RandomFailure", Action.RETRY0, 1.0)
+    agent2.dump_weights()
+
+    # agent2 took on the merged weights
+    df, counts_df = agent2._state_action_map.to_dataframes()
+    assert counts_df.loc["TooBusy", Action.RETRY0_5] == 4
+    assert df.loc["TooBusy", Action.RETRY0_5] == pytest.approx(3.0)
+
+    # agent1 only sends what it learned since its last push
+    agent1.apply_reward("TooBusy", Action.RETRY0_5, 3.0)
+    agent1.dump_weights()
+    df, counts_df = agent1._state_action_map.to_dataframes()
+    assert counts_df.loc["TooBusy", Action.RETRY0_5] == 5
+    assert df.loc["TooBusy", Action.RETRY0_5] == pytest.approx(3.0)
+    assert counts_df.loc["RandomFailure", Action.RETRY0] == 1
+
+    # a new agent starts from the merged weights
+    agent3 = _agent(AggregationClient(server.server_address))
+    assert agent3._state_action_map._counts_df.loc["TooBusy", Action.RETRY0_5] == 5
+    assert agent3._state_action_map.best_action("TooBusy") == Action.RETRY0_5
+
+
+def test_unreachable_server_keeps_unpushed_cells(server, tmp_path):
+    client = AggregationClient(str(tmp_path / "missing.sock") if isinstance(server.server_address, str) else ("127.0.0.1", 1))
+    agent = _agent(client)
+    agent.apply_reward("TooBusy", Action.RETRY0_5, 2.0)
+    agent.dump_weights()
+
+    # the server comes back
+    client._address = server.server_address
+    agent.dump_weights()
+
+    fresh = _agent(AggregationClient(server.server_address))
+    assert fresh._state_action_map._counts_df.loc["TooBusy", Action.RETRY0_5] == 1
+
+
+def test_empty_agent_dumps_to_an_empty_server(server):
+    client = AggregationClient(server.server_address)
+    agent = _agent(client)
+    agent.dump_weights()
+    # the agent carries on with its own (empty) table and still learns
+    agent.apply_reward("TooBusy", Action.RETRY0_5, 2.0)
+    agent.dump_weights()
+    assert agent._state_action_map._counts_df.loc["TooBusy", Action.RETRY0_5] == 1
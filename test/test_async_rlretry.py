@@ -0,0 +1,64 @@
+import asyncio
+from datetime import timedelta
+import inspect
+import random
+
+from src.rlretry.rlretry import RLRetryError, rlretry
+
+
+def test_async_wrapper_retries_until_success():
+    random.seed(0)
+    attempts = 0
+
+    async def flaky():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise RuntimeError("badness ocurred")
+        return "ok"
+
+    wrapped_func, agent = rlretry(
+        max_retries=10, timeout=timedelta(seconds=0.05), epsilon=0.0
+    )(flaky, return_agent=True)
+
+    assert inspect.iscoroutinefunction(wrapped_func)
+
+    # ABRT is one of the options for an unseen state, so keep calling until we get through
+    result = None
+    while result is None:
+        attempts = 0
+        try:
+            result = asyncio.run(wrapped_func())
+        except RLRetryError:
+            pass
+
+    assert result == "ok"
+    assert agent._state_action_map._counts_df.loc["RuntimeError"].sum() > 0
+
+
+def test_async_wrapper_shares_agent_between_concurrent_calls():
+    random.seed(0)
+
+    async def always_fails():
+        raise RuntimeError("badness ocurred")
+
+    wrapped_func, agent = rlretry(
+        max_retries=3, timeout=timedelta(seconds=0.01), epsilon=0.5
+    )(always_fails, return_agent=True)
+
+    async def main():
+        return await asyncio.gather(
+            *[wrapped_func() for _ in range(200)], return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(r, RLRetryError) for r in results)
+    counts = agent._state_action_map._counts_df.loc["RuntimeError"]
+    assert counts.sum() >= 200
+
+
+def test_sync_function_still_gets_sync_wrapper():
+    wrapped_func = rlretry()(lambda: 1)
+    assert not inspect.iscoroutinefunction(wrapped_func)
+    assert wrapped_func() == 1
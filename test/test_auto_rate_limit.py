@@ -0,0 +1,294 @@
+import asyncio
+from datetime import timedelta
+import inspect
+import random
+import threading
+import time
+
+import pytest
+
+from src.rlretry.auto_rate_limit import (
+    AsyncRequestPacer,
+    BisectionIntervalLearner,
+    RequestScheduler,
+    TokenBucket,
+    auto_request_interval,
+)
+from src.rlretry.clock import VirtualClock
+from src.rlretry.simulation import SimulatedServer, TooBusyFailure
+
+
+def test_async_pacer_spaces_concurrent_requests():
+    random.seed(0)
+    send_times = []
+
+    pacer = AsyncRequestPacer(
+        minimum=timedelta(seconds=0.01),
+        maximum=timedelta(seconds=0.03),
+        time_increment=timedelta(seconds=0.01),
+        epsilon=0.0,
+    )
+
+    @pacer
+    async def request(i: int) -> int:
+        send_times.append(asyncio.get_running_loop().time())
+        return i
+
+    async def main():
+        return await asyncio.gather(*[request(i) for i in range(20)])
+
+    assert asyncio.run(main()) == list(range(20))
+
+    gaps = [b - a for a, b in zip(send_times, send_times[1:])]
+    # allow for a little timer slop
+    assert min(gaps) >= 0.009
+    assert timedelta(seconds=0.01) <= pacer.current_interval <= timedelta(seconds=0.03)
+
+
+def test_async_auto_request_interval_reraises_failures():
+    random.seed(0)
+
+    @auto_request_interval(
+        minimum=timedelta(seconds=0.0),
+        maximum=timedelta(seconds=0.02),
+        time_increment=timedelta(seconds=0.01),
+        epsilon=0.0,
+    )
+    async def always_fails():
+        raise RuntimeError("too busy")
+
+    assert inspect.iscoroutinefunction(always_fails)
+
+    async def main():
+        return await asyncio.gather(
+            *[always_fails() for _ in range(5)], return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_sync_auto_request_interval_returns_and_reraises():
+    clock = VirtualClock()
+
+    @auto_request_interval(maximum=timedelta(seconds=2), epsilon=0.0, clock=clock)
+    def request(fail: bool):
+        if fail:
+            raise RuntimeError("too busy")
+        return "ok"
+
+    assert request(False) == "ok"
+    with pytest.raises(RuntimeError):
+        request(True)
+
+
+def test_invalid_grid_is_rejected():
+    with pytest.raises(ValueError):
+        auto_request_interval(
+            maximum=timedelta(seconds=1.5), time_increment=timedelta(seconds=1)
+        )
+
+
+def test_token_bucket_allows_bursts_at_the_same_average_rate():
+    clock = VirtualClock()
+    bucket = TokenBucket(burst=3, clock=clock)
+    interval = timedelta(seconds=2)
+    assert [bucket.take(interval) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(interval) == pytest.approx(2)
+    clock.advance(1)
+    assert bucket.take(interval) == pytest.approx(1)
+    clock.advance(1)
+    assert bucket.take(interval) == 0
+    # an idle period refills at most burst tokens
+    clock.advance(60)
+    assert [bucket.take(interval) > 0 for _ in range(4)] == [False] * 3 + [True]
+
+
+def test_sync_requests_are_spaced_in_virtual_time():
+    clock = VirtualClock()
+    send_times = []
+
+    @auto_request_interval(
+        minimum=timedelta(seconds=5),
+        maximum=timedelta(seconds=10),
+        time_increment=timedelta(seconds=5),
+        epsilon=0.0,
+        clock=clock,
+    )
+    def request():
+        send_times.append(clock.monotonic())
+
+    for _ in range(10):
+        request()
+    gaps = [b - a for a, b in zip(send_times, send_times[1:])]
+    assert gaps == [pytest.approx(5)] * 9
+
+
+def test_scheduler_spaces_requests_from_many_threads():
+    random.seed(0)
+    send_times = []
+    scheduler = RequestScheduler(
+        minimum=timedelta(seconds=0.02),
+        maximum=timedelta(seconds=0.04),
+        time_increment=timedelta(seconds=0.02),
+        epsilon=0.0,
+    )
+
+    @scheduler
+    def request():
+        send_times.append(time.monotonic())
+
+    def worker():
+        for _ in range(5):
+            request()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(send_times) == 40
+    send_times.sort()
+    gaps = [b - a for a, b in zip(send_times, send_times[1:])]
+    # the times are taken after acquire() returns, so a thread which is slow to be scheduled shortens the next gap
+    assert min(gaps) >= 0.01
+    assert send_times[-1] - send_times[0] >= 39 * 0.02 - 0.002
+
+
+def test_scheduler_hands_out_slots_in_fifo_order():
+    scheduler = RequestScheduler(
+        minimum=timedelta(seconds=0.1),
+        maximum=timedelta(seconds=0.2),
+        time_increment=timedelta(seconds=0.1),
+        epsilon=0.0,
+    )
+    # use up the token, so that the threads queue
+    scheduler.acquire()
+    served = []
+
+    def worker(i):
+        scheduler.acquire()
+        served.append(i)
+
+    threads = []
+    for i in range(5):
+        thread = threading.Thread(target=worker, args=(i,))
+        thread.start()
+        threads.append(thread)
+        # wait until it is queued before starting the next
+        while not (scheduler._head_taken and len(scheduler._waiters) == i):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert served == list(range(5))
+
+
+def test_results_are_credited_to_the_interval_they_were_paced_at():
+    clock = VirtualClock()
+    scheduler = RequestScheduler(
+        maximum=timedelta(seconds=5), epsilon=0.0, alpha=0.5, clock=clock
+    )
+    learner = scheduler.learner
+    slot = scheduler.acquire()
+    assert slot.interval == timedelta(0)
+    # another request moves the interval on before the first one reports
+    learner.current_interval = timedelta(seconds=3)
+    clock.advance(2)
+    scheduler.report(False, slot)
+    assert learner.average_rewards[timedelta(0)] == pytest.approx(-1.0)
+    assert learner.average_rewards[timedelta(seconds=3)] == 0
+
+
+def run_against_rate_limit(controller, hours=1, **kwargs):
+    random.seed(0)
+    clock = VirtualClock()
+    server = SimulatedServer(
+        clock,
+        random_failure_rate=0.0,
+        outage_duration=timedelta(0),
+        repeatable_failure_prefix="",
+    )
+    scheduler = RequestScheduler(
+        maximum=timedelta(seconds=10), controller=controller, clock=clock, **kwargs
+    )
+    failures = []
+
+    request = scheduler(server.request)
+    while clock.monotonic() < hours * 3600:
+        try:
+            request()
+        except TooBusyFailure:
+            failures.append(clock.monotonic())
+    return scheduler, server.requests - len(failures), failures
+
+
+def test_bisection_finds_the_rate_limit_between_grid_points():
+    # at the default resolution, whatever time_increment is
+    scheduler, successes, failures = run_against_rate_limit("bisection")
+    # 100 requests a minute, the limiter compares each request with the one 99 before it.
+    # The interval it settles on is well inside the grid's 1 second resolution
+    assert scheduler.learner.upper == pytest.approx(60 / 99, abs=0.02)
+    assert len(failures) < 50
+
+    _, grid_successes, grid_failures = run_against_rate_limit(
+        "grid", time_increment=timedelta(seconds=1)
+    )
+    assert successes > grid_successes
+    assert len(failures) < len(grid_failures)
+
+
+def test_bisection_backs_off_when_the_limit_tightens():
+    clock = VirtualClock()
+    learner = BisectionIntervalLearner(
+        maximum=timedelta(seconds=10), patience=2, clock=clock
+    )
+    learner.lower = learner.upper = 1.0
+    learner._set_interval(1.0)
+    request_time = learner.record_request()
+    clock.advance(1.0)
+    learner.record_result(False, learner.record_request())
+    assert learner.recovering
+    assert learner.current_interval == timedelta(seconds=1.5)
+    # a result from before the back-off is ignored
+    learner.record_result(False, request_time)
+    assert learner.current_interval == timedelta(seconds=1.5)
+    learner.record_result(False, learner.record_request())
+    assert learner.current_interval == timedelta(seconds=2.25)
+
+    for _ in range(2):
+        learner.record_result(True, learner.record_request())
+    assert not learner.recovering
+    assert (learner.lower, learner.upper) == (1.0, 2.25)
+    assert learner.current_interval == timedelta(seconds=1.625)
+
+
+def test_bisection_accepts_an_off_grid_range():
+    auto_request_interval(
+        maximum=timedelta(seconds=1.5),
+        time_increment=timedelta(seconds=1),
+        controller="bisection",
+    )
+    with pytest.raises(ValueError):
+        auto_request_interval(maximum=timedelta(seconds=1), controller="annealing")
+
+
+def test_bisection_stays_within_minimum_and_maximum():
+    learner = BisectionIntervalLearner(
+        minimum=timedelta(seconds=2),
+        maximum=timedelta(seconds=4),
+        resolution=timedelta(seconds=1),
+        patience=1,
+        drift=0.5,
+        clock=VirtualClock(),
+    )
+    intervals = []
+    for _ in range(20):
+        learner.record_result(True, learner.record_request())
+        intervals.append(learner.current_interval)
+    assert learner.lower == 2.0
+    assert min(intervals) >= timedelta(seconds=2)
+    # the trusted interval failing backs off no further than maximum
+    learner.record_result(False, learner.record_request())
+    learner.record_result(False, learner.record_request())
+    assert learner.current_interval == timedelta(seconds=4)
@@ -0,0 +1,89 @@
+from datetime import timedelta
+import threading
+import time
+
+from src.rlretry.rlretry import Action, RLAgent
+
+
+class RecordingDumper:
+    def __init__(self):
+        self.calls = []
+        self.dumped = threading.Event()
+
+    def __call__(self, df, counts_df, previous_df, previous_counts_df):
+        self.calls.append((threading.current_thread(), counts_df))
+        self.dumped.set()
+
+
+def test_dump_happens_off_the_calling_thread():
+    dumper = RecordingDumper()
+    agent = RLAgent(
+        0.0, weight_dumper=dumper, dump_interval=5, dump_in_background=True
+    )
+    for _ in range(5):
+        agent.apply_reward("a", Action.RETRY0, 1.0)
+        agent.choose_action("a")
+
+    assert dumper.dumped.wait(5)
+    assert all(thread is not threading.current_thread() for thread, _ in dumper.calls)
+
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+    agent.close()
+
+    # close() flushes the rewards applied since the last dump
+    _, counts_df = dumper.calls[-1]
+    assert counts_df.loc["a", Action.RETRY0] == 6
+
+
+def test_periodic_dump():
+    dumper = RecordingDumper()
+    agent = RLAgent(
+        0.0, weight_dumper=dumper, dump_period=timedelta(seconds=0.01)
+    )
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+
+    deadline = time.monotonic() + 5
+    while len(dumper.calls) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    agent.close()
+
+    assert len(dumper.calls) >= 3
+
+
+def test_merged_weights_are_taken_on_by_the_calling_thread():
+    adopted_on = []
+
+    class MergingDumper(RecordingDumper):
+        def __call__(self, df, counts_df, previous_df, previous_counts_df):
+            merged_counts_df = counts_df.copy()
+            merged_counts_df.loc["a", Action.RETRY0] += 10
+            super().__call__(df, counts_df, previous_df, previous_counts_df)
+            return df, merged_counts_df
+
+    dumper = MergingDumper()
+    agent = RLAgent(
+        0.0,
+        alpha=None,
+        weight_dumper=dumper,
+        dump_interval=10**6,
+        dump_in_background=True,
+    )
+    table = agent._state_action_map
+    set_cells = table.set_cells
+
+    def recording_set_cells(*args):
+        adopted_on.append(threading.current_thread())
+        set_cells(*args)
+
+    table.set_cells = recording_set_cells
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+    agent._dump_requested.set()
+    assert dumper.dumped.wait(5)
+    # give the dump thread time to return, it mustn't touch the table
+    time.sleep(0.05)
+    assert adopted_on == []
+
+    agent.choose_action("a")
+    assert adopted_on == [threading.current_thread()]
+    assert table.to_dataframes()[1].loc["a", Action.RETRY0] == 11
+    agent.close()
@@ -0,0 +1,131 @@
+from datetime import timedelta
+import pickle
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.rlretry.aggregation import _cells_to_table, _decode_action, _encode_action
+from src.rlretry.clock import VirtualClock
+from src.rlretry.persistence import DeltaLogWeightStore
+from src.rlretry.rlretry import (
+    Action,
+    Backoff,
+    RLAgent,
+    StateActionMap,
+    action_from_name,
+    backoff_ladder,
+    rlretry,
+)
+from src.rlretry.training import TransitionLog, train
+
+
+def test_backoff_ladder_is_geometric():
+    ladder = backoff_ladder(timedelta(milliseconds=50), timedelta(seconds=60), 12)
+    assert ladder[0] == Backoff(0)
+    seconds = [b.seconds for b in ladder[1:]]
+    assert seconds[0] == pytest.approx(0.05) and seconds[-1] == pytest.approx(60)
+    ratios = np.array(seconds[1:]) / np.array(seconds[:-1])
+    np.testing.assert_allclose(ratios, ratios[0], rtol=1e-2)
+
+    with pytest.raises(ValueError):
+        backoff_ladder(timedelta(0), timedelta(seconds=1), 3)
+
+
+def test_backoff_names_and_sleeps():
+    absolute, relative = Backoff(0.25), Backoff(0.1, relative=True)
+    assert absolute.sleep_seconds(timedelta(seconds=300)) == 0.25
+    assert relative.sleep_seconds(timedelta(seconds=300)) == pytest.approx(30)
+    assert Action.RETRY0_2.sleep_seconds(timedelta(seconds=300)) == pytest.approx(60)
+
+    for action in [absolute, relative, Action.RETRY0_5]:
+        assert action_from_name(action.name) == action
+        assert pickle.loads(pickle.dumps(action)) == action
+    assert hash(Backoff(1)) == hash(Backoff(1.0))
+    assert Backoff(1) != Backoff(1, relative=True)
+
+
+def test_rlretry_sleeps_for_the_chosen_backoff():
+    random.seed(0)
+    clock = VirtualClock()
+    attempts = 0
+
+    def flaky():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise RuntimeError("badness ocurred")
+        return attempts
+
+    wrapped, agent = rlretry(
+        epsilon=1.0,
+        dump_interval=10**9,
+        actions=[Backoff(2.0)],
+        clock=clock,
+    )(flaky, return_agent=True)
+
+    assert wrapped() == 3
+    assert clock.monotonic() == pytest.approx(4.0)
+    assert list(agent._state_action_map._df.columns) == [Action.ABRT, Backoff(2.0)]
+
+
+def test_loaded_weights_are_reindexed_to_the_actions():
+    df = pd.DataFrame([[1.0, 0.5, 0.2, 0.1, 0.0]], index=["a"], columns=list(Action))
+    counts_df = pd.DataFrame([[0, 3, 2, 1, 0]], index=["a"], columns=list(Action))
+    sam = StateActionMap(df, counts_df, 0.7, 0.1, actions=[Action.RETRY0, Backoff(5)])
+
+    new_df, new_counts_df = sam.to_dataframes()
+    assert list(new_df.columns) == [Action.ABRT, Action.RETRY0, Backoff(5)]
+    assert list(new_df.loc["a"]) == [1.0, 0.5, 0.7]
+    assert list(new_counts_df.loc["a"]) == [0, 3, 0]
+
+
+def test_many_arms_learn_the_best_one():
+    random.seed(0)
+    ladder = backoff_ladder(timedelta(milliseconds=10), timedelta(seconds=60), 40)
+    agent = RLAgent(0.2, alpha=0.1, dump_interval=10**9, actions=ladder)
+    best = ladder[17]
+    for _ in range(20000):
+        action = agent.choose_action("429")
+        agent.apply_reward("429", action, 2.0 if action == best else 0.0)
+    assert (
+        agent.choose_action("429") == best
+        or agent._state_action_map.best_action("429") == best
+    )
+
+
+def test_backoffs_persist_merge_and_train(tmp_path):
+    random.seed(0)
+    ladder = backoff_ladder(timedelta(milliseconds=50), timedelta(seconds=1), 3)
+    store = DeltaLogWeightStore(tmp_path / "weights")
+    log = TransitionLog(tmp_path / "transitions")
+    agent = RLAgent(
+        0.5, alpha=0.1, dump_interval=10**9, weight_store=store, actions=ladder
+    )
+    for _ in range(200):
+        action = agent.choose_action("s")
+        reward = random.random()
+        agent.apply_reward("s", action, reward)
+        log.record("s", action, reward, "success", 0.0)
+    agent.dump_weights()
+
+    df, counts_df = store.load()
+    expected_df, expected_counts_df = agent._state_action_map.to_dataframes()
+    assert set(ladder) <= set(df.columns)
+    pd.testing.assert_frame_equal(
+        df.reindex(columns=expected_df.columns), expected_df, check_dtype=False
+    )
+
+    # the aggregation protocol sends actions by name
+    assert _decode_action(_encode_action(ladder[2])) == ladder[2]
+    cells = [["s", _encode_action(a), 0.5, 1] for a in [Action.ABRT] + ladder]
+    assert list(_cells_to_table(cells)[0].columns) == [Action.ABRT] + ladder
+
+    trained_df, trained_counts_df = train(log.read(), 0.0, 0.1)
+    assert trained_df.columns[0] == Action.ABRT
+    assert set(trained_df.columns) == {Action.ABRT, *ladder}
+    np.testing.assert_allclose(
+        trained_df.loc["s"].to_numpy(),
+        expected_df.loc["s", trained_df.columns].to_numpy(dtype=float),
+    )
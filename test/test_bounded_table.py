@@ -0,0 +1,177 @@
+from datetime import timedelta
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.rlretry.bounded_table import BoundedStateActionMap
+from src.rlretry.clock import VirtualClock
+from src.rlretry.rlretry import Action, RLAgent
+
+
+def check_consistent(sam):
+    assert len(sam._states) == len(sam._rows)
+    for row, state in enumerate(sam._states):
+        assert sam._rows[state] == row
+    assert set(sam._lru) == set(sam._states) - {sam._fold_into}
+    num_states = len(sam._states)
+    assert (sam._greedy[:num_states] == sam._q[:num_states].argmax(axis=1)).all()
+
+
+def test_lru_eviction_keeps_at_most_max_states():
+    clock = VirtualClock()
+    sam = BoundedStateActionMap(None, None, 0.0, None, max_states=3, clock=clock)
+    for state in ["a", "b", "c"]:
+        sam.update_average_reward(state, Action.RETRY0, 1.0)
+        clock.advance(1)
+    # using a makes b the least recently used
+    sam.best_action("a")
+    clock.advance(1)
+
+    sam.update_average_reward("d", Action.RETRY0, 1.0)
+    assert sorted(sam._states) == ["a", "c", "d"]
+    check_consistent(sam)
+
+    for i in range(100):
+        sam.update_average_reward(f"s{i}", Action.RETRY0_1, 0.5)
+    assert len(sam._states) == 3
+    assert len(sam.to_dataframes()[0]) == 3
+    check_consistent(sam)
+
+
+def test_evicted_states_fold_into_parent():
+    clock = VirtualClock()
+    sam = BoundedStateActionMap(
+        None, None, 0.0, None, max_states=2, fold_evicted_into="default", clock=clock
+    )
+    for reward in [1.0, 2.0, 3.0]:
+        sam.update_average_reward("a", Action.RETRY0, reward)
+    clock.advance(1)
+    sam.update_average_reward("b", Action.RETRY0, 6.0)
+    clock.advance(1)
+    sam.update_average_reward("c", Action.RETRY0_5, 4.0)
+
+    assert sorted(sam._states) == ["c", "default"]
+    df, counts_df = sam.to_dataframes()
+    assert counts_df.loc["default", Action.RETRY0] == 4
+    assert df.loc["default", Action.RETRY0] == pytest.approx(3.0)
+    assert counts_df.loc["default", Action.RETRY0_5] == 0
+    check_consistent(sam)
+
+
+def test_ttl_expires_idle_states():
+    clock = VirtualClock()
+    sam = BoundedStateActionMap(
+        None,
+        None,
+        0.0,
+        None,
+        ttl=timedelta(minutes=10),
+        fold_evicted_into="default",
+        clock=clock,
+    )
+    for state in ["a", "b", "c", "d"]:
+        sam.update_average_reward(state, Action.RETRY0, 1.0)
+    clock.advance(360)
+    sam.update_average_reward("b", Action.RETRY0, 1.0)
+    sam.best_action("d")
+    clock.advance(360)
+    sam.update_average_reward("e", Action.RETRY0, 1.0)
+
+    assert sorted(sam._states) == ["b", "d", "default", "e"]
+    assert sam.to_dataframes()[1].loc["default", Action.RETRY0] == 2
+    check_consistent(sam)
+
+
+def test_loading_more_than_max_states_keeps_the_most_tried():
+    states = [f"s{i}" for i in range(10)]
+    df = pd.DataFrame(np.ones((10, len(Action))), index=states, columns=list(Action))
+    counts_df = pd.DataFrame(
+        np.arange(10)[:, None].repeat(len(Action), axis=1),
+        index=states,
+        columns=list(Action),
+    )
+    sam = BoundedStateActionMap(df, counts_df, 0.0, None, max_states=4)
+    assert sorted(sam._states) == ["s6", "s7", "s8", "s9"]
+    check_consistent(sam)
+
+
+def test_set_cells_does_not_evict():
+    sam = BoundedStateActionMap(None, None, 0.0, None, max_states=2)
+    sam.update_average_reward("a", Action.RETRY0, 1.0)
+    df = pd.DataFrame(
+        np.full((3, len(Action)), 2.0), index=["a", "x", "y"], columns=list(Action)
+    )
+    sam.set_cells(df, df.astype(int))
+    assert sorted(sam._states) == ["a", "x"]
+    assert sam.to_dataframes()[0].loc["a", Action.RETRY0] == 2.0
+    check_consistent(sam)
+
+
+def test_agent_with_max_states():
+    agent = RLAgent(
+        0.1,
+        weight_loader=lambda: (None, None),
+        weight_dumper=lambda *args: None,
+        max_states=5,
+    )
+    for i in range(50):
+        agent.apply_reward(f"state{i}", agent.choose_action(f"state{i}"), 1.0)
+    assert len(agent._state_action_map.to_dataframes()[0]) == 5
+
+    with pytest.raises(ValueError):
+        RLAgent(0.1, max_states=5, shared_memory_name="bounded")
+
+
+def test_snapshots_match_states_with_rows_while_evicting():
+    sam = BoundedStateActionMap(
+        None,
+        None,
+        0.0,
+        None,
+        max_states=8,
+        ttl=timedelta(seconds=0),
+        fold_evicted_into="default",
+    )
+    stop = threading.Event()
+    mismatches = []
+
+    def snapshot():
+        while not stop.is_set():
+            states, actions, q, counts = sam.snapshot()
+            col = actions.index(Action.RETRY0)
+            for state, value in zip(states, q[:, col]):
+                if state != "default" and value != float(state[1:]):
+                    mismatches.append((state, value))
+
+    thread = threading.Thread(target=snapshot)
+    thread.start()
+    try:
+        for i in range(3000):
+            sam.update_average_reward(f"s{i % 50}", Action.RETRY0, float(i % 50))
+    finally:
+        stop.set()
+        thread.join()
+    assert not mismatches
+    check_consistent(sam)
+
+
+def test_dump_in_background_with_max_states():
+    dumped = []
+    agent = RLAgent(
+        0.1,
+        weight_loader=lambda: (None, None),
+        weight_dumper=lambda df, *args: dumped.append(df),
+        alpha=None,
+        max_states=4,
+        dump_interval=7,
+        dump_in_background=True,
+    )
+    for i in range(200):
+        state = f"s{i % 10}"
+        agent.apply_reward(state, agent.choose_action(state), 1.0)
+    agent.close()
+    assert dumped
+    assert all(len(df) <= 4 for df in dumped)
+    check_consistent(agent._state_action_map)
@@ -0,0 +1,200 @@
+import asyncio
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+from src.rlretry.circuit_breaker import CircuitBreaker
+from src.rlretry.clock import VirtualClock
+from src.rlretry.metrics import RetryMetrics
+from src.rlretry.rlretry import Action, RLRetryAbort, RLRetryCircuitOpen, rlretry
+from src.rlretry.simulation import Simulator
+
+
+def make_breaker(clock, window=2):
+    return CircuitBreaker(
+        window=window, min_samples=10, cooldown=timedelta(seconds=10), clock=clock
+    )
+
+
+def test_opens_only_when_abort_is_preferred_and_calls_keep_failing():
+    breaker = make_breaker(VirtualClock())
+    error = RuntimeError("down")
+
+    # retries are still better than aborting
+    for _ in range(5):
+        breaker.record_failure(error, "a", -0.5, 100)
+    assert breaker.state == CircuitBreaker.CLOSED
+    # too few samples to trust
+    breaker.record_failure(error, "a", 0.1, 5)
+    assert breaker.state == CircuitBreaker.CLOSED
+    # timeouts don't open it on their own
+    breaker.record_failure(error)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure(error, "a", 0.1, 100)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.tripped_state == "a"
+    assert breaker.last_exception is error
+    assert not breaker.allow()
+
+
+def test_failure_rate_must_be_high():
+    breaker = make_breaker(VirtualClock(), window=4)
+    for _ in range(5):
+        breaker.record_success()
+    breaker.record_failure(RuntimeError("down"), "a", 0.1, 100)
+    assert breaker.failure_rate < 0.5
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe_and_learned_cooldown():
+    clock = VirtualClock()
+    breaker = make_breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(RuntimeError("down"), "a", 0.1, 100)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.advance(9)
+    assert not breaker.allow()
+    clock.advance(1)
+    # one probe at a time
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    breaker.record_failure(RuntimeError("still down"))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.cooldown == timedelta(seconds=20)
+
+    clock.advance(20)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.cooldown == timedelta(seconds=10)
+    assert breaker.allow()
+
+
+def test_rlretry_fails_fast_while_open():
+    clock = VirtualClock()
+    breaker = make_breaker(clock)
+    metrics = RetryMetrics()
+    # the agent has learned that retrying a RuntimeError never works
+    q = pd.DataFrame(
+        [[1.0, 0.5, 0.5, 0.5, 0.5]], index=["RuntimeError"], columns=list(Action)
+    )
+    counts = pd.DataFrame(
+        [[50, 50, 50, 50, 50]], index=["RuntimeError"], columns=list(Action)
+    )
+    calls = []
+    up = False
+
+    def func():
+        calls.append(None)
+        if not up:
+            raise RuntimeError("down")
+        return "ok"
+
+    wrapped = rlretry(
+        epsilon=0.0,
+        weight_loader=lambda: (q, counts),
+        circuit_breaker=breaker,
+        clock=clock,
+        metrics=metrics,
+    )(func)
+
+    with pytest.raises(RLRetryAbort):
+        wrapped()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert len(calls) == 1
+
+    for _ in range(5):
+        with pytest.raises(RLRetryCircuitOpen):
+            wrapped()
+    assert len(calls) == 1
+    assert metrics.totals().calls["circuit_open"] == 5
+
+    clock.advance(10)
+    up = True
+    assert wrapped() == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def traceback_depth(tb) -> int:
+    depth = 0
+    while tb is not None:
+        depth += 1
+        tb = tb.tb_next
+    return depth
+
+
+@pytest.mark.parametrize("raise_primary_exception", [False, True])
+def test_failing_fast_does_not_grow_the_traceback(raise_primary_exception):
+    clock = VirtualClock()
+    breaker = make_breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(RuntimeError("down"), "RuntimeError", 0.1, 100)
+    stored = breaker.last_exception
+
+    wrapped = rlretry(
+        circuit_breaker=breaker,
+        clock=clock,
+        raise_primary_exception=raise_primary_exception,
+    )(lambda: "ok")
+
+    depths = []
+    for _ in range(5):
+        with pytest.raises(
+            RuntimeError if raise_primary_exception else RLRetryCircuitOpen
+        ) as exc_info:
+            wrapped()
+        assert exc_info.value is not stored
+        depths.append(traceback_depth(exc_info.value.__traceback__))
+    assert len(set(depths)) == 1
+    assert stored.__traceback__ is None
+
+
+def open_breaker(clock):
+    breaker = make_breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(RuntimeError("down"), "a", 0.1, 100)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.advance(10)
+    return breaker
+
+
+def test_cancelled_probe_lets_the_next_call_probe():
+    simulator = Simulator()
+    breaker = open_breaker(simulator.clock)
+
+    async def hangs():
+        await asyncio.sleep(100)
+
+    wrapped = rlretry(circuit_breaker=breaker, clock=simulator.clock)(hangs)
+
+    async def cancel_probe():
+        probe = asyncio.ensure_future(wrapped())
+        await asyncio.sleep(1)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    simulator.run(cancel_probe())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+
+
+def test_probe_whose_state_func_raises_lets_the_next_call_probe():
+    clock = VirtualClock()
+    breaker = open_breaker(clock)
+
+    def state_func(e):
+        raise e
+
+    wrapped = rlretry(circuit_breaker=breaker, clock=clock, state_func=state_func)(
+        lambda: 1 / 0
+    )
+    with pytest.raises(ZeroDivisionError):
+        wrapped()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+import pytest
+
+from src.rlretry.clock import VirtualClock
+from src.rlretry.rlretry import Backoff, RLRetryTimeout, rlretry
+from src.rlretry.simulation import Simulator
+
+
+def fails_once(clock, deadlines):
+    def func(deadline=None):
+        deadlines.append(deadline)
+        if len(deadlines) == 1:
+            clock.advance(1)
+            raise RuntimeError("failed")
+        return "ok"
+
+    return func
+
+
+def test_backoff_happens_before_the_retry():
+    clock = VirtualClock()
+    deadlines = []
+    wrapped, agent = rlretry(
+        actions=[Backoff(10)],
+        epsilon=1.0,
+        timeout=timedelta(seconds=300),
+        clock=clock,
+        telemetry_capacity=8,
+    )(fails_once(clock, deadlines), return_agent=True)
+
+    start = clock.monotonic()
+    assert wrapped() == "ok"
+    # the first attempt took 1 second, then it backed off for 10.  Nothing after the success
+    assert clock.monotonic() - start == pytest.approx(11)
+    transition = next(agent.telemetry.read().to_dicts())
+    assert transition["sleep"] == 10
+    assert transition["reward"] == pytest.approx(2.5 - 10 / 300)
+
+
+def test_backoff_is_cut_short_at_the_deadline():
+    clock = VirtualClock()
+    deadlines = []
+    wrapped, agent = rlretry(
+        actions=[Backoff(60)],
+        epsilon=1.0,
+        timeout=timedelta(seconds=5),
+        clock=clock,
+        telemetry_capacity=8,
+        deadline_kwarg="deadline",
+    )(fails_once(clock, deadlines), return_agent=True)
+
+    start = clock.monotonic()
+    # backing off used up the time left, so it times out rather than calling with no time to spare
+    with pytest.raises(RLRetryTimeout):
+        wrapped()
+    assert clock.monotonic() - start == pytest.approx(5)
+    transition = next(agent.telemetry.read().to_dicts())
+    assert transition["sleep"] == pytest.approx(4)
+    assert transition["outcome"] == "timeout"
+    assert deadlines == [timedelta(seconds=5)]
+
+
+def test_remaining_time_is_passed_to_the_function():
+    clock = VirtualClock()
+    deadlines = []
+    wrapped = rlretry(
+        actions=[Backoff(2)],
+        epsilon=1.0,
+        timeout=timedelta(seconds=30),
+        clock=clock,
+        deadline_kwarg="deadline",
+    )(fails_once(clock, deadlines))
+
+    assert wrapped() == "ok"
+    assert deadlines == [timedelta(seconds=30), timedelta(seconds=27)]
+
+
+def test_async_backoff_is_cut_short_at_the_deadline():
+    simulator = Simulator()
+    deadlines = []
+
+    async def func(deadline):
+        deadlines.append(deadline)
+        if len(deadlines) == 1:
+            raise RuntimeError("failed")
+        return "ok"
+
+    wrapped = rlretry(
+        actions=[Backoff(60)],
+        epsilon=1.0,
+        timeout=timedelta(seconds=5),
+        clock=simulator.clock,
+        deadline_kwarg="deadline",
+    )(func)
+
+    start = simulator.clock.monotonic()
+    with pytest.raises(RLRetryTimeout):
+        simulator.run(wrapped())
+    assert simulator.clock.monotonic() - start == pytest.approx(5)
+    assert deadlines == [timedelta(seconds=5)]
@@ -0,0 +1,39 @@
+import asyncio
+from datetime import timedelta
+import random
+from unittest import mock
+
+import pytest
+
+from src.rlretry.rlretry import RLRetryMaxRetries, rlretry
+
+
+def test_first_try_success_does_not_create_environment():
+    async def async_add(x, y=1):
+        return x + y
+
+    with mock.patch("src.rlretry.rlretry.RLEnvironment") as environment:
+        wrapped = rlretry()(lambda x, y=1: x + y)
+        assert wrapped(1, y=2) == 3
+        assert asyncio.run(rlretry()(async_add)(1, y=2)) == 3
+    environment.assert_not_called()
+
+
+def test_retries_keep_the_arguments_and_first_exception():
+    random.seed(0)
+    calls = []
+
+    def always_fails(x, y=None):
+        calls.append((x, y))
+        raise ValueError(f"failure {len(calls)}")
+
+    wrapped = rlretry(
+        max_retries=3, timeout=timedelta(seconds=0.01), epsilon=1.0, dump_interval=10**9
+    )(always_fails)
+
+    with pytest.raises(Exception) as e:
+        wrapped(1, y=2)
+    assert set(calls) == {(1, 2)}
+    assert isinstance(e.value.__cause__, ValueError)
+    if isinstance(e.value, RLRetryMaxRetries):
+        assert len(calls) == 4
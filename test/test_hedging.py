@@ -0,0 +1,178 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import time
+
+import pytest
+
+from src.rlretry.hedging import Hedger
+from src.rlretry.rlretry import Action, Hedge, action_from_name, rlretry
+from src.rlretry.simulation import Simulator
+
+
+def primed_hedger(max_hedge_fraction=1.0, latency=0.01, **kwargs):
+    hedger = Hedger(max_hedge_fraction, min_samples=10, **kwargs)
+    for _ in range(10):
+        hedger.record(latency)
+    return hedger
+
+
+def test_hedge_names_round_trip():
+    hedge = Hedge(99.5)
+    assert action_from_name(hedge.name) == hedge
+    assert hedge.sleep_seconds(timedelta(seconds=10)) == 0
+    with pytest.raises(ValueError):
+        Hedge(100)
+
+
+def test_delay_is_a_percentile_of_recent_latencies():
+    hedger = Hedger(min_samples=5, window=100)
+    for latency in [1.0, 2.0, 3.0, 4.0]:
+        hedger.record(latency)
+    hedger.record(None)
+    assert hedger.delay(50) is None
+    hedger.record(5.0)
+    assert hedger.delay(50) == 3.0
+    assert hedger.attempts == 6
+
+
+def test_slow_attempt_is_hedged():
+    hedger = primed_hedger()
+    calls = []
+
+    def func():
+        calls.append(threading.current_thread())
+        if len(calls) == 1:
+            time.sleep(0.2)
+            raise RuntimeError("slow attempt failed")
+        return "fast"
+
+    assert hedger.run(func, 50) == "fast"
+    assert hedger.hedges == 1
+    # the first attempt ran on the caller's thread, and only the hedge on the pool
+    assert calls[0] is threading.current_thread()
+    assert calls[1] is not threading.current_thread()
+
+
+def test_slow_success_is_returned_though_hedged():
+    hedger = primed_hedger()
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.2)
+            return "slow"
+        return "fast"
+
+    assert hedger.run(func, 50) == "slow"
+    assert hedger.hedges == 1
+
+
+def test_saturated_pool_does_not_delay_or_hedge_the_first_attempt():
+    pool = ThreadPoolExecutor(1)
+    release = threading.Event()
+    pool.submit(release.wait)
+    hedger = primed_hedger(latency=0.05, executor=pool)
+    calls = []
+
+    def func(sleep):
+        calls.append(None)
+        time.sleep(sleep)
+        return "ok"
+
+    try:
+        start = time.monotonic()
+        assert hedger.run(lambda: func(0), 50) == "ok"
+        assert time.monotonic() - start < 0.05
+        assert hedger.hedges == 0
+
+        # the hedge is queued behind the busy thread, and cancelled once the first attempt succeeds
+        assert hedger.run(lambda: func(0.2), 50) == "ok"
+        assert hedger.hedges == 1
+    finally:
+        release.set()
+        pool.shutdown()
+    assert len(calls) == 2
+
+
+def test_first_success_wins_when_the_hedge_fails():
+    hedger = primed_hedger()
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.1)
+            return "primary"
+        raise RuntimeError("hedge failed")
+
+    assert hedger.run(func, 50) == "primary"
+
+
+def test_hedges_are_capped():
+    hedger = primed_hedger(max_hedge_fraction=0.0)
+    calls = []
+
+    def func():
+        calls.append(None)
+        time.sleep(0.05)
+        return "ok"
+
+    assert hedger.run(func, 50) == "ok"
+    assert len(calls) == 1
+    assert hedger.hedges == 0
+
+
+def test_async_hedge_cancels_the_loser():
+    simulator = Simulator()
+    hedger = primed_hedger(latency=1.0, clock=simulator.clock)
+    cancelled = []
+    calls = []
+
+    async def func():
+        calls.append(None)
+        try:
+            await asyncio.sleep(100 if len(calls) == 1 else 2)
+        except asyncio.CancelledError:
+            cancelled.append(len(calls))
+            raise
+        return len(calls)
+
+    start = simulator.clock.monotonic()
+    assert simulator.run(hedger.run_async(func, 50)) == 2
+    # hedged after 1 second, and the hedge took 2
+    assert simulator.clock.monotonic() - start == pytest.approx(3.0)
+    assert cancelled
+
+
+def test_rlretry_learns_hedge_action():
+    calls = []
+
+    def func(fail=False, slow=False):
+        calls.append(None)
+        if fail and len(calls) == 1:
+            raise RuntimeError("first attempt failed")
+        if slow and len(calls) == 2:
+            time.sleep(0.2)
+            raise RuntimeError("slow attempt failed")
+        return "ok"
+
+    wrapped, agent = rlretry(actions=[Hedge(50)], epsilon=1.0, max_hedge_fraction=0.5)(
+        func, return_agent=True
+    )
+    # the latencies to hedge at a percentile of
+    for _ in range(20):
+        calls.clear()
+        wrapped()
+
+    calls.clear()
+    start = time.monotonic()
+    assert wrapped(fail=True, slow=True) == "ok"
+    # the hedge launched during the slow attempt answered, rather than another retry
+    assert len(calls) == 3
+    assert time.monotonic() - start < 0.5
+    counts = agent._state_action_map.to_dataframes()[1]
+    assert counts.loc["RuntimeError", Hedge(50)] == 1
+    assert list(counts.columns) == [Action.ABRT, Hedge(50)]
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from datetime import timedelta
+import random
+import threading
+
+import pytest
+
+from src.rlretry.auto_rate_limit import auto_request_interval
+from src.rlretry.metrics import (
+    Histogram,
+    PacingMetrics,
+    PrometheusFileExporter,
+    RetryMetrics,
+    prometheus_text,
+    write_prometheus,
+)
+from src.rlretry.rlretry import RLRetryError, rlretry
+
+
+def sample(text: str, series: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.split(" ")[-1])
+    raise KeyError(series)
+
+
+def test_histogram_buckets():
+    histogram = Histogram([1.0, 2.0])
+    for value in [0.5, 1.0, 1.5, 3.0]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.sum == 6.0
+
+
+def test_rlretry_metrics():
+    random.seed(0)
+    metrics = RetryMetrics("flaky")
+    attempts = 0
+
+    def flaky(fail: bool):
+        nonlocal attempts
+        attempts += 1
+        if fail or attempts % 2:
+            raise RuntimeError("badness ocurred")
+        return attempts
+
+    wrapped = rlretry(
+        max_retries=3,
+        timeout=timedelta(seconds=0.01),
+        dump_interval=10**9,
+        metrics=metrics,
+    )(flaky)
+    for i in range(30):
+        try:
+            wrapped(i % 3 == 0)
+        except RLRetryError:
+            pass
+
+    totals = metrics.totals()
+    assert sum(totals.calls.values()) == 30
+    assert totals.calls["success"] > 0
+    assert (
+        totals.calls["abort"] + totals.calls["max_retries"] + totals.calls["timeout"]
+        > 0
+    )
+    assert sum(totals.retries.values()) > 0
+
+    text = prometheus_text([metrics])
+    assert text.count("# TYPE rlretry_calls_total counter") == 1
+    assert sample(text, 'rlretry_call_duration_seconds_count{name="flaky"}') == 30
+    assert (
+        sample(text, 'rlretry_call_duration_seconds_bucket{name="flaky",le="+Inf"}')
+        == 30
+    )
+    assert sample(text, 'rlretry_calls_total{name="flaky",outcome="success"}') == (
+        totals.calls["success"]
+    )
+    assert 'rlretry_retries_total{name="flaky",state="RuntimeError",action=' in text
+
+
+def test_metrics_are_summed_across_threads():
+    metrics = RetryMetrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.record_call("success", 0.001)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.totals().calls["success"] == 8000
+
+
+def test_pacing_metrics(tmp_path):
+    metrics = PacingMetrics("paced")
+
+    @auto_request_interval(
+        maximum=timedelta(seconds=0.02),
+        time_increment=timedelta(seconds=0.01),
+        metrics=metrics,
+    )
+    async def request(fail: bool):
+        if fail:
+            raise RuntimeError("too busy")
+
+    async def run():
+        for i in range(10):
+            try:
+                await request(i % 2 == 0)
+            except RuntimeError:
+                pass
+
+    asyncio.run(run())
+
+    path = tmp_path / "metrics.prom"
+    write_prometheus(str(path), [metrics, RetryMetrics("other")])
+    text = path.read_text()
+    assert (
+        sample(text, 'rlretry_paced_requests_total{name="paced",result="success"}') == 5
+    )
+    assert (
+        sample(text, 'rlretry_paced_requests_total{name="paced",result="failure"}') == 5
+    )
+    assert sample(text, 'rlretry_pacing_wait_seconds_count{name="paced"}') == 10
+    assert sample(
+        text, 'rlretry_pacing_interval_seconds{name="paced"}'
+    ) == pytest.approx(metrics.current_interval)
+    assert 'rlretry_calls_total{name="other",outcome="success"} 0' in text
+
+
+def test_exporter_failures_are_logged_to_a_configurable_logger(tmp_path, caplog):
+    exporter = PrometheusFileExporter(
+        str(tmp_path / "missing" / "metrics.prom"),
+        [RetryMetrics("exported")],
+        interval=timedelta(seconds=0.01),
+    )
+    with caplog.at_level(logging.ERROR, logger="src.rlretry"):
+        exporter.start()
+        for _ in range(100):
+            if caplog.records:
+                break
+            threading.Event().wait(0.01)
+        exporter._stop.set()
+        exporter._thread.join()
+    assert "failed to write metrics" in caplog.records[0].getMessage()
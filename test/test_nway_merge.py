@@ -0,0 +1,86 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.rlretry.rlretry import merge_weights, update_average
+from test.test_3way_average import calculate_weighted_average
+
+
+def _table(value, index=("a", "b"), columns=(0, 1)):
+    return pd.DataFrame(
+        [[value] * len(columns)] * len(index), index=list(index), columns=list(columns)
+    )
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 5, 50])
+@pytest.mark.parametrize("alpha", [0.1, 0.5])
+def test_nway_merge_matches_sequential_replay(num_workers, alpha):
+    random.seed(num_workers)
+    base_batch = [random.random() for _ in range(7)]
+    worker_batches = [
+        [random.random() for _ in range(random.randint(0, 12))]
+        for _ in range(num_workers)
+    ]
+
+    q0 = calculate_weighted_average(0, base_batch, alpha)
+    n0 = len(base_batch)
+    workers = [
+        (
+            _table(calculate_weighted_average(q0, batch, alpha)),
+            _table(n0 + len(batch)),
+        )
+        for batch in worker_batches
+    ]
+    plain_workers = [
+        (_table(sum(base_batch + batch) / (n0 + len(batch))), _table(n0 + len(batch)))
+        for batch in worker_batches
+    ]
+
+    all_samples = base_batch + [r for batch in worker_batches for r in batch]
+
+    merged = merge_weights(_table(q0), _table(n0), workers, alpha=alpha)
+    assert (merged.counts.values == len(all_samples)).all()
+    assert merged.recency_weighted_average.values == pytest.approx(
+        np.full((2, 2), calculate_weighted_average(0, all_samples, alpha))
+    )
+
+    merged = merge_weights(
+        _table(sum(base_batch) / n0), _table(n0), plain_workers
+    )
+    assert merged.recency_weighted_average is None
+    assert merged.average.values == pytest.approx(
+        np.full((2, 2), sum(all_samples) / len(all_samples))
+    )
+
+
+def test_two_workers_match_update_average():
+    q0, n0 = _table(1.0), _table(4)
+    q1, n1 = _table(2.0), _table(10)
+    q2, n2 = _table(3.0), _table(6)
+
+    expected_q, expected_n = update_average(q0, n0, q1, n1, q2, n2)
+    merged = merge_weights(q0, n0, [(q1, n1), (q2, n2)])
+
+    assert merged.average.values == pytest.approx(expected_q.values)
+    assert (merged.counts.values == expected_n.values).all()
+
+
+def test_workers_with_different_states_are_aligned():
+    q0, n0 = _table(1.0, index=["a"]), _table(2, index=["a"])
+    # worker 1 only knows about a, worker 2 discovered b and a new action
+    q1, n1 = _table(2.0, index=["a"]), _table(4, index=["a"])
+    q2 = _table(5.0, index=["a", "b"], columns=[0, 1, 2])
+    n2 = _table(2, index=["a", "b"], columns=[0, 1, 2])
+    q2.loc["a"] = 1.0
+
+    merged = merge_weights(q0, n0, [(q1, n1), (q2, n2)])
+
+    assert list(merged.average.index) == ["a", "b"]
+    assert list(merged.average.columns) == [0, 1, 2]
+    # a: base 2 samples averaging 1, worker 1 added 2 samples averaging 3
+    assert merged.average.loc["a", 0] == pytest.approx(2.0)
+    assert merged.counts.loc["a", 0] == 4
+    assert merged.average.loc["b", 0] == pytest.approx(5.0)
+    assert merged.counts.loc["b", 0] == 2
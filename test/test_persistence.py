@@ -0,0 +1,98 @@
+import pickle
+
+from src.rlretry.persistence import DeltaLogWeightStore
+from src.rlretry.rlretry import Action, RLAgent
+
+
+def test_only_changed_cells_are_logged(tmp_path):
+    store = DeltaLogWeightStore(tmp_path)
+    agent = RLAgent(0.0, alpha=None, weight_store=store, dump_interval=10**6)
+
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+    agent.apply_reward("b", Action.RETRY0_1, 2.0)
+    agent.dump_weights()
+
+    agent.apply_reward("a", Action.RETRY0_2, 3.0)
+    agent.dump_weights()
+
+    with open(tmp_path / DeltaLogWeightStore.LOG_FILENAME, "rb") as f:
+        first = pickle.load(f)
+        second = pickle.load(f)
+
+    # a new state is written in full, after that only the changed cells
+    assert len(first[0]) == 2 * len(Action)
+    assert second[0] == ["a"]
+    assert second[1] == [Action.RETRY0_2]
+    assert list(second[2]) == [3.0]
+    assert list(second[3]) == [1]
+
+    # nothing changed, nothing written
+    size = (tmp_path / DeltaLogWeightStore.LOG_FILENAME).stat().st_size
+    agent.dump_weights()
+    assert (tmp_path / DeltaLogWeightStore.LOG_FILENAME).stat().st_size == size
+
+
+def test_replay_and_compaction(tmp_path):
+    store = DeltaLogWeightStore(tmp_path, compact_every=3)
+    agent = RLAgent(0.0, alpha=None, weight_store=store, dump_interval=10**6)
+
+    for i in range(10):
+        agent.apply_reward(f"state{i % 4}", Action.RETRY0_5, float(i))
+        agent.dump_weights()
+
+    expected_df, expected_counts_df = agent._state_action_map.to_dataframes()
+
+    # ten dumps with compaction every 3 leaves a snapshot and one record in the log
+    assert (tmp_path / DeltaLogWeightStore.SNAPSHOT_FILENAME).exists()
+    assert len(DeltaLogWeightStore(tmp_path)._read_log()[0]) == 1
+
+    reloaded = RLAgent(0.0, alpha=None, weight_store=DeltaLogWeightStore(tmp_path))
+    df, counts_df = reloaded._state_action_map.to_dataframes()
+
+    assert list(df.columns) == list(Action)
+    assert df.sort_index().equals(expected_df.sort_index())
+    assert counts_df.sort_index().equals(expected_counts_df.sort_index())
+
+
+def test_truncated_log_is_ignored(tmp_path):
+    store = DeltaLogWeightStore(tmp_path)
+    agent = RLAgent(0.0, alpha=None, weight_store=store, dump_interval=10**6)
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+    agent.dump_weights()
+
+    with open(tmp_path / DeltaLogWeightStore.LOG_FILENAME, "ab") as f:
+        f.write(b"\x80\x05partial")
+
+    df, _ = DeltaLogWeightStore(tmp_path).load()
+    assert df.loc["a", Action.RETRY0] == 1.0
+
+
+def test_dumps_after_a_torn_record_survive_a_reload(tmp_path):
+    agent = RLAgent(
+        0.0,
+        alpha=None,
+        weight_store=DeltaLogWeightStore(tmp_path),
+        dump_interval=10**6,
+    )
+    agent.apply_reward("a", Action.RETRY0, 1.0)
+    agent.dump_weights()
+    # the process died part way through writing a record
+    with open(tmp_path / DeltaLogWeightStore.LOG_FILENAME, "ab") as f:
+        f.write(b"\x80\x05partial")
+
+    restarted = RLAgent(
+        0.0,
+        alpha=None,
+        weight_store=DeltaLogWeightStore(tmp_path),
+        dump_interval=10**6,
+    )
+    restarted.apply_reward("b", Action.RETRY0_1, 2.0)
+    restarted.dump_weights()
+
+    store = DeltaLogWeightStore(tmp_path)
+    df, _ = store.load()
+    assert df.loc["a", Action.RETRY0] == 1.0
+    assert df.loc["b", Action.RETRY0_1] == 2.0
+    store.compact()
+    df, _ = DeltaLogWeightStore(tmp_path).load()
+    assert df.loc["b", Action.RETRY0_1] == 2.0
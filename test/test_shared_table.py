@@ -0,0 +1,88 @@
+import multiprocessing
+import sys
+import uuid
+
+import pandas as pd
+import pytest
+
+from src.rlretry.rlretry import Action, Backoff, RLAgent, StateActionMap
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="the shared table uses fcntl locking"
+)
+
+
+@pytest.fixture
+def segment_name():
+    name = f"rlretry-test-{uuid.uuid4().hex[:8]}"
+    yield name
+    from src.rlretry.shared_table import SharedStateActionMap
+
+    table = SharedStateActionMap(name, lambda: (None, None))
+    table.unlink()
+    table.close()
+
+
+def _add_rewards(name: str, state: str, n: int):
+    agent = RLAgent(0.0, alpha=None, shared_memory_name=name)
+    for _ in range(n):
+        agent.apply_reward(state, Action.RETRY0_1, 2.0)
+
+
+def test_processes_share_rewards(segment_name):
+    agent = RLAgent(0.0, alpha=None, shared_memory_name=segment_name)
+    agent.apply_reward("RuntimeError", Action.RETRY0, 1.0)
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=_add_rewards, args=(segment_name, "TooBusy", 50))
+        for _ in range(4)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    counts_df = agent._state_action_map._counts_df
+    assert counts_df.loc["TooBusy", Action.RETRY0_1] == 200
+    assert counts_df.loc["RuntimeError", Action.RETRY0] == 1
+    assert agent._state_action_map.best_action("TooBusy") == Action.RETRY0_1
+
+
+def test_only_the_creator_loads_weights(segment_name):
+    df = StateActionMap.default_df()
+    df.loc["Seeded"] = [1.0, 0.0, 0.0, 3.0, 0.0]
+    counts_df = pd.DataFrame([[0, 0, 0, 7, 0]], index=["Seeded"], columns=list(Action))
+
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return df, counts_df
+
+    first = RLAgent(0.0, weight_loader=loader, shared_memory_name=segment_name)
+    second = RLAgent(0.0, weight_loader=loader, shared_memory_name=segment_name)
+
+    assert len(loads) == 1
+    assert second._state_action_map.best_action("Seeded") == Action.RETRY0_2
+    assert second._state_action_map._counts_df.loc["Seeded", Action.RETRY0_2] == 7
+    assert first._state_action_map._df.equals(second._state_action_map._df)
+
+
+def test_full_table_drops_new_states(segment_name):
+    agent = RLAgent(
+        0.0, alpha=None, shared_memory_name=segment_name, shared_memory_capacity=2
+    )
+    for state in ["a", "b", "c"]:
+        agent.apply_reward(state, Action.RETRY0, 1.0)
+
+    assert list(agent._state_action_map._df.index) == ["a", "b"]
+
+
+def test_attaching_with_different_actions_is_rejected(segment_name):
+    RLAgent(0.0, shared_memory_name=segment_name)
+    # as many columns as the default actions, but they mean different back-offs
+    ladder = [Backoff(1), Backoff(2), Backoff(4), Backoff(8)]
+    with pytest.raises(ValueError):
+        RLAgent(0.0, shared_memory_name=segment_name, actions=ladder)
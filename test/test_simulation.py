@@ -0,0 +1,164 @@
+import asyncio
+from datetime import datetime, timedelta
+import pathlib
+import random
+import time
+
+from src.rlretry.auto_rate_limit import auto_request_interval
+from src.rlretry.clock import VirtualClock, VirtualTimeEventLoop
+from src.rlretry.rlretry import rlretry
+from src.rlretry.simulation import (
+    ClusteredFailure,
+    RepeatableFailure,
+    SimulatedServer,
+    Simulator,
+    TooBusyFailure,
+)
+
+
+def failure_state(e: Exception) -> str:
+    return e.__class__.__name__
+
+
+def test_virtual_clock_only_moves_when_sleeping():
+    clock = VirtualClock(datetime(2020, 1, 1))
+    assert clock.now() == datetime(2020, 1, 1)
+    clock.sleep(90)
+    assert clock.monotonic() == 90
+    assert clock.now() == datetime(2020, 1, 1, 0, 1, 30)
+
+
+def test_virtual_time_event_loop_sleeps_instantly():
+    clock = VirtualClock()
+    loop = VirtualTimeEventLoop(clock)
+
+    async def sleepy():
+        await asyncio.gather(asyncio.sleep(3600), asyncio.sleep(60))
+        return clock.monotonic()
+
+    start = time.monotonic()
+    try:
+        assert loop.run_until_complete(sleepy()) == 3600
+    finally:
+        loop.close()
+    assert time.monotonic() - start < 1
+
+
+def test_simulated_server_failure_models():
+    random.seed(0)
+    clock = VirtualClock()
+    server = SimulatedServer(clock, random_failure_rate=0.0, rate_limit=3)
+
+    # the first 30s of every 5 minutes is an outage
+    try:
+        server.request("abc")
+        assert False
+    except ClusteredFailure:
+        pass
+
+    clock.advance(60)
+    assert server.request("abc")
+    try:
+        server.request("kbc")
+        assert False
+    except RepeatableFailure:
+        pass
+    try:
+        server.request("abc")
+        assert False
+    except TooBusyFailure:
+        pass
+
+    clock.advance(61)
+    assert server.request("abc")
+
+
+def test_async_rlretry_simulated_hour_runs_quickly():
+    random.seed(0)
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock)
+
+    async def call(parameter):
+        return await server.request_async(parameter)
+
+    wrapped, agent = rlretry(
+        state_func=failure_state,
+        timeout=timedelta(seconds=300),
+        dump_interval=10**9,
+        clock=simulator.clock,
+    )(call, return_agent=True)
+
+    start = time.monotonic()
+    result = simulator.run_traffic(
+        wrapped, duration=timedelta(hours=1), interval=timedelta(seconds=1)
+    )
+    assert time.monotonic() - start < 60
+
+    assert result.calls == 3600
+    assert result.duration >= timedelta(hours=1)
+    assert 0 < result.successes < result.calls
+    assert server.requests >= result.calls
+    assert "ClusteredFailure" in agent._state_action_map._df.index
+
+
+def test_sync_decorators_sleep_in_virtual_time():
+    random.seed(0)
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock, random_failure_rate=0.5)
+
+    wrapped = rlretry(
+        state_func=failure_state,
+        timeout=timedelta(seconds=60),
+        dump_interval=10**9,
+        clock=simulator.clock,
+    )(server.request)
+
+    start = time.monotonic()
+    result = simulator.run_traffic_sync(
+        wrapped, duration=timedelta(minutes=30), interval=timedelta(seconds=1)
+    )
+    assert time.monotonic() - start < 60
+    assert result.duration >= timedelta(minutes=30)
+    assert result.calls > 0
+
+
+def test_auto_request_interval_async_in_virtual_time():
+    random.seed(0)
+    simulator = Simulator()
+    server = SimulatedServer(simulator.clock, random_failure_rate=0.0)
+
+    @auto_request_interval(
+        maximum=timedelta(seconds=10),
+        time_increment=timedelta(seconds=1),
+        clock=simulator.clock,
+    )
+    async def call(parameter):
+        return await server.request_async(parameter)
+
+    async def traffic():
+        for _ in range(50):
+            try:
+                await call("abc")
+            except RuntimeError:
+                pass
+
+    simulator.run(traffic())
+    # the pacer waits between requests, in virtual time
+    assert simulator.clock.monotonic() > 0
+
+
+def test_simulate_example_learns(monkeypatch, tmp_path):
+    # the examples import the package as rlretry, and each other by module name
+    monkeypatch.syspath_prepend(str(pathlib.Path(__file__).parents[1] / "src"))
+    monkeypatch.syspath_prepend(str(pathlib.Path(__file__).parents[1] / "examples"))
+    from simulate_example import simulate
+
+    random.seed(0)
+    result, counts_df = simulate(timedelta(hours=2), tmp_path)
+
+    assert result.calls > 10000
+    assert {"RandomFailure", "ClusteredFailure", "RepeatableFailure"} <= set(
+        counts_df.index
+    )
+    assert counts_df.to_numpy().sum() > 0
+    assert (tmp_path / "counts_df.pickle").exists()
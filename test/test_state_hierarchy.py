@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from src.rlretry.rlretry import (
+    Action,
+    RLAgent,
+    RLEnvironment,
+    rlretry,
+    state_key,
+    state_levels,
+)
+
+
+def make_agent(min_state_samples):
+    return RLAgent(
+        0.0,
+        weight_loader=lambda: (None, None),
+        weight_dumper=lambda *args: None,
+        alpha=None,
+        min_state_samples=min_state_samples,
+    )
+
+
+def test_state_key_and_levels():
+    assert state_key(("ConnectionError", 503, "example.com")) == (
+        "ConnectionError/503/example.com"
+    )
+    assert state_key("ValueError") == "ValueError"
+    assert state_levels("ConnectionError/503/example.com") == (
+        "ConnectionError/503/example.com",
+        "ConnectionError/503",
+        "ConnectionError",
+    )
+    assert state_levels("ValueError") == ("ValueError",)
+
+
+def test_rewards_are_learned_at_every_level():
+    agent = make_agent(5)
+    agent.apply_reward("A/1/x", Action.RETRY0_5, 2.0)
+    agent.apply_reward("A/2/y", Action.RETRY0_5, 2.0)
+    counts = agent._state_action_map.to_dataframes()[1]
+    assert counts.loc["A", Action.RETRY0_5] == 2
+    assert counts.loc["A/1", Action.RETRY0_5] == 1
+    assert counts.loc["A/2/y", Action.RETRY0_5] == 1
+
+
+def test_rare_states_fall_back_to_coarser_levels():
+    agent = make_agent(5)
+    for host in ["a", "b", "c", "d", "e", "f"]:
+        agent.apply_reward(f"E/503/{host}", Action.RETRY0_5, 2.0)
+    assert agent._decision_state("E/503/new") == "E/503"
+    assert agent._decision_state("E/404/new") == "E"
+    assert agent.choose_action("E/503/new") == Action.RETRY0_5
+
+    for _ in range(5):
+        agent.apply_reward("E/503/hot", Action.RETRY0, 3.0)
+    assert agent._decision_state("E/503/hot") == "E/503/hot"
+    assert agent.choose_action("E/503/hot") == Action.RETRY0
+
+
+def test_without_min_state_samples_states_are_independent():
+    agent = make_agent(0)
+    agent.apply_reward("E/503/a", Action.RETRY0_5, 2.0)
+    assert list(agent._state_action_map.to_dataframes()[0].index) == ["E/503/a"]
+
+
+def test_rlretry_with_structured_states(monkeypatch):
+    class StatusError(Exception):
+        def __init__(self, status):
+            self.status = status
+
+    def execute_action(enviro, action):
+        return "success", 1.0
+
+    monkeypatch.setattr(RLEnvironment, "execute_action", execute_action)
+
+    def fails(status):
+        raise StatusError(status)
+
+    wrapped, agent = rlretry(
+        state_func=lambda e: (e.__class__.__name__, e.status),
+        min_state_samples=3,
+        timeout=timedelta(seconds=1),
+    )(fails, return_agent=True)
+    wrapped(503)
+    counts = agent._state_action_map.to_dataframes()[1]
+    assert set(counts.index) == {"StatusError", "StatusError/503"}
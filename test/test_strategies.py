@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from src.rlretry.rlretry import Action, RLAgent, StateActionMap
+from src.rlretry.strategies import (
+    DecayingEpsilonGreedy,
+    EpsilonGreedy,
+    ThompsonSampling,
+    UCB1,
+)
+
+
+def table_with(rewards):
+    """
+    a table where each action in rewards was tried len(rewards[action]) times in state "a"
+    """
+    sam = StateActionMap(None, None, 0.0, None)
+    for action, action_rewards in rewards.items():
+        for reward in action_rewards:
+            sam.update_average_reward("a", action, reward)
+    return sam
+
+
+@pytest.mark.parametrize(
+    "strategy",
+    [EpsilonGreedy(0.1), DecayingEpsilonGreedy(), UCB1(), ThompsonSampling(seed=0)],
+)
+def test_strategies_settle_on_the_best_action(strategy):
+    random.seed(0)
+    sam = StateActionMap(None, None, 0.0, None)
+    means = {
+        Action.ABRT: 1.0,
+        Action.RETRY0: 1.1,
+        Action.RETRY0_5: 1.3,
+        Action.RETRY0_2: 1.9,
+        Action.RETRY0_1: 1.2,
+    }
+    chosen = []
+    for _ in range(2000):
+        action, _ = strategy.select(sam, "a")
+        chosen.append(action)
+        # ABRT's reward is fixed
+        noise = 0.0 if action == Action.ABRT else random.gauss(0, 0.2)
+        sam.update_average_reward("a", action, means[action] + noise)
+
+    assert sam.best_action("a") == Action.RETRY0_2
+    assert chosen[-500:].count(Action.RETRY0_2) > 400
+
+
+@pytest.mark.parametrize(
+    "strategy", [DecayingEpsilonGreedy(), UCB1(), ThompsonSampling()]
+)
+def test_unknown_state_explores_a_retry(strategy):
+    sam = StateActionMap(None, None, 0.0, None)
+    for _ in range(20):
+        action, explored = strategy.select(sam, "new")
+        assert action != Action.ABRT
+        assert explored
+
+
+def test_ucb1_tries_every_action_first():
+    sam = table_with({Action.RETRY0: [2.0]})
+    strategy = UCB1()
+    tried = set()
+    for _ in range(3):
+        action, explored = strategy.select(sam, "a")
+        assert explored
+        tried.add(action)
+        sam.update_average_reward("a", action, 0.0)
+    assert tried == {Action.RETRY0_1, Action.RETRY0_2, Action.RETRY0_5}
+    assert strategy.select(sam, "a") == (Action.RETRY0, False)
+
+
+def test_decaying_epsilon_falls_with_visits():
+    strategy = DecayingEpsilonGreedy(initial=0.5, minimum=0.05, half_life=10)
+    assert strategy.state_epsilon(0) == 0.5
+    assert strategy.state_epsilon(10) == 0.25
+    assert strategy.state_epsilon(1000) == 0.05
+    # choosing in a well visited state doesn't change epsilon for other states
+    strategy.select(table_with({Action.RETRY0: [0.0] * 1000}), "a")
+    assert strategy.epsilon == 0.5
+
+
+def test_agent_uses_strategy():
+    class Always:
+        def select(self, table, state):
+            return Action.RETRY0_1, True
+
+    agent = RLAgent(
+        1.0,
+        weight_loader=lambda: (None, None),
+        weight_dumper=lambda *args: None,
+        strategy=Always(),
+    )
+    assert agent.select_action("a") == (Action.RETRY0_1, True)
+    assert agent.choose_action("a") == Action.RETRY0_1
@@ -0,0 +1,77 @@
+from datetime import timedelta
+import json
+import random
+
+from src.rlretry.rlretry import Action, RLAgent, rlretry
+from src.rlretry.telemetry import (
+    TelemetryStreamer,
+    TransitionRingBuffer,
+    jsonl_file_sink,
+)
+
+
+def test_ring_buffer_reads_by_cursor_and_counts_dropped():
+    buffer = TransitionRingBuffer(4)
+    for i in range(3):
+        buffer.append("a", Action.RETRY0, False, float(i), 0.0, "success")
+
+    batch = buffer.read()
+    assert list(batch.records["reward"]) == [0.0, 1.0, 2.0]
+    assert batch.cursor == 3 and batch.dropped == 0
+    assert buffer.read(batch.cursor).records.size == 0
+
+    for i in range(3, 10):
+        buffer.append("b", Action.RETRY0_1, True, float(i), 1.5, "b")
+    batch = buffer.read(batch.cursor, max_records=2)
+    # only the last 4 survive, so 3 of the 7 new transitions were overwritten
+    assert batch.dropped == 3
+    assert list(batch.records["reward"]) == [6.0, 7.0]
+    assert next(batch.to_dicts()) == {
+        "time": float(batch.records["time"][0]),
+        "state": "b",
+        "action": "RETRY0_1",
+        "explored": True,
+        "reward": 6.0,
+        "sleep": 1.5,
+        "outcome": "b",
+    }
+
+
+def test_select_action_reports_exploration():
+    random.seed(0)
+    assert RLAgent(1.0, alpha=0.1).select_action("a")[1]
+    assert not RLAgent(0.0, alpha=0.1).select_action("a")[1]
+
+
+def test_rlretry_streams_transitions_to_a_file(tmp_path):
+    random.seed(0)
+    attempts = 0
+
+    def flaky():
+        nonlocal attempts
+        attempts += 1
+        if attempts % 2:
+            raise RuntimeError("badness ocurred")
+        return attempts
+
+    wrapped, agent = rlretry(
+        timeout=timedelta(seconds=0.01), dump_interval=10**9, telemetry_capacity=1024
+    )(flaky, return_agent=True)
+
+    path = tmp_path / "telemetry.jsonl"
+    streamer = TelemetryStreamer(
+        agent.telemetry, jsonl_file_sink(str(path)), timedelta(seconds=0.01)
+    )
+    streamer.start()
+    for _ in range(20):
+        try:
+            wrapped()
+        except Exception:
+            pass
+    streamer.close()
+
+    with open(path) as f:
+        transitions = [json.loads(line) for line in f]
+    assert len(transitions) == agent.telemetry.read().cursor > 0
+    assert {t["state"] for t in transitions} == {"RuntimeError"}
+    assert {t["outcome"] for t in transitions} <= {"RuntimeError", "success", "abort"}
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import random
+
+from src.rlretry.rlretry import Action, RLAgent, RLRetryError, rlretry
+
+
+def test_no_rewards_are_lost_between_threads():
+    agent = RLAgent(0.1, alpha=None, thread_safe=True, reward_batch_size=16)
+    rewards_per_thread = 500
+    num_threads = 64
+
+    def worker(i: int):
+        for j in range(rewards_per_thread):
+            state = f"state{(i + j) % 7}"
+            agent.choose_action(state)
+            agent.apply_reward(state, Action.RETRY0, 1.0)
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(worker, range(num_threads)))
+
+    agent.flush_rewards()
+
+    counts_df = agent._state_action_map._counts_df
+    assert counts_df[Action.RETRY0].sum() == rewards_per_thread * num_threads
+    # the plain average of a constant reward is that reward
+    assert (agent._state_action_map._df[Action.RETRY0] == 1.0).all()
+
+
+def test_thread_safe_decorator():
+    random.seed(0)
+
+    def always_fails():
+        raise RuntimeError("badness ocurred")
+
+    wrapped_func, agent = rlretry(
+        max_retries=2,
+        timeout=timedelta(seconds=0.001),
+        thread_safe=True,
+        reward_batch_size=4,
+    )(always_fails, return_agent=True)
+
+    def call(_):
+        try:
+            wrapped_func()
+        except RLRetryError:
+            pass
+
+    with ThreadPoolExecutor(16) as pool:
+        list(pool.map(call, range(200)))
+
+    agent.flush_rewards()
+    assert agent._state_action_map._counts_df.loc["RuntimeError"].sum() >= 200
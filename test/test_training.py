@@ -0,0 +1,126 @@
+from datetime import timedelta
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.rlretry.rlretry import Action, StateActionMap, default_alpha_func, rlretry
+from src.rlretry.training import TransitionLog, read_transitions, train
+
+
+def random_transitions(num: int):
+    states = ["RuntimeError", "ValueError", "TimeoutError"]
+    return [
+        (
+            random.choice(states),
+            random.choice(list(Action)),
+            random.uniform(-1, 2.5),
+            random.choice(states + ["success", "abort"]),
+            random.random(),
+        )
+        for _ in range(num)
+    ]
+
+
+def sequential_table(transitions, initial_value, alpha, df=None, counts_df=None):
+    sam = StateActionMap(df, counts_df, initial_value, alpha)
+    for state, action, reward, _, _ in transitions:
+        sam.update_average_reward(state, action, reward)
+    return sam.to_dataframes()
+
+
+@pytest.mark.parametrize("alpha", [default_alpha_func, 0.1, None, 1.0])
+def test_train_matches_sequential_updates(tmp_path, alpha):
+    random.seed(0)
+    transitions = random_transitions(2000)
+    log = TransitionLog(tmp_path / "transitions", buffer_size=64)
+    for transition in transitions:
+        log.record(*transition)
+
+    df, counts_df = train(log.read(), initial_value=1.0, alpha=alpha)
+    expected_df, expected_counts_df = sequential_table(transitions, 1.0, alpha)
+
+    expected_df = expected_df.reindex(index=df.index)
+    expected_counts_df = expected_counts_df.reindex(index=df.index)
+    np.testing.assert_allclose(df.to_numpy(), expected_df.to_numpy(), atol=1e-9)
+    assert (counts_df.to_numpy() == expected_counts_df.to_numpy()).all()
+
+
+def test_train_continues_from_loaded_weights(tmp_path):
+    random.seed(1)
+    first, second = random_transitions(500), random_transitions(500)
+    base_df, base_counts_df = sequential_table(first, 0.0, default_alpha_func)
+
+    log = TransitionLog(tmp_path / "transitions")
+    for transition in second:
+        log.record(*transition)
+    df, counts_df = train(
+        log.read(), 0.0, default_alpha_func, weights=(base_df, base_counts_df)
+    )
+
+    expected_df, expected_counts_df = sequential_table(
+        first + second, 0.0, default_alpha_func
+    )
+    expected_df = expected_df.reindex(index=df.index)
+    np.testing.assert_allclose(df.to_numpy(), expected_df.to_numpy(), atol=1e-9)
+    assert counts_df.to_numpy().sum() == 1000
+
+
+def test_read_transitions_combines_logs_and_ignores_truncation(tmp_path):
+    log1 = TransitionLog(tmp_path / "a")
+    log1.record("s1", Action.RETRY0, 1.0, "success", 0.1)
+    log1.flush()
+    log2 = TransitionLog(tmp_path / "b")
+    log2.record("s2", Action.ABRT, 0.5, "abort", 0.0)
+    log2.record("s1", Action.RETRY0_1, 0.2, "s1", 0.3)
+    log2.flush()
+    with open(tmp_path / "b", "ab") as f:
+        f.write(b"\x01\x02")
+
+    transitions = read_transitions([tmp_path / "a", tmp_path / "b"])
+    assert len(transitions.records) == 3
+    states = [transitions.states[i] for i in transitions.records["state"]]
+    next_states = [transitions.states[i] for i in transitions.records["next_state"]]
+    assert states == ["s1", "s2", "s1"]
+    assert next_states == ["success", "abort", "s1"]
+
+    # reopening a log carries on with its state ids
+    log2 = TransitionLog(tmp_path / "b2")
+    log2.record("x", Action.ABRT, 0.0, "abort", 0.0)
+    log2.flush()
+    log2 = TransitionLog(tmp_path / "b2")
+    log2.record("y", Action.ABRT, 0.0, "x", 0.0)
+    transitions = log2.read()
+    assert [transitions.states[i] for i in transitions.records["next_state"]] == [
+        "abort",
+        "x",
+    ]
+
+
+def test_rlretry_records_transitions(tmp_path):
+    random.seed(0)
+    log = TransitionLog(tmp_path / "transitions")
+    attempts = 0
+
+    def flaky():
+        nonlocal attempts
+        attempts += 1
+        if attempts % 2:
+            raise RuntimeError("badness ocurred")
+        return attempts
+
+    wrapped = rlretry(
+        timeout=timedelta(seconds=0.01), dump_interval=10**9, transition_log=log
+    )(flaky)
+    for _ in range(20):
+        try:
+            wrapped()
+        except Exception:
+            pass
+
+    transitions = log.read()
+    assert len(transitions.records) > 0
+    assert {transitions.states[i] for i in transitions.records["state"]} == {
+        "RuntimeError"
+    }